@@ -275,6 +275,53 @@ class AbsorptionImageProcessor(object):
                 except Exception:
                     pass
 
+        self._initialize_from_file_list(beam_image_file_list)
+
+    def initialize_from_catalog(self, catalog, desired_roi,
+                                orientation='camera', **query_kwargs):
+        """Initialize an AbsorptionProcessor using shots from a ShotCatalog.
+
+        This does the same as self.initialize_from_file_patterns(), except that
+        the shots with the desired ROI are looked up in a
+        shot_catalog.ShotCatalog instead of opening every file to check its ROI.
+        The catalog should be updated with catalog.update() before calling this
+        method so that it includes the latest shots.
+
+        Args:
+            catalog (shot_catalog.ShotCatalog): The catalog of shots.
+            desired_roi (dict): The camera ROI that the shots should have. See
+                self.initialize_from_file_patterns() for more information.
+            orientation (str, optional): (Default = 'camera') The orientation of
+                the camera whose ROI is compared to desired_roi.
+            **query_kwargs: Additional keyword arguments are passed to
+                catalog.query() to further restrict which shots are used, e.g.
+                since=datetime.datetime.now() - datetime.timedelta(days=7).
+
+        Raises:
+            RuntimeError: This method (if called) must be called before any beam
+                images are added. If this method is called but beam images have
+                already been added, a RuntimeError is raised.
+        """
+        # Check if this instance has already been initialized.
+        if self._initialised:
+            message = ("initialize_from_catalog must be called before"
+                       " adding any beam images.")
+            raise RuntimeError(message)
+
+        beam_image_file_list = catalog.query(
+            roi=desired_roi,
+            orientation=orientation,
+            **query_kwargs,
+        )
+        self._initialize_from_file_list(beam_image_file_list)
+
+    def _initialize_from_file_list(self, beam_image_file_list):
+        """Redo __init__() and add the beam images from a list of shot files.
+
+        Args:
+            beam_image_file_list (list of str): The paths to the shot files
+                whose beam images should be added.
+        """
         # Remove duplicates, preserving order in case that matters.
         beam_image_file_list = list(dict.fromkeys(beam_image_file_list))
 
@@ -429,6 +476,34 @@ class AbsorptionImageProcessor(object):
         """
         return (type(object_).__name__ in ['RepeatedShot'])
 
+    @classmethod
+    def _get_background_subtracted_image(cls, run, frametype):
+        """Get one of a run's images with its background image subtracted.
+
+        If the run supports reading several frames at once with get_images(),
+        as our Shot class does, then both frames are read with the hdf5 file
+        opened only once. Otherwise they are read with two calls to
+        run.get_image(). RepeatedShot instances always use get_image() since
+        that averages the images over all of their shots.
+
+        Args:
+            run (lyse.Run-like or RepeatedShot): The run from which to get the
+                images.
+            frametype (str): The frametype of the image, e.g. 'atoms' or
+                'beam'.
+
+        Returns:
+            image (np.ndarray): The image minus the 'background' image.
+        """
+        if hasattr(run, 'get_images') and not cls._is_repeatedshot_type(run):
+            image, background_image = run.get_images(
+                'camera', 'absorption', (frametype, 'background'))
+        else:
+            image = run.get_image('camera', 'absorption', frametype)
+            background_image = run.get_image(
+                'camera', 'absorption', 'background')
+        return image - background_image
+
     def add_beam_image(self, beam_image, enable_image_shape_error=True):
         """Add a beam image to the list of images used for reconstruction.
 
@@ -462,10 +537,7 @@ class AbsorptionImageProcessor(object):
         # get the actual beam_image from it.
         if self._is_run_type(beam_image):
             run = beam_image
-            beam_image = run.get_image('camera', 'absorption', 'beam')
-            background_image = run.get_image(
-                'camera', 'absorption', 'background')
-            beam_image = beam_image - background_image
+            beam_image = self._get_background_subtracted_image(run, 'beam')
 
         if not self._initialised:
             self._init(beam_image)
@@ -1037,10 +1109,7 @@ class AbsorptionImageProcessor(object):
         is_repeatedshot = self._is_repeatedshot_type(atoms_image)
         if is_run or is_repeatedshot:
             run = atoms_image
-            atoms_image = run.get_image('camera', 'absorption', 'atoms')
-            background_image = run.get_image(
-                'camera', 'absorption', 'background')
-            atoms_image = atoms_image - background_image
+            atoms_image = self._get_background_subtracted_image(run, 'atoms')
 
         # Ensure that image has the correct shape
         if atoms_image.shape != self.image_shape:
@@ -1087,10 +1156,7 @@ class AbsorptionImageProcessor(object):
         is_repeatedshot = self._is_repeatedshot_type(atoms_image)
         if is_run or is_repeatedshot:
             run = atoms_image
-            atoms_image = run.get_image('camera', 'absorption', 'atoms')
-            background_image = run.get_image(
-                'camera', 'absorption', 'background')
-            atoms_image = atoms_image - background_image
+            atoms_image = self._get_background_subtracted_image(run, 'atoms')
 
         reconstruction = self.reconstruct(atoms_image)
         od_image = np.log(reconstruction / atoms_image)
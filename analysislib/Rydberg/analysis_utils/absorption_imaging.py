@@ -0,0 +1,91 @@
+"""The calculations of the absorption image analysis, as plain numpy functions.
+
+Shot.process_image() and the lazy result graph from
+analysis_graph.build_absorption_image_graph() both analyze absorption images
+with the functions here, so that the two always give the same results. The
+functions don't save or plot anything, and they don't depend on Lyse.
+
+Example Usage:
+```
+processed_image = calculate_processed_image(atoms_image, no_atoms_image)
+image_roi = processed_image[roi_to_slices(roi)]
+horizontal_crossection, vertical_crossection = calculate_cross_sections(
+    image_roi)
+od = cross_section_od(horizontal_fit_params, vertical_fit_params)
+```
+"""
+import numpy as np
+
+
+def calculate_processed_image(atoms_image, no_atoms_image,
+                              background_image=None):
+    """Divide the atoms image by the no-atoms image.
+
+    The background is subtracted from both images first, if provided, and
+    negative values are clipped to zero. Pixels where the division gives inf or
+    nan are set to zero.
+
+    Args:
+        atoms_image (np.ndarray): The image of the atoms with the imaging beam
+            on.
+        no_atoms_image (np.ndarray): The image with the imaging beam on, after
+            the atoms have left the trap.
+        background_image (np.ndarray, optional): (Default = None) The image
+            with the imaging beam off and no atoms.
+
+    Returns:
+        processed_image (np.ndarray): The ratio of the intensities, as floats.
+    """
+    # Convert to floats first so that subtracting the background can't wrap
+    # around for unsigned integer images.
+    atoms_image = np.asarray(atoms_image, dtype=float)
+    no_atoms_image = np.asarray(no_atoms_image, dtype=float)
+    if background_image is not None:
+        atoms_image = np.clip(atoms_image - background_image, 0, np.inf)
+        no_atoms_image = np.clip(no_atoms_image - background_image, 0, np.inf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        processed_image = atoms_image / no_atoms_image
+    # Clean up any values that had infinities or nans after division.
+    processed_image[~np.isfinite(processed_image)] = 0
+    return processed_image
+
+
+def calculate_cross_sections(image_roi):
+    """Average an ROI of the processed image along each of its axes.
+
+    Args:
+        image_roi (np.ndarray): The ROI of the processed image, indexed as
+            [row, column].
+
+    Returns:
+        horizontal_crossection (np.ndarray): The cross section as a function of
+            x (the column), averaged over the rows.
+        vertical_crossection (np.ndarray): The cross section as a function of y
+            (the row), averaged over the columns.
+    """
+    return image_roi.mean(axis=0), image_roi.mean(axis=1)
+
+
+def cross_section_od(horizontal_params, vertical_params):
+    """Integrate the OD of a 2D gaussian from its cross sections' parameters.
+
+    The parameters are (center, sigma, amplitude, offset) as returned by
+    fitting_routines.fit_gaussian_with_offset() or
+    fitting_routines.estimate_gaussian_with_offset(). You can check that
+    integrating the 2D gaussian gives this equation.
+
+    Args:
+        horizontal_params (array-like): The parameters of the horizontal cross
+            section.
+        vertical_params (array-like): The parameters of the vertical cross
+            section.
+
+    Returns:
+        od (float): The integrated OD.
+    """
+    # params[0] is the center position and params[3] is the offset, which
+    # don't affect the integral.
+    amplitude = (horizontal_params[2] + vertical_params[2]) / 2
+    h_width = horizontal_params[1]
+    v_width = vertical_params[1]
+    return 2 * np.pi * np.abs(amplitude) * np.abs(h_width) * np.abs(v_width)
@@ -0,0 +1,386 @@
+"""A lazy, dependency-tracked graph of analysis results.
+
+Shot.process_image() calculates the processed image, the ROI crop, the cross
+sections, the gaussian fits, the OD, and the atom number in one go, so changing
+any one setting means redoing all of it. The ResultGraph class here instead
+describes each derived quantity as a function of named inputs. A result is only
+calculated when it is requested, and each result is stored with a fingerprint
+of its inputs. Requesting a result again only recalculates it if the
+fingerprint of any of its inputs has changed, so e.g. changing the ROI only
+recalculates the crop and everything downstream of it, but not the processed
+image.
+
+Results are cached in memory, and optionally in the shot's hdf5 file through a
+ShotResultStore. The store saves each result to the shot's results group (i.e.
+'results/shot_results') as usual and records its fingerprint as an attribute of a separate
+'result_fingerprints' group, so that a later script (or a later run of the same
+script) can reuse results whose inputs haven't changed.
+
+Example Usage:
+```
+graph = shot.absorption_image_graph(atoms_image, no_atoms_image, roi=roi)
+atom_number = graph.get('atom_number')
+# Changing the ROI only recalculates the crop, cross sections, fits, etc.
+graph.set_input('roi', new_roi)
+atom_number = graph.get('atom_number')
+```
+"""
+import hashlib
+
+import labscript_utils.h5_lock
+import h5py
+import numpy as np
+
+from analysislib.Rydberg.analysis_utils.absorption_imaging import (
+    calculate_cross_sections, calculate_processed_image, cross_section_od,
+)
+from analysislib.Rydberg.analysis_utils.fitting_routines import fit_gaussian_with_offset
+from analysislib.Rydberg.analysis_utils.image_storage import roi_to_slices
+
+FINGERPRINT_GROUP = 'result_fingerprints'
+
+
+def fingerprint(value):
+    """Calculate a fingerprint (hash) of a value.
+
+    Arrays are hashed from their data, shape, and dtype. Dictionaries, lists,
+    and tuples are hashed recursively. Everything else is hashed from its
+    repr().
+
+    Args:
+        value (any type): The value to fingerprint.
+
+    Returns:
+        fingerprint (str): A hexadecimal string which changes whenever value
+            changes.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    _update_hash(hasher, value)
+    return hasher.hexdigest()
+
+
+def _update_hash(hasher, value):
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        hasher.update(b'ndarray')
+        hasher.update(str((value.shape, value.dtype.str)).encode())
+        hasher.update(value.tobytes())
+    elif isinstance(value, dict):
+        hasher.update(b'dict')
+        for key in sorted(value, key=repr):
+            _update_hash(hasher, key)
+            _update_hash(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(type(value).__name__.encode())
+        for item in value:
+            _update_hash(hasher, item)
+    else:
+        hasher.update(repr(value).encode())
+
+
+class ResultNode(object):
+    """A derived quantity in a ResultGraph.
+
+    Attributes:
+        name (str): The name of the result.
+        function (function): The function which calculates the result. It is
+            called with the values of the inputs as positional arguments, in the
+            same order as inputs.
+        inputs (tuple of str): The names of the inputs and results that this
+            result depends on.
+        kind (str or None): How the result is saved to a store: 'scalar',
+            'array', 'image', or None to only cache it in memory.
+        version (str): Changing this forces the result to be recalculated, e.g.
+            after changing function.
+    """
+
+    def __init__(self, name, function, inputs=(), kind=None, version='1'):
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.kind = kind
+        self.version = version
+
+
+class ShotResultStore(object):
+    """Stores graph results in a Shot's hdf5 file along with their fingerprints.
+
+    Scalars are saved with shot.save_result(), arrays with
+    shot.save_result_array(), and images with shot.save_result_image(), so the
+    results are available in the same places as if they were calculated by
+    Shot.process_image(). The fingerprints are saved as attributes of the
+    FINGERPRINT_GROUP group so that they don't show up as results.
+    """
+
+    def __init__(self, shot, fingerprint_group=FINGERPRINT_GROUP):
+        """Create a ShotResultStore.
+
+        Args:
+            shot (data_classes.Shot): The shot in whose file the results are
+                stored.
+            fingerprint_group (str, optional): (Default = FINGERPRINT_GROUP) The
+                group in the hdf5 file in which to save the fingerprints.
+        """
+        self.shot = shot
+        self.fingerprint_group = fingerprint_group
+
+    def load(self, name, kind, fingerprint_):
+        """Load a result if it was stored with the given fingerprint.
+
+        Args:
+            name (str): The name of the result.
+            kind (str): The kind of result, see ResultNode.
+            fingerprint_ (str): The fingerprint the stored result must have.
+
+        Returns:
+            found (bool): Whether a matching result was found.
+            value (any type): The result if found, otherwise None.
+        """
+        with h5py.File(self.shot.h5_path, 'r') as h5_file:
+            if self.fingerprint_group not in h5_file:
+                return False, None
+            stored_fingerprint = h5_file[self.fingerprint_group].attrs.get(name)
+        if isinstance(stored_fingerprint, bytes):
+            stored_fingerprint = stored_fingerprint.decode()
+        if stored_fingerprint != fingerprint_:
+            return False, None
+        try:
+            if kind == 'scalar':
+                value = self.shot.get_result(self.shot.group, name)
+            elif kind == 'array':
+                value = self.shot.get_result_array(self.shot.group, name)
+            else:
+                value = self.shot.get_result_image(name)
+        except Exception:
+            return False, None
+        setattr(self.shot, name, value)
+        return True, value
+
+    def save(self, name, kind, value, fingerprint_):
+        """Save a result and its fingerprint.
+
+        Args:
+            name (str): The name of the result.
+            kind (str): The kind of result, see ResultNode.
+            value (any type): The result.
+            fingerprint_ (str): The fingerprint of the result's inputs.
+        """
+        if kind == 'scalar':
+            self.shot.save_result(name, value)
+        elif kind == 'array':
+            self.shot.save_result_array(name, value)
+        elif kind == 'image':
+            self.shot.save_result_image(name, value)
+        with h5py.File(self.shot.h5_path, 'a') as h5_file:
+            group = h5_file.require_group(self.fingerprint_group)
+            group.attrs[name] = fingerprint_
+
+
+class ResultGraph(object):
+    """A graph of named inputs and the results calculated from them.
+
+    Inputs are set with self.set_input(), and results are declared with
+    self.add_result(). Calling self.get() then calculates only the results
+    needed for the requested one, reusing cached results whose inputs haven't
+    changed.
+
+    Attributes:
+        store (ShotResultStore or None): Where results with a kind are saved
+            and loaded from, in addition to the in-memory cache.
+        n_calculations (dict): The number of times each result has been
+            calculated, which is useful for checking what was recalculated.
+    """
+
+    def __init__(self, store=None):
+        """Create an empty ResultGraph.
+
+        Args:
+            store (ShotResultStore, optional): (Default = None) Where to save
+                and load results. If None, results are only cached in memory.
+        """
+        self.store = store
+        self.n_calculations = {}
+        self._inputs = {}
+        self._input_fingerprints = {}
+        self._nodes = {}
+        # Maps result names to (fingerprint, value).
+        self._cache = {}
+
+    def set_input(self, name, value):
+        """Set the value of an input.
+
+        Results that depend on the input are recalculated the next time they
+        are requested, but only if the value actually changed.
+
+        Args:
+            name (str): The name of the input.
+            value (any type): The value of the input.
+        """
+        if name in self._nodes:
+            raise ValueError(f"{name} is a result, not an input.")
+        self._inputs[name] = value
+        self._input_fingerprints[name] = fingerprint(value)
+
+    def add_result(self, name, function, inputs=(), kind=None, version='1'):
+        """Declare a result and how to calculate it.
+
+        Args:
+            name (str): The name of the result.
+            function (function): The function which calculates the result from
+                the values of inputs, passed as positional arguments.
+            inputs (list of str, optional): (Default = ()) The names of the
+                inputs and other results that this result depends on.
+            kind (str, optional): (Default = None) How to save the result to
+                self.store: 'scalar', 'array', 'image', or None to only cache it
+                in memory.
+            version (str, optional): (Default = '1') Change this to force the
+                result to be recalculated, e.g. after changing function.
+        """
+        if name in self._inputs:
+            raise ValueError(f"{name} is an input, not a result.")
+        self._nodes[name] = ResultNode(name, function, inputs, kind, version)
+        self._cache.pop(name, None)
+
+    def _fingerprint(self, name, visiting=()):
+        """Get the fingerprint of an input or result without calculating it."""
+        if name in self._input_fingerprints:
+            return self._input_fingerprints[name]
+        if name not in self._nodes:
+            raise KeyError(f"{name} is neither an input nor a result.")
+        if name in visiting:
+            raise ValueError(f"The result {name} depends on itself.")
+        node = self._nodes[name]
+        input_fingerprints = [
+            self._fingerprint(input_name, visiting + (name,))
+            for input_name in node.inputs
+        ]
+        return fingerprint((name, node.version, input_fingerprints))
+
+    def get(self, name):
+        """Get the value of an input or result, calculating it only if needed.
+
+        Args:
+            name (str): The name of the input or result.
+
+        Raises:
+            KeyError: If name isn't an input or a result, or if a result depends
+                on an input which hasn't been set.
+            ValueError: If the results have a circular dependency.
+
+        Returns:
+            value (any type): The value of the input or result.
+        """
+        if name in self._inputs:
+            return self._inputs[name]
+        node_fingerprint = self._fingerprint(name)
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == node_fingerprint:
+            return cached[1]
+
+        node = self._nodes[name]
+        found = False
+        if self.store is not None and node.kind is not None:
+            found, value = self.store.load(name, node.kind, node_fingerprint)
+        if not found:
+            input_values = [self.get(input_name) for input_name in node.inputs]
+            value = node.function(*input_values)
+            self.n_calculations[name] = self.n_calculations.get(name, 0) + 1
+            if self.store is not None and node.kind is not None:
+                self.store.save(name, node.kind, value, node_fingerprint)
+        self._cache[name] = (node_fingerprint, value)
+        return value
+
+    def is_current(self, name):
+        """Check if a result is cached with up to date inputs.
+
+        Args:
+            name (str): The name of the result.
+
+        Returns:
+            is_current (bool): True if getting the result wouldn't require
+                calculating it (ignoring self.store).
+        """
+        cached = self._cache.get(name)
+        return cached is not None and cached[0] == self._fingerprint(name)
+
+
+def build_absorption_image_graph(store=None):
+    """Create a ResultGraph for the absorption image analysis.
+
+    The graph has the same steps as Shot.process_image(), and uses the same
+    functions from the absorption_imaging module for them, except that the ROI
+    is an input rather than being picked automatically or by the user. The
+    inputs are:
+
+    * 'atoms_image', 'no_atoms_image', 'background_image': The camera frames.
+      background_image may be None.
+    * 'roi': The ROI as (x, y, width, height), in the same format as
+      cv2.selectROI().
+    * 'fit_settings': A dict of keyword arguments for
+      fitting_routines.fit_gaussian_with_offset().
+    * 'od_to_atom_number': The conversion factor from OD to atom number.
+
+    The results are 'processed_image', 'processed_image_roi',
+    'horizontal_crossection', 'vertical_crossection', 'horizontal_fit_params',
+    'vertical_fit_params', 'od', and 'atom_number'.
+
+    Args:
+        store (ShotResultStore, optional): (Default = None) Where to save and
+            load the results.
+
+    Returns:
+        graph (ResultGraph): The graph, with none of its inputs set.
+    """
+    graph = ResultGraph(store=store)
+    graph.add_result(
+        'processed_image',
+        calculate_processed_image,
+        ['atoms_image', 'no_atoms_image', 'background_image'],
+        kind='image',
+    )
+    graph.add_result(
+        'processed_image_roi',
+        lambda processed_image, roi: processed_image[roi_to_slices(roi)],
+        ['processed_image', 'roi'],
+    )
+    graph.add_result(
+        'horizontal_crossection',
+        lambda image_roi: calculate_cross_sections(image_roi)[0],
+        ['processed_image_roi'],
+        kind='array',
+    )
+    graph.add_result(
+        'vertical_crossection',
+        lambda image_roi: calculate_cross_sections(image_roi)[1],
+        ['processed_image_roi'],
+        kind='array',
+    )
+    graph.add_result(
+        'horizontal_fit_params',
+        lambda cross_section, roi, fit_settings: fit_gaussian_with_offset(
+            cross_section, indices=np.arange(roi[0], roi[0] + roi[2]),
+            **fit_settings),
+        ['horizontal_crossection', 'roi', 'fit_settings'],
+        kind='array',
+    )
+    graph.add_result(
+        'vertical_fit_params',
+        lambda cross_section, roi, fit_settings: fit_gaussian_with_offset(
+            cross_section, indices=np.arange(roi[1], roi[1] + roi[3]),
+            **fit_settings),
+        ['vertical_crossection', 'roi', 'fit_settings'],
+        kind='array',
+    )
+    graph.add_result(
+        'od',
+        cross_section_od,
+        ['horizontal_fit_params', 'vertical_fit_params'],
+        kind='scalar',
+    )
+    graph.add_result(
+        'atom_number',
+        lambda od, od_to_atom_number: od_to_atom_number * od,
+        ['od', 'od_to_atom_number'],
+        kind='scalar',
+    )
+    return graph
@@ -0,0 +1,360 @@
+"""Send M-LOOP costs to the optimizer over a local socket.
+
+Normally the M-LOOP costs are saved to the shot files, and the M-LOOP
+integration reads them back from there, so every optimizer iteration waits on
+file system and hdf5 file lock latency. The classes here pass the costs directly
+instead. The cost routine publishes each cost as a small message with a
+CostPublisher, and the optimizer side receives it from a CostSubscriber
+listening on a local socket. The costs are still saved to the shot files for
+provenance, but in the background by a ResultReplicator (see
+result_replication.py), so the iteration turnaround is set by the analysis time
+rather than disk I/O. If no subscriber is listening, report_cost() saves the
+cost to the shot file right away instead, so the file-based M-LOOP integration
+keeps working.
+
+Messages are dictionaries sent as JSON, with the keys 'cost', 'uncertainty',
+'bad', 'shot_ids', and 'time'; see make_cost_message().
+
+To test a cost routine without M-LOOP, run this module to start a stand-in
+subscriber on the loopback interface which prints every message it receives:
+```
+python -m analysislib.Rydberg.analysis_utils.cost_channel
+```
+
+Example Usage:
+```
+# Cost routine side:
+publisher = CostPublisher()
+report_cost(shot, cost, uncertainty, publisher, write_behind, replicator)
+
+# Optimizer side:
+subscriber = CostSubscriber()
+message = subscriber.get(timeout=60)
+```
+"""
+import json
+import queue
+import socket
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from analysislib.Rydberg.analysis_utils.result_replication import (
+    ResultReplicator, get_journal_path,
+)
+
+DEFAULT_ADDRESS = ('localhost', 6061)
+DEFAULT_AUTHKEY = b'mloop_costs'
+COST_GROUP = 'results/mloop_costs'
+
+
+def make_cost_message(cost, uncertainty, bad=False, shot_ids=()):
+    """Create a message describing one M-LOOP cost.
+
+    Args:
+        cost (float): The cost.
+        uncertainty (float): The uncertainty in the cost.
+        bad (bool, optional): (Default = False) Whether the run should be
+            treated as bad by M-LOOP, e.g. because the cost is nan.
+        shot_ids (list of str, optional): (Default = ()) Identifies the shots
+            that the cost was calculated from, e.g. their file paths.
+
+    Returns:
+        message (dict): The message.
+    """
+    return {
+        'cost': float(cost),
+        'uncertainty': float(uncertainty),
+        'bad': bool(bad),
+        'shot_ids': [str(shot_id) for shot_id in shot_ids],
+        'time': time.time(),
+    }
+
+
+class CostPublisher(object):
+    """Publishes cost messages to a CostSubscriber.
+
+    The connection is opened when the first message is published and reopened
+    as needed, e.g. after the subscriber is restarted, so a CostPublisher can be
+    created before the subscriber is running.
+
+    Attributes:
+        address (tuple): The (host, port) of the subscriber.
+        authkey (bytes): The key used to authenticate with the subscriber.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY):
+        """Create a CostPublisher.
+
+        Args:
+            address (tuple, optional): (Default = DEFAULT_ADDRESS) The
+                (host, port) of the subscriber.
+            authkey (bytes, optional): (Default = DEFAULT_AUTHKEY) The key used
+                to authenticate with the subscriber.
+        """
+        self.address = tuple(address)
+        self.authkey = authkey
+        self._connection = None
+
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except OSError:
+                pass
+            self._connection = None
+
+    def publish(self, message):
+        """Send a message to the subscriber.
+
+        This doesn't block waiting for a subscriber; if none is listening the
+        message is dropped.
+
+        Args:
+            message (dict): The message, e.g. from make_cost_message().
+
+        Returns:
+            delivered (bool): Whether the message was handed to a subscriber's
+                connection.
+        """
+        payload = json.dumps(message).encode()
+        # Try twice, since an existing connection may be stale if the
+        # subscriber was restarted since the last message.
+        for _ in range(2):
+            if self._connection is None:
+                try:
+                    self._connection = Client(self.address,
+                                              authkey=self.authkey)
+                except (OSError, AuthenticationError):
+                    return False
+            try:
+                # Subscribers never send anything, so a readable connection
+                # means that the subscriber closed it.
+                if self._connection.poll():
+                    raise ConnectionResetError
+                self._connection.send_bytes(payload)
+                return True
+            except (OSError, EOFError):
+                self._disconnect()
+        return False
+
+    def close(self):
+        """Close the connection to the subscriber, if there is one."""
+        self._disconnect()
+
+
+class CostSubscriber(object):
+    """Receives cost messages from CostPublishers.
+
+    A background thread accepts connections from publishers and queues the
+    messages that they send, which are then retrieved with get().
+
+    Attributes:
+        address (tuple): The (host, port) being listened on. If the port was
+            given as 0, this has the port that was picked.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY):
+        """Create a CostSubscriber and start listening.
+
+        Args:
+            address (tuple, optional): (Default = DEFAULT_ADDRESS) The
+                (host, port) to listen on. Use port 0 to pick a free port.
+            authkey (bytes, optional): (Default = DEFAULT_AUTHKEY) The key that
+                publishers must use.
+        """
+        self._authkey = authkey
+        self._listener = Listener(tuple(address), authkey=authkey)
+        self.address = self._listener.address
+        self._messages = queue.Queue()
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._accept, name='CostSubscriber', daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # Failed handshakes are ignored, and closing the listener
+                # ends the loop.
+                continue
+            with self._lock:
+                if self._closed:
+                    connection.close()
+                    return
+                self._connections.add(connection)
+            threading.Thread(target=self._receive, args=(connection,),
+                             daemon=True).start()
+
+    def _receive(self, connection):
+        while not self._closed:
+            try:
+                payload = connection.recv_bytes()
+            except (OSError, EOFError):
+                break
+            self._messages.put(json.loads(payload.decode()))
+        with self._lock:
+            self._connections.discard(connection)
+        connection.close()
+
+    def get(self, timeout=None):
+        """Get the next message.
+
+        Args:
+            timeout (float, optional): (Default = None) The maximum time, in
+                seconds, to wait for a message. If None, wait as long as
+                necessary.
+
+        Raises:
+            queue.Empty: If no message arrived within timeout.
+
+        Returns:
+            message (dict): The message, as from make_cost_message().
+        """
+        return self._messages.get(timeout=timeout)
+
+    def close(self):
+        """Stop listening for publishers and close their connections."""
+        with self._lock:
+            self._closed = True
+            connections = list(self._connections)
+        # Connect once to wake up the thread blocked in accept().
+        try:
+            Client(self.address, authkey=self._authkey).close()
+        except (OSError, EOFError, AuthenticationError):
+            pass
+        self._listener.close()
+        self._thread.join()
+        # Shutting down the sockets wakes up the threads blocked reading them,
+        # and lets the publishers see that they were closed.
+        for connection in connections:
+            try:
+                with socket.fromfd(connection.fileno(), socket.AF_INET,
+                                   socket.SOCK_STREAM) as sock:
+                    sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_write_behind_journal_path(routine_name):
+    """Get the journal path for a routine's write-behind replicator.
+
+    The journal is different from the one that get_journal_path() gives for the
+    routine's other ResultReplicator, and from those of other routines.
+
+    Args:
+        routine_name (str): The name of the routine, e.g.
+            'mloop_calculate_cost'.
+
+    Returns:
+        journal_path (str): The path of the journal file.
+    """
+    return get_journal_path(f'{routine_name}_cost_write_behind')
+
+
+def create_write_behind(journal_path):
+    """Create a ResultReplicator that writes results to the shot file itself.
+
+    It's used to save costs to the copy of the shot file that they were
+    calculated for, in the background, once they've been delivered over the
+    cost channel.
+
+    Args:
+        journal_path (str): The path of the replicator's journal, e.g. from
+            get_write_behind_journal_path(). Lyse runs each routine in its own
+            worker process, so each routine must use its own journal, which
+            must also be different from the journal of any other
+            ResultReplicator.
+
+    Returns:
+        (ResultReplicator): The replicator.
+    """
+    return ResultReplicator(lambda h5_path: h5_path, journal_path=journal_path)
+
+
+def report_cost(shot, cost, uncertainty, publisher, write_behind, replicator,
+                bad=False, shot_ids=(), group=COST_GROUP,
+                save_to_both_copies=None):
+    """Publish an M-LOOP cost and save it to both copies of the shot file.
+
+    The cost is published first. If it was delivered, it's saved to shot's file
+    in the background by write_behind; otherwise it's saved right away so that
+    the file-based M-LOOP integration can read it. Either way it's replicated
+    to the other copy of the shot file in the background by replicator, if
+    there is one. Without a replicator, the cost is instead saved to both
+    copies right away with save_to_both_copies, if provided. The cost and
+    uncertainty are saved as mloop_cost and u_mloop_cost, which is the naming
+    convention required by the M-LOOP lyse integration code.
+
+    Args:
+        shot (lyse.Run-like): The shot to save the cost to, e.g. a
+            data_classes.Shot instance for the original copy of the file.
+        cost (float): The cost.
+        uncertainty (float): The uncertainty in the cost.
+        publisher (CostPublisher): The publisher to send the cost with.
+        write_behind (ResultReplicator): Saves the cost to shot's file in the
+            background, e.g. from create_write_behind().
+        replicator (ResultReplicator or None): Replicates the cost to the other
+            copy of the shot file. If None, save_to_both_copies is used instead.
+        bad (bool, optional): (Default = False) Whether the run should be
+            treated as bad by M-LOOP.
+        shot_ids (list of str, optional): (Default = ()) Identifies the shots
+            that the cost was calculated from.
+        group (str, optional): (Default = COST_GROUP) The group in the hdf5
+            file to save the cost to.
+        save_to_both_copies (function, optional): (Default = None) Called as
+            save_to_both_copies(shot, name, value, group=group) to save the
+            cost to both copies of the shot file when replicator is None, e.g.
+            save_result_to_both_copies() from multishot_utils. If this is None
+            too, the cost is only saved to shot's file.
+
+    Returns:
+        delivered (bool): Whether the cost was delivered over the channel.
+    """
+    message = make_cost_message(cost, uncertainty, bad=bad, shot_ids=shot_ids)
+    delivered = publisher.publish(message)
+    for name, value in (('mloop_cost', cost), ('u_mloop_cost', uncertainty)):
+        if replicator is None and save_to_both_copies is not None:
+            # Without a replicator, fall back to saving to both copies right
+            # away so that the other copy still gets the cost.
+            save_to_both_copies(shot, name, value, group=group)
+        elif delivered:
+            write_behind.submit(shot.h5_path, group, name, value)
+        else:
+            shot.save_result(name, value, group=group)
+        if replicator is not None:
+            replicator.submit(shot.h5_path, group, name, value)
+    return delivered
+
+
+def serve_loopback(address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY):
+    """Run a stand-in subscriber on the loopback interface, printing messages.
+
+    This is useful for testing cost routines without running M-LOOP. Stop it
+    with Ctrl+C.
+    """
+    with CostSubscriber(address, authkey) as subscriber:
+        print(f"Listening for costs on {subscriber.address}...")
+        try:
+            while True:
+                message = subscriber.get()
+                print(f"Cost: {message['cost']} +/- {message['uncertainty']}"
+                      f" (bad: {message['bad']}, "
+                      f"shots: {len(message['shot_ids'])})")
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    serve_loopback()
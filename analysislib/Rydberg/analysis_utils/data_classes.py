@@ -5,7 +5,6 @@ import os.path
 import labscript_utils.h5_lock
 import h5py
 from pynput.keyboard import Key, Listener
-from matplotlib import patches
 import matplotlib.pyplot as plt
 import cv2
 import matplotlib as mpl
@@ -14,7 +13,19 @@ np.seterr(divide='ignore', invalid='ignore') # ignore annoying division error fo
 import scipy.constants
 
 from lyse import Run, routine_storage
-from analysislib.Rydberg.analysis_utils.fitting_routines import fit_gaussian_with_offset, gaussian, gaussian_with_offset
+from analysislib.Rydberg.analysis_utils.absorption_imaging import (
+    calculate_cross_sections, calculate_processed_image, cross_section_od,
+)
+from analysislib.Rydberg.analysis_utils.analysis_graph import ShotResultStore, build_absorption_image_graph
+from analysislib.Rydberg.analysis_utils.fit_cache import cached_fit_gaussian_with_offset
+from analysislib.Rydberg.analysis_utils.fitting_routines import (
+    estimate_gaussian_with_offset, fit_gaussian_with_offset, gaussian, gaussian_with_offset,
+)
+from analysislib.Rydberg.analysis_utils.image_pyramid import PYRAMID_GROUP, write_pyramid
+from analysislib.Rydberg.analysis_utils.image_storage import read_image_dataset, roi_to_slices, write_image_dataset
+from analysislib.Rydberg.analysis_utils.live_plotting import AbsorptionImageLiveView
+from analysislib.Rydberg.analysis_utils.mloop_costs import DEFAULT_N_PEAK_PIXELS, top_k_mean
+from analysislib.Rydberg.analysis_utils.roi_finder import find_roi
 from lyse.dataframe_utilities import get_nested_dict_from_shot, asdatetime
 from labscript_utils.connections import _ensure_str
 from runmanager import get_shot_globals
@@ -59,6 +70,12 @@ OD_TO_ATOM_NUMBER = OD_TO_ATOM_NUMBER_CORRECTION * BASLER_PIXEL_SIZE**2 / SIGMA_
 # is to convert K to uK.
 TEMPERATURE_COEFF = BASLER_PIXEL_SIZE**2 * (M87 / scipy.constants.k) * 1e6
 
+# The ways that Shot.process_image() can analyze the cross sections. See its docstring for details.
+FIT_MODES = ('fit', 'moments')
+# The fit caches that Shot.fit_cross_sections() can use. See its docstring for details.
+FIT_CACHE_MODES = (None, 'memory', 'file')
+
+
 def group_by_function(object_list, grouping_function, *args, **kwargs):
     """Group objects by the results of applying grouping_function to them.
 
@@ -398,9 +415,11 @@ class Shot(Run):
         except Exception:
             pass
 
-        # If it wasn't a scalar, let's see if an array result exists.
+        # If it wasn't a scalar, let's see if an array result exists. Reading
+        # it with get_result_image() decodes compactly stored images and returns
+        # other arrays unchanged.
         try:
-            return self.get_result_array(self.group, name)
+            return self.get_result_image(name)
         except Exception:
             pass
 
@@ -468,30 +487,166 @@ class Shot(Run):
         setattr(self, result_name, result_array)
         super().save_result_array(result_name, result_array, **kwargs)
 
-    def process_image(self, atoms_image, no_atoms_image, background_image=None, plot=True):
+    def save_result_image(self, result_name, image, lossy=None, pyramid=False, **kwargs):
+        """Save an image to the hdf5 file compactly and as an attribute of this instance.
+
+        This is similar to self.save_result_array(), except that the image is saved as a chunked hdf5 dataset with the
+        shuffle filter and a fast compressor. That makes it practical to keep images such as the processed image or
+        OD image for every shot, and it makes it possible to read just an ROI of the image later with
+        self.get_result_image(). Optionally a lossy encoding can be used to shrink the image further. See the
+        image_storage module for more information.
+
+        Note that the attribute of this instance is set to the original image, even if a lossy encoding is used.
+
+        Args:
+            result_name (str): The name to use to store the result, e.g. 'od_image'. See self.save_result_array() for
+                more information.
+            image (np.array): The image to store.
+            lossy (str, optional): The lossy encoding to use, either None (lossless), 'float16', or 'quantized'.
+                Defaults to None.
+            pyramid (bool, optional): whether to also save 2x, 4x, and 8x downsampled copies of the image in the
+                'image_pyramids' group, for quickly browsing many shots. See the image_pyramid module. Defaults to
+                False.
+            **kwargs: Additional keyword arguments are passed to image_storage.write_image_dataset(), e.g.
+                quantization_bits, chunks, or compression.
+        """
+        setattr(self, result_name, image)
+        with h5py.File(self.h5_path, 'a') as h5_file:
+            # Like lyse.Run, keep the results of self.group in a subgroup of the 'results' group.
+            group = h5_file.require_group('results').require_group(self.group)
+            write_image_dataset(group, result_name, image, lossy=lossy, **kwargs)
+            if pyramid:
+                write_pyramid(h5_file.require_group(PYRAMID_GROUP), result_name, image)
+
+    def get_result_image(self, result_name, roi=None):
+        """Read an image result from the hdf5 file, optionally only an ROI of it.
+
+        Images saved with self.save_result_image() are decoded automatically. Arrays saved with
+        self.save_result_array() can be read with this method as well.
+
+        Args:
+            result_name (str): The name of the result, e.g. 'processed_image'.
+            roi (tuple of ints, optional): If provided, only this region of the image is read from the file. It
+                should be given as (x, y, width, height), in the same format as cv2.selectROI(). Defaults to None.
+
+        Returns:
+            image (np.array): The image, or the ROI of the image.
+        """
+        with h5py.File(self.h5_path, 'r') as h5_file:
+            return read_image_dataset(h5_file['results'][self.group][result_name], roi=roi)
+
+    def get_image(self, orientation, label, image, roi=None):
+        """Get an image taken during the shot, optionally only an ROI of it.
+
+        This extends lyse.Run.get_image() so that only a region of the image can be read. Only that hyperslab of the
+        hdf5 dataset is read from the file, which is much faster than reading the full frame when the ROI is small
+        compared to the camera's sensor. The image keeps the datatype it was saved with, as in lyse.Run.get_image().
+
+        Args:
+            orientation (str): The orientation of the camera, e.g. 'basler'.
+            label (str): The 'name' argument passed to camera.expose() in the labscript, e.g. 'CMOT'.
+            image (str): The 'frametype' argument passed to camera.expose() in the labscript, e.g. 'atoms'.
+            roi (tuple of ints, optional): If provided, only this region of the image is read. It should be given as
+                (x, y, width, height), in the same format as cv2.selectROI(). Defaults to None.
+
+        Raises:
+            Exception: If the shot has no images, or not one with the requested orientation, label, and frametype.
+
+        Returns:
+            image (np.array): The image, or the ROI of the image.
+        """
+        return self.get_images(orientation, label, (image,), roi=roi)[0]
+
+    def get_images(self, orientation, label, frametypes=('atoms', 'no_atoms'), roi=None, dtype=None):
+        """Get several frames of an exposure at once, stacked into one array.
+
+        All of the frames are read while the hdf5 file is opened only once, rather than once per frame as happens when
+        calling self.get_image() for each of them. If roi is provided, then only that region of each frame is read.
+
+        Args:
+            orientation (str): The orientation of the camera, e.g. 'basler'.
+            label (str): The 'name' argument passed to camera.expose() in the labscript, e.g. 'CMOT'.
+            frametypes (list of str, optional): The frametypes to read, e.g. ('atoms', 'no_atoms', 'background').
+                Defaults to ('atoms', 'no_atoms').
+            roi (tuple of ints, optional): If provided, only this region of each frame is read. It should be given as
+                (x, y, width, height), in the same format as cv2.selectROI(). Defaults to None.
+            dtype (np.dtype, optional): If provided, the frames are converted to this datatype, e.g. np.float64 to
+                avoid integer overflow when subtracting them. Defaults to None, which keeps the stored datatype.
+
+        Raises:
+            Exception: If the shot has no images, or not the requested orientation, label, or frametypes.
+
+        Returns:
+            images (np.array): A 3D array where images[j] is the frame (or ROI of the frame) for frametypes[j].
+        """
+        slices = () if roi is None else roi_to_slices(roi)
+        with h5py.File(self.h5_path, 'r') as h5_file:
+            # Raise the same sort of errors as lyse.Run.get_image().
+            if 'images' not in h5_file:
+                raise Exception('File does not contain any images')
+            if orientation not in h5_file['images']:
+                raise Exception(f'File does not contain any images with orientation \'{orientation}\'')
+            if label not in h5_file['images'][orientation]:
+                raise Exception(f'File does not contain any images with label \'{label}\'')
+            label_group = h5_file['images'][orientation][label]
+            images = []
+            for frametype in frametypes:
+                if frametype not in label_group:
+                    raise Exception(f'Image \'{frametype}\' not found in file')
+                images.append(label_group[frametype][slices])
+        images = np.stack(images)
+        if dtype is not None:
+            images = images.astype(dtype, copy=False)
+        return images
+
+    def process_image(self, atoms_image, no_atoms_image, background_image=None, plot=True,
+                      roi=None, auto_roi=True, roi_n_sigmas=3., follow_previous_roi=True,
+                      save_processed_image=True, image_lossy=None, save_image_pyramid=False, fit_mode='fit'):
         """Here we take in a series of absorption images, process them, and perform gaussian fits. From the gaussian fits,
         we can get the OD + the atom # in the cloud. Finally, we can plot the fits + the processed image if plot is true
 
+        The ROI is chosen automatically with roi_finder.find_roi() by default so that Lyse doesn't block waiting for
+        the user. A manually selected ROI can still be used, either by passing it as roi, by setting auto_roi to False,
+        or by pressing the '`' key on the plot, which asks the user to draw an ROI on the next shot. That manual ROI is
+        then used until the 'a' key is pressed to switch back to automatic ROI selection.
+
         Args:
             atoms_image (2d image): image of the atoms with imaging beam turned on
             no_atoms_image (2d image): the image beam is turned on, but the atoms have decayed out of the trap
             background_image (2d image, optional): the image beam is off and there are no atoms. Defaults to None.
             plot (bool, optional): whether or not to plot the results. Defaults to True.
+            roi (tuple of ints, optional): an ROI as (x, y, width, height), in the same format as returned by
+                cv2.selectROI(). If provided, it overrides both the automatic and the stored manual ROI. Defaults to
+                None.
+            auto_roi (bool, optional): whether to find the ROI automatically. If False, the user is asked to select
+                an ROI whenever none is stored in routine_storage. Defaults to True.
+            roi_n_sigmas (float, optional): how many sigmas of the cloud's width the automatic ROI extends from the
+                center of the cloud in each direction. Defaults to 3.
+            follow_previous_roi (bool, optional): whether the automatic ROI search is restricted to the area around
+                the previous shot's ROI. Defaults to True.
+            save_processed_image (bool, optional): whether to save the processed image to the hdf5 file. It is saved
+                with self.save_result_image(), so it is compressed and its ROI can be read back on its own. Defaults
+                to True.
+            image_lossy (str, optional): the lossy encoding used when saving the processed image, either None
+                (lossless), 'float16', or 'quantized'. See the image_storage module. Defaults to None.
+            save_image_pyramid (bool, optional): whether to also save downsampled copies of the processed image for
+                browsing many shots with image_pyramid.plot_contact_sheet(). Only used if save_processed_image is
+                True. This adds more writes for every shot, so it's usually better to write the pyramids in a separate
+                pass with image_pyramid.write_shot_pyramids(). Defaults to False.
+            fit_mode (str, optional): how the cross sections are analyzed. The closed-form moment estimates from
+                self.estimate_cross_sections() are always calculated first, since they're nearly free. Then with
+                'fit', the gaussian fits from self.fit_cross_sections() are done right away, as before. With 'moments'
+                no fits are done, and the estimates are plotted instead, which is fast enough to keep up with the
+                camera. Note that od and atom_number are then not saved at all, so multishot routines which use them
+                (e.g. autoplot_atom_number.py and the M-LOOP costs) should use od_estimate and atom_number_estimate
+                instead. Defaults to 'fit'.
         """
+        if fit_mode not in FIT_MODES:
+            raise ValueError(f"fit_mode must be one of {FIT_MODES}, not {fit_mode!r}.")
 
-        # remove the background from the images, ensure that there are not negative numbers in the images
-        if background_image is not None:
-            atoms_image = np.clip(atoms_image - background_image, 0, np.inf)
-            no_atoms_image = np.clip(no_atoms_image - background_image, 0, np.inf)
-
-        # divide the two to get the ratios of intensities. Used in the OD calculation
-        self.processed_image = atoms_image / no_atoms_image
-
-        # clean up any values that had infinities after division
-        inf_indices = np.isinf(self.processed_image)
-        nan_indices = np.isnan(self.processed_image)
-        remove_indices = np.logical_or(inf_indices, nan_indices)
-        self.processed_image[remove_indices] = 0
+        # remove the background from the images, then divide the two to get the ratios of intensities. Used in the OD
+        # calculation. This is shared with absorption_image_graph() so that both give the same results.
+        self.processed_image = calculate_processed_image(atoms_image, no_atoms_image, background_image)
 
         # ADD IN ARTIFICIAL DATA FOR PRESENTATION PURPOSES. 
         # DELETE OR COMMENT THIS OUT LATER
@@ -503,11 +658,25 @@ class Shot(Run):
             for j in range(4*width):
                 self.processed_image[image_y+j, image_x+i] -= amplitude * np.exp(-(2*width-i)**2/width**2 - (2*width-j)**2/width**2)
 
-        # If we do not have image_roi saved in the routine_storage variable..
-        if not hasattr(routine_storage, 'image_roi'):
+        # Pick the ROI. An explicitly provided roi always wins, then a manually selected one, then the automatic one.
+        if roi is not None:
+            routine_storage.image_roi = tuple(roi)
+        elif auto_roi and not getattr(routine_storage, 'manual_roi', False):
+            previous_roi = getattr(routine_storage, 'image_roi', None)
+            found_roi = find_roi(
+                self.processed_image,
+                n_sigmas=roi_n_sigmas,
+                previous_roi=previous_roi if follow_previous_roi else None,
+            )
+            # If no cloud was found, keep the previous ROI, or use the full image if there isn't one yet.
+            if found_roi is not None:
+                routine_storage.image_roi = found_roi
+            elif previous_roi is None:
+                routine_storage.image_roi = (0, 0, self.processed_image.shape[1], self.processed_image.shape[0])
+        elif not hasattr(routine_storage, 'image_roi'):
             # ask the user for an image roi! The user can choose an new roi by pressing ` (the key under the escape key)
             cv2.namedWindow("Image",2)
-            cv2.resizeWindow("Image", 800, 600) 
+            cv2.resizeWindow("Image", 800, 600)
             routine_storage.image_roi = cv2.selectROI("Image", self.processed_image, showCrosshair=True)
             cv2.waitKey(1)
             cv2.destroyAllWindows()
@@ -515,95 +684,226 @@ class Shot(Run):
         # Get the rectangle parameters that the user selected! Save those and the roi in the HDF file
         self.x0, self.y0, self.w, self.h = routine_storage.image_roi
         self.save_result("roi", routine_storage.image_roi)
-        self.processed_image_roi = self.processed_image[int(self.x0):int(self.x0+self.w), int(self.y0):int(self.y0+self.h)]
-        #self.save_result_array("processed_image", self.processed_image)
+        # The ROI's x is the column index and y is the row index, as for cv2.selectROI().
+        self.processed_image_roi = self.processed_image[roi_to_slices(routine_storage.image_roi)]
+        if save_processed_image:
+            self.save_result_image("processed_image", self.processed_image, lossy=image_lossy,
+                                   pyramid=save_image_pyramid)
 
         # Get crossections from the ROI to fit; save them
-        horizontal_crossection = self.processed_image_roi.sum(axis=1)/self.processed_image_roi.shape[1]
-        vertical_crossection = self.processed_image_roi.sum(axis=0)/self.processed_image_roi.shape[0]
+        horizontal_crossection, vertical_crossection = calculate_cross_sections(self.processed_image_roi)
         self.save_result_array("horizontal_crossection", horizontal_crossection)
         self.save_result_array("vertical_crossection", vertical_crossection)
         
+        # Get quick estimates of the cloud's parameters, then fit them unless only the estimates are wanted.
+        self.estimate_cross_sections()
+        self.calculate_peak_od()
+        if fit_mode == 'fit':
+            self.fit_cross_sections()
+
+        # if plot, plot
+        if plot:
+            self.plot_absorption_image(use_fits=(fit_mode == 'fit'))
+
+    def estimate_cross_sections(self):
+        """Estimate the cloud's parameters from the cross sections without fitting.
+
+        This uses fitting_routines.estimate_gaussian_with_offset(), which calculates the gaussian parameters in
+        closed form from the moments of the cross sections, so it's much faster than self.fit_cross_sections(). The
+        parameters are saved as horizontal_moment_params and vertical_moment_params, and the resulting OD and atom
+        number as od_estimate and atom_number_estimate. self.process_image() must be run first.
+        """
+        horizontal_moment_params = np.array(estimate_gaussian_with_offset(
+            self.horizontal_crossection, indices=np.arange(self.x0, self.x0+self.w)))
+        vertical_moment_params = np.array(estimate_gaussian_with_offset(
+            self.vertical_crossection, indices=np.arange(self.y0, self.y0+self.h)))
+        self.save_result_array("horizontal_moment_params", horizontal_moment_params)
+        self.save_result_array("vertical_moment_params", vertical_moment_params)
+
+        od = cross_section_od(horizontal_moment_params, vertical_moment_params)
+        self.save_result("od_estimate", od)
+        self.save_result("atom_number_estimate", OD_TO_ATOM_NUMBER * od)
+
+    def calculate_peak_od(self, n_peak_pixels=None):
+        """Calculate the peak OD of the cloud by averaging the OD of its brightest pixels.
+
+        The peak OD is saved as the scalar result peak_od, so that multishot routines such as the M-LOOP cost
+        calculations can use it without reading and sorting the OD image of every shot again. The pixels are found
+        with mloop_costs.top_k_mean(), which uses np.partition() instead of sorting the image. self.process_image()
+        must be run first.
+
+        Args:
+            n_peak_pixels (int, optional): the number of pixels with the largest OD to average. If None, the value of
+                the mloop_n_peak_pixels_average global is used if it exists, otherwise DEFAULT_N_PEAK_PIXELS. Defaults
+                to None.
+
+        Returns:
+            float: the peak OD.
+        """
+        if n_peak_pixels is None:
+            n_peak_pixels = self.globals.get('mloop_n_peak_pixels_average', DEFAULT_N_PEAK_PIXELS)
+
+        # Pixels that were zeroed because of bad divisions give an OD of inf, which makes the peak OD inf, as it did
+        # when the brightest pixels were found by sorting the OD image.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            od_image = -np.log(self.processed_image_roi)
+        peak_od = top_k_mean(od_image, n_peak_pixels)
+        self.save_result("peak_od", peak_od)
+        return peak_od
+
+    def fit_cross_sections(self, warm_start=True, use_cache='memory'):
+        """Fit gaussians to the cross sections and calculate the OD and atom number from the fits.
+
+        The fit parameters are saved as horizontal_fit_params and vertical_fit_params, and the resulting OD and atom
+        number as od and atom_number. The number of function evaluations used by each fit is saved as
+        horizontal_fit_nfev and vertical_fit_nfev, which can be used to check how much warm starting helps.
+        self.process_image() must be run first.
+
+        Args:
+            warm_start (bool, optional): whether to start the fits from the previous shot's fit parameters, which are
+                kept in routine_storage. Consecutive shots in a scan usually have nearly identical clouds, so this
+                needs fewer iterations. fit_gaussian_with_offset() falls back to its usual initial guesses if the
+                previous parameters don't look reasonable for this shot or the fit diverges. Defaults to True.
+            use_cache (str, optional): which cache to use to reuse the results of identical fits, e.g. when
+                reanalyzing a shot with the same ROI, see the fit_cache module. With 'memory' the results are only
+                kept in this process's in-memory cache. With 'file' they are also saved to and loaded from the hdf5
+                file, so they survive restarting lyse, at the cost of an extra file open and write for every shot.
+                With None no cache is used. The nfev results are 0 for fits that came from the cache. Defaults to
+                'memory'.
+
+        Raises:
+            ValueError: if use_cache isn't one of FIT_CACHE_MODES.
+        """
+        if use_cache not in FIT_CACHE_MODES:
+            raise ValueError(f"use_cache must be one of {FIT_CACHE_MODES}, not {use_cache!r}.")
+        previous_fit_params = getattr(routine_storage, 'previous_fit_params', {}) if warm_start else {}
+
+        if use_cache == 'file':
+            fit_function = lambda *args, **kwargs: cached_fit_gaussian_with_offset(*args, h5_path=self.h5_path, **kwargs)
+        elif use_cache == 'memory':
+            fit_function = cached_fit_gaussian_with_offset
+        else:
+            fit_function = fit_gaussian_with_offset
+
         # get the parameters of a gaussian + offset that fit the cross section for both vertical and horizontal
-        horizontal_fit_params = fit_gaussian_with_offset(horizontal_crossection, indices=np.arange(self.x0, self.x0+self.w))
-        vertical_fit_params = fit_gaussian_with_offset(vertical_crossection, indices=np.arange(self.y0, self.y0+self.h))
+        horizontal_fit_params, horizontal_info = fit_function(
+            self.horizontal_crossection, indices=np.arange(self.x0, self.x0+self.w),
+            initial_guesses=previous_fit_params.get('horizontal'), full_output=True)
+        vertical_fit_params, vertical_info = fit_function(
+            self.vertical_crossection, indices=np.arange(self.y0, self.y0+self.h),
+            initial_guesses=previous_fit_params.get('vertical'), full_output=True)
         self.save_result_array("horizontal_fit_params", horizontal_fit_params)
         self.save_result_array("vertical_fit_params", vertical_fit_params)
+        self.save_result("horizontal_fit_nfev", horizontal_info['nfev'])
+        self.save_result("vertical_fit_nfev", vertical_info['nfev'])
+        routine_storage.previous_fit_params = {'horizontal': horizontal_fit_params, 'vertical': vertical_fit_params}
 
-        # the gaussian parameters (params[0] is the center position, params[3] is the offset)
-        amplitude = (horizontal_fit_params[2] + vertical_fit_params[2])/2
-        h_width = horizontal_fit_params[1]
-        v_width = vertical_fit_params[1]
-
-        # Integrate the OD using the gaussian fit parameters, which is then converted to atom number using constants defined at the top of the page. 
-        # You can check that integrating the 2d gaussian gives this eqn.
-        od = 2 * np.pi * np.abs(amplitude) * np.abs(h_width) * np.abs(v_width)
+        # Integrate the OD using the gaussian fit parameters, which is then converted to atom number using constants
+        # defined at the top of the page.
+        od = cross_section_od(horizontal_fit_params, vertical_fit_params)
         atom_number = OD_TO_ATOM_NUMBER * od
         self.save_result("od", od)
         self.save_result("atom_number", atom_number)
 
-        # if plot, plot
-        if plot:
-            self.plot_absorption_image()
-        
-    def plot_absorption_image(self):
-        """Plot the results of the process_image function
-        """
+    def absorption_image_graph(self, atoms_image, no_atoms_image, background_image=None, roi=None,
+                               fit_settings=None, store_results=True):
+        """Create a lazy result graph for the absorption image analysis of this shot.
 
-        # if we have already created a figure, skip this.
-        # if we have *not* created a figure, create a new figure
-        # the code is written this way so that we do not have to recreate a figure each time we process a new shot
-        if not hasattr(routine_storage, 'fig'):
-            routine_storage.fig = plt.figure(constrained_layout=True, figsize=DEFAULT_FIGURE_SIZE)
-            routine_storage.gs = routine_storage.fig.add_gridspec(3, 3)
+        This is an opt-in alternative to self.process_image(). Nothing is calculated until a result is requested with
+        graph.get(), e.g. graph.get('atom_number'), and then only the results that it depends on are calculated. If
+        an input such as the ROI or the fit settings is later changed with graph.set_input(), only the results
+        downstream of it are recalculated. See the analysis_graph module for more information.
 
-            # if the user pressed the '`' key, ask the user for a new ROI on the next shot
-            def on_press(event, key_text='`'):
-                if event.key == key_text and hasattr(routine_storage, 'image_roi'):
-                    delattr(routine_storage, "image_roi")
+        Unlike self.process_image(), this doesn't add the artificial data, ask the user for an ROI, or plot anything.
 
-            # add the above function to our plot
-            routine_storage.fig.canvas.mpl_connect('key_press_event', on_press)
-
-        # the image occupies grid spaces [0, 0], [0, 1], [1, 0], and [1, 1] in our 3x3 grid
-        image_axis = routine_storage.fig.add_subplot(routine_storage.gs[0:2, 0:2])
-
-        plot_img = image_axis.imshow(self.processed_image, cmap=plt.get_cmap('plasma'))
-        routine_storage.fig.colorbar(plot_img, ax=image_axis)
-            
-        # Create a Rectangle patch that denotes the selected ROI 
-        rect = patches.Rectangle((self.x0, self.y0), self.w, self.h, linewidth=1, edgecolor='w', facecolor='none')
+        Args:
+            atoms_image (2d image): image of the atoms with imaging beam turned on
+            no_atoms_image (2d image): the image beam is turned on, but the atoms have decayed out of the trap
+            background_image (2d image, optional): the image beam is off and there are no atoms. Defaults to None.
+            roi (tuple of ints, optional): the ROI as (x, y, width, height), in the same format as returned by
+                cv2.selectROI(). If None, the ROI is found automatically with roi_finder.find_roi(), which requires
+                calculating the processed image right away. Defaults to None.
+            fit_settings (dict, optional): keyword arguments passed to fit_gaussian_with_offset() for both cross
+                sections. Defaults to None, which uses the default settings.
+            store_results (bool, optional): whether to save the results to the hdf5 file along with fingerprints of
+                their inputs. Results in the file whose inputs haven't changed are then loaded instead of being
+                recalculated, even by a different Shot instance. Defaults to True.
 
-        # Add the patch to the Axes
-        image_axis.add_patch(rect)
+        Returns:
+            graph (analysis_graph.ResultGraph): The graph, with all of its inputs set.
+        """
+        store = ShotResultStore(self) if store_results else None
+        graph = build_absorption_image_graph(store=store)
+        graph.set_input('atoms_image', atoms_image)
+        graph.set_input('no_atoms_image', no_atoms_image)
+        graph.set_input('background_image', background_image)
+        graph.set_input('fit_settings', {} if fit_settings is None else dict(fit_settings))
+        graph.set_input('od_to_atom_number', OD_TO_ATOM_NUMBER)
+        if roi is None:
+            processed_image = graph.get('processed_image')
+            roi = find_roi(processed_image)
+            if roi is None:
+                roi = (0, 0, processed_image.shape[1], processed_image.shape[0])
+        graph.set_input('roi', tuple(int(value) for value in roi))
+        return graph
+
+    def plot_absorption_image(self, use_fits=True):
+        """Plot the results of the process_image function
 
-        # create a new plot to show the crossection + the fit
-        horizontal_axis = routine_storage.fig.add_subplot(routine_storage.gs[2, 0:2], sharex=image_axis)
+        Args:
+            use_fits (bool, optional): whether to plot the results of self.fit_cross_sections(). If False, the results
+                of self.estimate_cross_sections() are plotted instead. Defaults to True.
+        """
+        if use_fits:
+            horizontal_params, vertical_params = self.horizontal_fit_params, self.vertical_fit_params
+            od, atom_number, label_suffix = self.od, self.atom_number, ""
+        else:
+            horizontal_params, vertical_params = self.horizontal_moment_params, self.vertical_moment_params
+            od, atom_number, label_suffix = self.od_estimate, self.atom_number_estimate, " (estimate)"
+
+        # if we have already created the live view, skip this.
+        # if we have *not* created the live view, create it. The live view creates all of its artists once and then
+        # only updates their data for each new shot, so the figure doesn't get slower to draw over a long run.
+        if not hasattr(routine_storage, 'live_view'):
+            # if the user pressed the '`' key, ask the user for a new ROI on the next shot and keep using it. Pressing
+            # 'a' switches back to finding the ROI automatically.
+            def on_press(event, key_text='`', auto_key_text='a'):
+                if event.key == key_text:
+                    routine_storage.manual_roi = True
+                    if hasattr(routine_storage, 'image_roi'):
+                        delattr(routine_storage, "image_roi")
+                elif event.key == auto_key_text:
+                    routine_storage.manual_roi = False
+
+            routine_storage.live_view = AbsorptionImageLiveView(
+                figsize=DEFAULT_FIGURE_SIZE,
+                key_press_callback=on_press,
+            )
 
         # the x-points are the width of the rectangle we selected as the ROI
         x_points = np.linspace(self.x0, self.x0+self.w, 1000)
-        # plot the abs of the log of the cross section, which we fit in process_image()
-        horizontal_data_plot = horizontal_axis.scatter(np.arange(self.x0, self.x0+self.w), abs(np.log(self.horizontal_crossection)), s=1, c='y')
-        # plot the fit of the horizontal cross section
-        horizontal_fit_plot = horizontal_axis.plot(x_points, gaussian_with_offset(x_points, *self.horizontal_fit_params), c='r')[0]
-
-        # do the same as above, except for the vertical crossection
-        vertical_axis = routine_storage.fig.add_subplot(routine_storage.gs[0:2, 2], sharey=image_axis)
-
         y_points = np.linspace(self.y0, self.y0+self.h, 1000)
-        vertical_data_plot = vertical_axis.scatter(abs(np.log(self.vertical_crossection)), np.arange(self.y0, self.y0+self.h), s=1, c='y')
-        vertical_fit_plot = vertical_axis.plot(gaussian_with_offset(y_points, *self.vertical_fit_params), y_points, c='r')[0]
-        vertical_axis.invert_xaxis()
-
-        # add in some text results for the plot
-        text_axis = routine_storage.fig.add_subplot(routine_storage.gs[2, 2])
-        text_axis.set_axis_off()
-
-        text_axis.text(0, 0.375, "Atom Number: {:.3E}".format(self.atom_number))
-        text_axis.text(0, 0.75, "OD: {:.3E}".format(self.od))
 
-        print("Atom Number: {:.3E}".format(self.atom_number))
-        print("OD: {:.3E}".format(self.od))
+        # plot the abs of the log of the cross sections, which we fit in process_image(), along with the fits
+        routine_storage.live_view.update(
+            self.processed_image,
+            (self.x0, self.y0, self.w, self.h),
+            horizontal_indices=np.arange(self.x0, self.x0+self.w),
+            horizontal_data=abs(np.log(self.horizontal_crossection)),
+            horizontal_fit_positions=x_points,
+            horizontal_fit_values=gaussian_with_offset(x_points, *horizontal_params),
+            vertical_indices=np.arange(self.y0, self.y0+self.h),
+            vertical_data=abs(np.log(self.vertical_crossection)),
+            vertical_fit_positions=y_points,
+            vertical_fit_values=gaussian_with_offset(y_points, *vertical_params),
+            text_lines=[
+                "OD{}: {:.3E}".format(label_suffix, od),
+                "Atom Number{}: {:.3E}".format(label_suffix, atom_number),
+            ],
+        )
+
+        print("Atom Number{}: {:.3E}".format(label_suffix, atom_number))
+        print("OD{}: {:.3E}".format(label_suffix, od))
 
 
 # Below are classes that Zak made, but that I haven't had to use yet. I'm keeping them in case they are useful in the future
@@ -0,0 +1,127 @@
+"""Helpers for working with the Lyse dataframe in multishot routines.
+
+Multishot routines usually run once per shot, with the full dataframe each
+time. Routines which keep state between runs in routine_storage, such as
+running_statistics.LineAggregator and scan_gridding.ScanGrid, only need to
+process the rows that were added since their previous run. IncrementalRows
+keeps track of which rows those are. It also notices when already processed
+rows have changed, e.g. because the singleshot routines were rerun on some
+shots after changing the ROI, or because shots were removed from Lyse, in which
+case the caller should start over from the full dataframe.
+
+Example Usage:
+```
+rows = IncrementalRows(watched_columns=[('shot_results', 'atom_number')])
+new_rows, restarted = rows.update(df)
+if restarted:
+    ...  # Forget everything calculated from the previous rows.
+atom_numbers = column_values(new_rows, ('shot_results', 'atom_number'))
+```
+"""
+import zlib
+
+import numpy as np
+
+
+def column_values(df, column):
+    """Get the values of a column of a (possibly multi-indexed) dataframe.
+
+    Args:
+        df (pd.DataFrame): The dataframe, e.g. from lyse.data().
+        column (str or tuple): The name of the column. With a multi-indexed
+            dataframe, a top-level name can be used if there is only one column
+            under it, e.g. 'filepath' or the name of a global.
+
+    Returns:
+        values (np.ndarray): A 1D array with one value per row.
+    """
+    values = df[column]
+    # With a multi-indexed column, a top-level name can select a dataframe with
+    # one column.
+    return np.asarray(values).reshape(len(df), -1)[:, 0]
+
+
+class IncrementalRows(object):
+    """Keeps track of which rows of a growing dataframe have been processed.
+
+    The dataframe is assumed to only grow by appending rows. The rows processed
+    so far are considered unchanged if the dataframe still has at least as many
+    rows, the filepath of the last processed row is the same, and a checksum of
+    the values of the watched columns in the processed rows is the same. The
+    checksum covers the exact bytes of the values, so a result that is filled in
+    after being nan counts as a change.
+
+    Only the number of rows, the last filepath, and one running checksum per
+    watched column are kept, and the checksums are extended with just the new
+    rows when they are processed. Checking the processed rows still reads their
+    watched values, but only to checksum them in a single pass, which is much
+    faster than processing the rows again.
+
+    Attributes:
+        watched_columns (tuple): The numeric columns whose values in processed
+            rows are checked for changes, e.g. the results being averaged.
+        n_rows (int): The number of dataframe rows that have been processed.
+    """
+
+    def __init__(self, watched_columns=()):
+        """Create an IncrementalRows instance with no processed rows.
+
+        Args:
+            watched_columns (list, optional): (Default = ()) The numeric columns
+                whose values in processed rows are checked for changes.
+        """
+        self.watched_columns = tuple(watched_columns)
+        self.reset()
+
+    def reset(self):
+        """Forget all of the processed rows."""
+        self.n_rows = 0
+        self._last_filepath = None
+        self._checksums = [0 for _ in self.watched_columns]
+
+    def _column_checksum(self, rows, column, checksum=0):
+        # crc32 can be continued from a previous value, so checksumming the new
+        # rows starting from the checksum of the processed rows gives the same
+        # result as checksumming all of them at once.
+        values = np.ascontiguousarray(column_values(rows, column), dtype=float)
+        return zlib.crc32(values, checksum)
+
+    def _processed_rows_unchanged(self, df):
+        if len(df) < self.n_rows:
+            return False
+        if self.n_rows == 0:
+            return True
+        if df['filepath'].iloc[self.n_rows - 1] != self._last_filepath:
+            return False
+        processed_rows = df.iloc[:self.n_rows]
+        for column, checksum in zip(self.watched_columns, self._checksums):
+            if self._column_checksum(processed_rows, column) != checksum:
+                return False
+        return True
+
+    def update(self, df):
+        """Get the rows which haven't been processed yet, and mark them processed.
+
+        Args:
+            df (pd.DataFrame): The dataframe, e.g. from lyse.data(). It must
+                have a 'filepath' column.
+
+        Returns:
+            new_rows (pd.DataFrame): The rows to process. If restarted is True,
+                this is the whole dataframe.
+            restarted (bool): Whether the processed rows changed, in which case
+                everything calculated from them should be discarded.
+        """
+        restarted = not self._processed_rows_unchanged(df)
+        if restarted:
+            self.reset()
+        new_rows = df.iloc[self.n_rows:]
+        if len(new_rows):
+            self._checksums = [
+                self._column_checksum(new_rows, column, checksum)
+                for column, checksum in zip(self.watched_columns,
+                                            self._checksums)
+            ]
+            self.n_rows = len(df)
+            self._last_filepath = df['filepath'].iloc[-1]
+        return new_rows, restarted
@@ -0,0 +1,284 @@
+"""Memoization of fit results keyed by the contents of the fitted data.
+
+Rerunning a singleshot routine on the same shot with the same ROI, e.g. after
+tweaking some plotting code, refits the same cross sections from scratch. The
+functions here cache fit results under a key calculated from the fitted data,
+the index grid, and the fit options, so that identical fits are only done once.
+Results are kept in a bounded, least recently used, in-memory FitCache and can
+optionally also be saved in the shot file in the 'fit_cache' group, so that
+they are reused even after Lyse is restarted or by a different script. Saving
+to the shot file opens and writes it for every fit, so it is opt-in.
+
+Options which only affect where a fit starts rather than the result it
+converges to, such as the initial_guesses used to warm start
+fitting_routines.fit_gaussian_with_offset(), are not part of the key.
+
+Example Usage:
+```
+# only cached in memory
+params = cached_fit_gaussian_with_offset(cross_section, indices)
+# also cached in the shot file
+params = cached_fit_gaussian_with_offset(cross_section, indices,
+                                         h5_path=shot.h5_path)
+```
+"""
+from collections import OrderedDict
+
+import labscript_utils.h5_lock
+import h5py
+import numpy as np
+
+from analysislib.Rydberg.analysis_utils.analysis_graph import fingerprint
+from analysislib.Rydberg.analysis_utils.fitting_routines import (
+    fit_gaussian_log_iterative,
+    fit_gaussian_with_offset,
+)
+
+FIT_CACHE_GROUP = 'fit_cache'
+DEFAULT_MAX_ENTRIES = 1024
+# Increment this to invalidate all cached results, e.g. after changing how a
+# fitting function works.
+FIT_CACHE_VERSION = '1'
+
+
+class FitCache(object):
+    """A bounded in-memory cache of fit results.
+
+    When the cache is full, the least recently used result is discarded.
+
+    Attributes:
+        max_entries (int): The maximum number of results to keep.
+        hits (int): The number of lookups which found a result.
+        misses (int): The number of lookups which didn't find a result.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        """Create a FitCache.
+
+        Args:
+            max_entries (int, optional): (Default = DEFAULT_MAX_ENTRIES) The
+                maximum number of results to keep.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Get a cached result, or None if there isn't one."""
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value.copy()
+
+    def put(self, key, value):
+        """Add a result to the cache, discarding the oldest one if it's full."""
+        self._entries[key] = np.array(value, dtype=float)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all results from the cache."""
+        self._entries.clear()
+
+
+# The cache used when none is specified. It lasts as long as this module stays
+# imported, e.g. between shots in Lyse.
+default_fit_cache = FitCache()
+
+
+def fit_key(function_name, data, indices=None, options=None):
+    """Calculate the cache key for a fit.
+
+    Args:
+        function_name (str): The name of the fitting function.
+        data (np.ndarray): The data which is fitted.
+        indices (np.ndarray, optional): (Default = None) The indices (i.e.
+            x-values) of the data.
+        options (dict, optional): (Default = None) The fit options which affect
+            the result.
+
+    Returns:
+        key (str): The key, which changes if any of the arguments change.
+    """
+    if indices is not None:
+        indices = np.asarray(indices)
+    return fingerprint((
+        FIT_CACHE_VERSION,
+        function_name,
+        np.asarray(data),
+        indices,
+        {} if options is None else dict(options),
+    ))
+
+
+def load_cached_fit(h5_path, key):
+    """Load a fit result saved in a shot file, or return None if there isn't one.
+    """
+    with h5py.File(h5_path, 'r') as h5_file:
+        if FIT_CACHE_GROUP not in h5_file or key not in h5_file[FIT_CACHE_GROUP]:
+            return None
+        return h5_file[FIT_CACHE_GROUP][key][()]
+
+
+def save_cached_fit(h5_path, key, value, function_name):
+    """Save a fit result to a shot file under its key."""
+    with h5py.File(h5_path, 'a') as h5_file:
+        group = h5_file.require_group(FIT_CACHE_GROUP)
+        if key in group:
+            del group[key]
+        dataset = group.create_dataset(key, data=np.array(value, dtype=float))
+        dataset.attrs['function'] = function_name
+
+
+def memoize_fit(function_name, calculate, data, indices=None, options=None,
+                cache=None, h5_path=None):
+    """Get a fit result from the caches, or calculate and cache it.
+
+    The in-memory cache is checked first, then the shot file if h5_path is
+    given. A result found in the file is also added to the in-memory cache.
+
+    Args:
+        function_name (str): The name of the fitting function, used in the key.
+        calculate (function): Called with no arguments to do the fit if the
+            result isn't cached. It should return the fitted parameters as an
+            array or tuple of floats.
+        data (np.ndarray): The data which is fitted.
+        indices (np.ndarray, optional): (Default = None) The indices (i.e.
+            x-values) of the data.
+        options (dict, optional): (Default = None) The fit options which affect
+            the result.
+        cache (FitCache, optional): (Default = None) The in-memory cache. If
+            None, default_fit_cache is used.
+        h5_path (str, optional): (Default = None) The path of a shot file to
+            also cache the result in. If None, only the in-memory cache is used.
+
+    Returns:
+        result (np.ndarray): The fitted parameters.
+        cached (bool): Whether the result came from a cache.
+    """
+    if cache is None:
+        cache = default_fit_cache
+    key = fit_key(function_name, data, indices, options)
+
+    result = cache.get(key)
+    if result is not None:
+        return result, True
+    if h5_path is not None:
+        result = load_cached_fit(h5_path, key)
+        if result is not None:
+            cache.put(key, result)
+            return result, True
+
+    result = np.array(calculate(), dtype=float)
+    cache.put(key, result)
+    if h5_path is not None:
+        save_cached_fit(h5_path, key, result, function_name)
+    return result, False
+
+
+def cached_fit_gaussian_with_offset(cross_section, indices=None, cache=None,
+                                    h5_path=None, **kwargs):
+    """A cached version of fitting_routines.fit_gaussian_with_offset().
+
+    Args:
+        cross_section (np.ndarray): The cross section to fit.
+        indices (np.ndarray, optional): (Default = None) The indices (i.e.
+            x-values) of the cross section.
+        cache (FitCache, optional): (Default = None) The in-memory cache. If
+            None, default_fit_cache is used.
+        h5_path (str, optional): (Default = None) The path of a shot file to
+            also cache the result in.
+        **kwargs: Additional keyword arguments are passed on to
+            fit_gaussian_with_offset(). All of them except initial_guesses and
+            full_output are part of the cache key.
+
+    Returns:
+        The same as fit_gaussian_with_offset(). If full_output is True and the
+        result came from a cache, the info dictionary has 'nfev' set to 0 and
+        'cached' set to True.
+    """
+    full_output = kwargs.pop('full_output', False)
+    options = {
+        name: value for name, value in kwargs.items()
+        if name != 'initial_guesses'
+    }
+    info = {'nfev': 0, 'warm_started': False, 'cached': True}
+
+    def calculate():
+        params, fit_info = fit_gaussian_with_offset(
+            cross_section, indices=indices, full_output=True, **kwargs)
+        info.update(fit_info, cached=False)
+        return params
+
+    params, _ = memoize_fit('fit_gaussian_with_offset', calculate,
+                            cross_section, indices, options, cache, h5_path)
+    if full_output:
+        return params, info
+    return params
+
+
+def cached_fit_gaussian_log_iterative(cross_section, indices=None, cache=None,
+                                      h5_path=None, **kwargs):
+    """A cached version of fitting_routines.fit_gaussian_log_iterative().
+
+    Args:
+        cross_section (np.ndarray): The cross section to fit.
+        indices (np.ndarray, optional): (Default = None) The indices (i.e.
+            x-values) of the cross section.
+        cache (FitCache, optional): (Default = None) The in-memory cache. If
+            None, default_fit_cache is used.
+        h5_path (str, optional): (Default = None) The path of a shot file to
+            also cache the result in.
+        **kwargs: Additional keyword arguments are passed on to
+            fit_gaussian_log_iterative() and are part of the cache key.
+
+    Returns:
+        (tuple of floats): a tuple of the three fitted parameters
+            (center, sigma, amplitude), as from fit_gaussian_log_iterative().
+    """
+    params, _ = memoize_fit(
+        'fit_gaussian_log_iterative',
+        lambda: fit_gaussian_log_iterative(cross_section, indices, **kwargs),
+        cross_section, indices, kwargs, cache, h5_path,
+    )
+    return tuple(float(value) for value in params)
+
+
+def cached_fitgaussian(data, cache=None, h5_path=None):
+    """A cached version of labrad_fitting_routines.fitgaussian().
+
+    Unlike fitgaussian(), this doesn't replace nan and inf values in data in
+    place.
+
+    Args:
+        data (np.ndarray): The 2D image to fit.
+        cache (FitCache, optional): (Default = None) The in-memory cache. If
+            None, default_fit_cache is used.
+        h5_path (str, optional): (Default = None) The path of a shot file to
+            also cache the result in.
+
+    Returns:
+        (np.ndarray): The fitted parameters
+            (offset, height, x, y, width_x, width_y), as from fitgaussian().
+    """
+    # Import here since the labrad fitting routines aren't needed for the 1D
+    # fits.
+    from analysislib.Rydberg.analysis_utils.labrad_fitting_routines import (
+        fitgaussian,
+    )
+    params, _ = memoize_fit(
+        'fitgaussian', lambda: fitgaussian(np.array(data, dtype=float)),
+        data, None, None, cache, h5_path,
+    )
+    return params
@@ -1,3 +1,5 @@
+import math
+
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.optimize
@@ -188,38 +190,30 @@ def fit_gaussian_log_iterative(cross_section, indices=None,
     log_positive_data = np.log(positive_data)
     positive_indices = indices[keep_indices].astype(float)
 
+    # The matrix elements from equation 16 of the paper are sums of
+    # positive_indices**(j + k) weighted by fitted_values**2, where j + k runs
+    # from 0 to 4. Those powers don't change between iterations, so compute
+    # them once here.
+    powers = _index_powers(positive_indices)
+
     # Start the iterative fitting
     fitted_values = positive_data  # Use data for first iteration
     previous_sigma = 0.  # Initialize
     keep_iterating = True
     n_iterations = 0  # Keep track of number of iterations
     while keep_iterating:
-        # Make the matrix from equation 16 of the paper
-        def matrix_element_func(j, k): return (
-            positive_indices**(j + k) * fitted_values**2).sum()
-        left_matrix = [[matrix_element_func(j, k)
-                        for j in range(3)] for k in range(3)]
-        left_matrix = np.array(left_matrix)
-
-        # Make the vector from the right side of equation 16 of the paper
-        def vector_element_func(j): return (
-            positive_indices**j *
-            fitted_values**2 *
-            log_positive_data).sum()
-        right_vector = [vector_element_func(j) for j in range(3)]
-        right_vector = np.array(right_vector)
+        # Make the matrix and vector from equation 16 of the paper
+        weights = fitted_values**2
+        moments = powers @ weights
+        left_matrix = moments[_MOMENT_MATRIX_INDICES]
+        right_vector = powers[:3] @ (weights * log_positive_data)
 
         # Now solve the matrix equation and convert the fitted parabola
         # parameters into parameters of gaussian
         a, b, c = np.linalg.solve(left_matrix, right_vector)
 
         # Update fitted values
-        fitted_values = np.exp(
-            a +
-            b *
-            positive_indices +
-            c *
-            positive_indices**2)
+        fitted_values = np.exp(powers[:3].T @ (a, b, c))
 
         # Calculate sigma from the fit parameters to check convergence.
         if c < 0:
@@ -244,23 +238,157 @@ def fit_gaussian_log_iterative(cross_section, indices=None,
         if n_iterations < min_iterations:
             keep_iterating = True
 
-    # Convert the fitted parabola parameters into parameters of the gaussian
-    if c < 0:
-        center = -b / (2 * c)
-        sigma = np.sqrt(-1 / (2 * c))
-        amplitude = np.exp(a - b**2 / (4 * c))
-    else:
-        # Set values to np.nan if c > 0 (which would give imaginary sigma, which
-        # is a sign that the fit didn't converge)
-        center, sigma, amplitude = np.nan, np.nan, np.nan
+    return _parabola_to_gaussian(a, b, c)
+
+
+# Indices into the array of moments [S0, S1, S2, S3, S4], where Sn is the
+# weighted sum of x**n, which build the matrix from equation 16 of Guo's paper,
+# i.e. left_matrix[j, k] = S(j + k).
+_MOMENT_MATRIX_INDICES = np.add.outer(np.arange(3), np.arange(3))
 
+
+def _index_powers(indices):
+    """Calculate indices**n for n = 0, 1, ..., 4, stacked along the first axis."""
+    return indices[np.newaxis, :] ** np.arange(5)[:, np.newaxis]
+
+
+def _parabola_to_gaussian(a, b, c):
+    """Convert the fitted parabola a + b*x + c*x**2 into gaussian parameters.
+
+    Works for scalars as well as arrays of parameters. Values are set to np.nan
+    where c >= 0 (which would give imaginary sigma, which is a sign that the fit
+    didn't converge).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = c < 0
+        center = np.where(valid, -b / (2 * c), np.nan)
+        sigma = np.where(valid, np.sqrt(-1 / (2 * c)), np.nan)
+        amplitude = np.where(valid, np.exp(a - b**2 / (4 * c)), np.nan)
+    if np.ndim(center) == 0:
+        return float(center), float(sigma), float(amplitude)
     return center, sigma, amplitude
 
 
+def fit_gaussian_log_iterative_batch(cross_sections, indices=None,
+                                     min_iterations=10, max_iterations=100,
+                                     sigma_tolerance=1e-4):
+    """Fit guassians (no offset) to many cross sections at once.
+
+    This does the same fit as fit_gaussian_log_iterative(), but for a 2D array
+    of cross sections with the same length and shared indices. The iterations
+    for all of the cross sections are done together with array operations, and
+    each cross section stops being updated once it has converged, so the
+    results are the same as calling fit_gaussian_log_iterative() on each row.
+
+    Data points with negative values are ignored by giving them zero weight.
+    Rather than raising a numpy.linalg.LinAlgError for cross sections where the
+    matrix equation is singular, their fitted parameters are set to np.nan.
+
+    Args:
+        cross_sections (np.ndarray): A 2D array where each row is the
+            integrated cross section of one atomic cloud.
+        indices (np.ndarray, optional): (Default = None) The indices (i.e.
+            x-values) corresponding to the columns of cross_sections. If None,
+            they will be assumed to be [0, 1, ..., cross_sections.shape[1]].
+        min_iterations (int, optional): (Default = 10) The minimum number of
+            fitting iterations to perform.
+        max_iterations (int, optional): (Default = 100) The maximum number of
+            fitting iterations to perform.
+        sigma_tolerance (float, optional): (Default = 1e-4) A parameter to
+            decide when the fit has converged. See fit_gaussian_log_iterative()
+            for more information.
+
+    Returns:
+        (tuple of np.ndarray): a tuple of arrays of the three fitted parameters
+            (centers, sigmas, amplitudes), each with one entry per row of
+            cross_sections.
+    """
+    cross_sections = np.asarray(cross_sections, dtype=float)
+    n_profiles, n_points = cross_sections.shape
+    if indices is None:
+        indices = np.arange(n_points)
+    powers = _index_powers(np.asarray(indices, dtype=float))
+
+    # Data points with non-positive values are given zero weight below, and a
+    # placeholder value for their logarithm that then doesn't contribute.
+    keep_indices = cross_sections > 0
+    log_data = np.log(np.where(keep_indices, cross_sections, 1.))
+    fitted_values = cross_sections.copy()
+
+    parabola_params = np.full((n_profiles, 3), np.nan)
+    previous_sigma = np.zeros(n_profiles)
+    active = np.ones(n_profiles, dtype=bool)
+    n_iterations = 0
+    while active.any():
+        rows = np.flatnonzero(active)
+
+        # Make the matrices and vectors from equation 16 of the paper for all
+        # of the cross sections that are still being fitted.
+        weights = np.where(keep_indices[rows], fitted_values[rows]**2, 0.)
+        moments = weights @ powers.T
+        left_matrices = moments[:, _MOMENT_MATRIX_INDICES]
+        right_vectors = (weights * log_data[rows]) @ powers[:3].T
+        solutions, singular = _solve_batch(left_matrices, right_vectors)
+        parabola_params[rows] = solutions
+
+        # Update fitted values. Values for singular rows are irrelevant since
+        # those rows stop iterating below.
+        fitted_values[rows] = np.exp(solutions @ powers[:3])
+
+        # Calculate sigma from the fit parameters to check convergence,
+        # setting it to zero rather than using complex numbers.
+        c = solutions[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sigma = np.where(c < 0, np.sqrt(-1 / (2 * c)), 0.)
+            delta_sigma = np.abs(sigma - previous_sigma[rows]) / \
+                previous_sigma[rows]
+        converged = (sigma > 0) & (previous_sigma[rows] > 0) & \
+            (delta_sigma < sigma_tolerance)
+        previous_sigma[rows] = sigma
+
+        n_iterations += 1
+        if n_iterations >= max_iterations:
+            break
+        if n_iterations >= min_iterations:
+            active[rows[converged]] = False
+        active[rows[singular]] = False
+
+    return _parabola_to_gaussian(*parabola_params.T)
+
+
+def _solve_batch(matrices, vectors):
+    """Solve a stack of small matrix equations, flagging singular ones.
+
+    Returns:
+        solutions (np.ndarray): The solutions, with np.nan for singular
+            equations.
+        singular (np.ndarray): Boolean array marking the singular equations.
+    """
+    # Solve for a stack of vectors, or a stack of matrices when inverting.
+    if vectors.ndim == matrices.ndim - 1:
+        solve = lambda a, b: np.linalg.solve(a, b[..., np.newaxis])[..., 0]
+    else:
+        solve = np.linalg.solve
+    try:
+        return solve(matrices, vectors), np.zeros(len(matrices), dtype=bool)
+    except np.linalg.LinAlgError:
+        pass
+    # At least one matrix is singular, so solve them individually.
+    solutions = np.full(vectors.shape, np.nan)
+    singular = np.zeros(len(matrices), dtype=bool)
+    for i, (matrix, vector) in enumerate(zip(matrices, vectors)):
+        try:
+            solutions[i] = solve(matrix[np.newaxis], vector[np.newaxis])[0]
+        except np.linalg.LinAlgError:
+            singular[i] = True
+    return solutions, singular
+
+
 
 def fit_gaussian_with_offset(cross_section, indices=None,
                              fit_gaussian_log_iterative_args_dict={},
-                             curve_fit_args_dict={}):
+                             curve_fit_args_dict={}, initial_guesses=None,
+                             full_output=False):
     """Fit a guassian (with offset) to the data in cross_section.
 
     This function uses this module's fit_gaussian_log_iterative() to get intial
@@ -284,10 +412,23 @@ def fit_gaussian_with_offset(cross_section, indices=None,
         curve_fit_args_dict (dict): (Default = {}) Additional keyword arguments
             can be passed on to curve_fit() by including them as entries in this
             dictionary.
+        initial_guesses (array-like, optional): (Default = None) Initial guesses
+            for (center, sigma, amplitude, offset) to warm start the fit, e.g.
+            the fitted parameters from the previous shot of a scan. They are
+            only used if they pass a quick sanity check (see
+            _check_gaussian_params()). If they don't, or the fit starting from
+            them fails or gives unreasonable parameters, the fit is redone
+            starting from the usual guesses estimated from the data.
+        full_output (bool, optional): (Default = False) If True, also return a
+            dictionary with information about the fit.
 
     Returns:
         (tuple of floats): a tuple of the four fitted parameters
             (center, sigma, amplitude, offset)
+        info (dict): Only returned if full_output is True. It has the keys
+            'nfev', the total number of function evaluations, and
+            'warm_started', which is True if the fit that was returned started
+            from initial_guesses.
     """
     # Creates indices if necessary
     if indices is None:
@@ -304,22 +445,318 @@ def fit_gaussian_with_offset(cross_section, indices=None,
     log_positive_data = abs(np.log(positive_data))
     positive_indices = indices[keep_indices].astype(float)
 
-    smoothed_data = gaussian_filter1d(log_positive_data, sigma=1, mode='nearest')
-    center_guess = positive_indices[np.argmax(abs(smoothed_data))]
-    offset_guess = np.min(smoothed_data)
-    amplitude_guess = np.max(smoothed_data) - offset_guess
-    sigma_guess = abs(center_guess - positive_indices[find_nearest(smoothed_data, amplitude_guess/np.e)])
-
-    # Get initial parameter guesses (center, sigma, amplitude)
-    initial_guesses = [center_guess, sigma_guess, amplitude_guess, offset_guess]
-
-    # Do nonlinear fit least-squares optimization.
-    fitted_parameters, _ = scipy.optimize.curve_fit(
-        gaussian_with_offset, positive_indices, log_positive_data, p0=initial_guesses,
-        jac=gaussian_with_offset_jacobian, **curve_fit_args_dict)
+    def get_heuristic_guesses():
+        # Only called when needed, since it isn't necessary when warm starting.
+        smoothed_data = gaussian_filter1d(log_positive_data, sigma=1, mode='nearest')
+        center_guess = positive_indices[np.argmax(abs(smoothed_data))]
+        offset_guess = np.min(smoothed_data)
+        amplitude_guess = np.max(smoothed_data) - offset_guess
+        sigma_guess = abs(center_guess - positive_indices[find_nearest(smoothed_data, amplitude_guess/np.e)])
+
+        # Get initial parameter guesses (center, sigma, amplitude)
+        return [center_guess, sigma_guess, amplitude_guess, offset_guess]
+
+    def do_fit(p0):
+        # Do nonlinear fit least-squares optimization.
+        fitted_parameters, _, info, _, _ = scipy.optimize.curve_fit(
+            gaussian_with_offset, positive_indices, log_positive_data, p0=p0,
+            jac=gaussian_with_offset_jacobian, full_output=True,
+            **curve_fit_args_dict)
+        return fitted_parameters, info['nfev']
+
+    # Try a warm start from the provided guesses first, and fall back to the
+    # heuristic guesses if the fit from them diverges.
+    nfev = 0
+    fitted_parameters = None
+    warm_started = False
+    if initial_guesses is not None:
+        warm_guesses = np.array(initial_guesses, dtype=float)
+        warm_guesses[1] = abs(warm_guesses[1])
+        if _check_gaussian_params(warm_guesses, positive_indices):
+            try:
+                fitted_parameters, warm_nfev = do_fit(warm_guesses)
+                nfev += warm_nfev
+                warm_started = _check_gaussian_params(
+                    fitted_parameters, positive_indices)
+            except RuntimeError:
+                pass
+    if not warm_started:
+        fitted_parameters, heuristic_nfev = do_fit(get_heuristic_guesses())
+        nfev += heuristic_nfev
 
     # plt.figure()
     # plt.scatter(positive_indices, log_positive_data)
     # xpoints = np.linspace(np.min(positive_indices), np.max(positive_indices), 1000)
     # plt.plot(xpoints, gaussian_with_offset(xpoints, *fitted_parameters))
+    if full_output:
+        return fitted_parameters, {'nfev': nfev, 'warm_started': warm_started}
     return fitted_parameters
+
+
+def _check_gaussian_params(params, indices):
+    """Check that gaussian parameters are reasonable for a cross section.
+
+    This is used to decide whether to trust parameters used to warm start a fit,
+    and the results of that fit. The parameters must all be finite, the center
+    must be within the range of indices, and sigma must be nonzero and no larger
+    than that range.
+    """
+    center, sigma, amplitude, offset = params
+    if not np.all(np.isfinite(params)) or len(indices) < 2:
+        return False
+    low, high = np.min(indices), np.max(indices)
+    return bool((low <= center <= high) and (0 < abs(sigma) <= high - low))
+
+
+def _guess_gaussian_with_offset_batch(data, indices):
+    """Make initial guesses for fit_gaussian_with_offset_batch().
+
+    The guesses are made in the same way as in fit_gaussian_with_offset(), but
+    for every row of data at once.
+    """
+    smoothed_data = gaussian_filter1d(data, sigma=1, mode='nearest', axis=1)
+    rows = np.arange(len(data))
+    center_guess = indices[np.argmax(np.abs(smoothed_data), axis=1)]
+    offset_guess = np.min(smoothed_data, axis=1)
+    amplitude_guess = np.max(smoothed_data, axis=1) - offset_guess
+    nearest = np.argmin(
+        np.abs(smoothed_data - (amplitude_guess / np.e)[:, np.newaxis]), axis=1)
+    sigma_guess = np.abs(center_guess - indices[nearest])
+    # A sigma of zero would make the jacobian singular, so use the grid spacing
+    # instead in that case.
+    spacing = np.abs(np.diff(indices)).min() if len(indices) > 1 else 1.
+    sigma_guess = np.where(sigma_guess > 0, sigma_guess, spacing)
+    return np.stack(
+        [center_guess, sigma_guess, amplitude_guess, offset_guess], axis=1)
+
+
+def fit_gaussian_with_offset_batch(cross_sections, indices=None,
+                                   initial_guesses=None, log_transform=True,
+                                   max_iterations=100, ftol=1e-8, xtol=1e-8):
+    """Fit gaussians (with offset) to many cross sections at once.
+
+    This fits the same model as fit_gaussian_with_offset(), but rather than
+    calling scipy's curve_fit() once per cross section, it runs
+    Levenberg-Marquardt iterations on all of the cross sections together with
+    array operations, using gaussian_with_offset_jacobian() for the
+    derivatives. Each cross section has its own damping parameter and stops
+    being updated once it has converged, so the cross sections don't affect
+    each other's fits.
+
+    By default the data is transformed in the same way as in
+    fit_gaussian_with_offset(), i.e. abs(np.log(data)) is fitted and data points
+    with non-positive values are ignored (by giving them zero weight).
+
+    Args:
+        cross_sections (np.ndarray): A 2D array where each row is the
+            integrated cross section of one atomic cloud, e.g. one row per
+            shot.
+        indices (np.ndarray, optional): (Default = None) The indices (i.e.
+            x-values) corresponding to the columns of cross_sections. If None,
+            they will be assumed to be [0, 1, ..., cross_sections.shape[1]].
+        initial_guesses (np.ndarray, optional): (Default = None) An array with
+            shape (n_profiles, 4) giving the initial guesses for
+            (center, sigma, amplitude, offset) for each cross section. If None,
+            they are guessed in the same way as in fit_gaussian_with_offset().
+        log_transform (bool, optional): (Default = True) If True, fit
+            abs(np.log(cross_sections)) as fit_gaussian_with_offset() does. If
+            False, fit cross_sections directly, using all data points.
+        max_iterations (int, optional): (Default = 100) The maximum number of
+            iterations to perform.
+        ftol (float, optional): (Default = 1e-8) A fit has converged when the
+            relative reduction in its sum of squared residuals from an accepted
+            step is less than this.
+        xtol (float, optional): (Default = 1e-8) A fit has also converged when
+            every parameter changes by less than this, relative to its value.
+
+    Returns:
+        parameters (np.ndarray): An array with shape (n_profiles, 4) giving the
+            fitted (center, sigma, amplitude, offset) for each cross section.
+        covariances (np.ndarray): An array with shape (n_profiles, 4, 4) giving
+            the estimated covariance matrix of the fitted parameters for each
+            cross section, scaled by the reduced chi squared as curve_fit() does
+            by default. Entries are np.inf if it couldn't be estimated.
+        converged (np.ndarray): A boolean array which is True for the cross
+            sections whose fits converged within max_iterations.
+    """
+    cross_sections = np.asarray(cross_sections, dtype=float)
+    n_profiles, n_points = cross_sections.shape
+    if indices is None:
+        indices = np.arange(n_points)
+    indices = np.asarray(indices, dtype=float)
+
+    # Transform the data and set the weights of the data points to ignore to
+    # zero.
+    if log_transform:
+        weights = (cross_sections > 0).astype(float)
+        data = np.abs(np.log(np.where(weights > 0, cross_sections, 1.)))
+    else:
+        weights = np.isfinite(cross_sections).astype(float)
+        data = np.where(weights > 0, cross_sections, 0.)
+
+    if initial_guesses is None:
+        parameters = _guess_gaussian_with_offset_batch(data, indices)
+    else:
+        parameters = np.array(initial_guesses, dtype=float).reshape(
+            n_profiles, 4)
+
+    def residuals(rows, params):
+        model = gaussian_with_offset(indices, *params.T[:, :, np.newaxis])
+        return (data[rows] - model) * weights[rows]
+
+    def jacobian(rows, params):
+        x = np.broadcast_to(indices, (len(rows), n_points))
+        # gaussian_with_offset_jacobian() returns shape (n_points, rows, 4) for
+        # 2D x, so move the rows to the front.
+        jac = gaussian_with_offset_jacobian(x, *params.T[:, :, np.newaxis])
+        return jac.transpose(1, 0, 2) * weights[rows, :, np.newaxis]
+
+    all_rows = np.arange(n_profiles)
+    cost = np.sum(residuals(all_rows, parameters)**2, axis=1)
+    damping = np.full(n_profiles, 1e-3)
+    converged = np.zeros(n_profiles, dtype=bool)
+    failed = ~np.isfinite(cost)
+    for _ in range(max_iterations):
+        rows = np.flatnonzero(~converged & ~failed)
+        if len(rows) == 0:
+            break
+        params = parameters[rows]
+
+        # Solve the damped normal equations for the step of each fit.
+        jac = jacobian(rows, params)
+        res = residuals(rows, params)
+        jtj = np.einsum('rni,rnj->rij', jac, jac)
+        gradient = np.einsum('rni,rn->ri', jac, res)
+        diagonal = np.einsum('rii->ri', jtj)
+        damped = jtj + (damping[rows, np.newaxis] * diagonal)[:, :, np.newaxis] \
+            * np.eye(4)
+        step, singular = _solve_batch(damped, gradient)
+        failed[rows[singular]] = True
+
+        # Accept steps which reduce the cost, and decrease the damping for
+        # those fits. Otherwise increase the damping and try again next time.
+        new_params = params + np.nan_to_num(step)
+        new_cost = np.sum(residuals(rows, new_params)**2, axis=1)
+        accepted = (new_cost <= cost[rows]) & ~singular
+        accepted_rows = rows[accepted]
+        parameters[accepted_rows] = new_params[accepted]
+        damping[accepted_rows] /= 10.
+        damping[rows[~accepted]] *= 10.
+
+        # Check for convergence.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cost_change = (cost[rows] - new_cost) / cost[rows]
+        small_cost_change = accepted & (np.abs(cost_change) < ftol)
+        small_step = np.all(
+            np.abs(step) <= xtol * (np.abs(params) + xtol), axis=1)
+        converged[rows[small_cost_change | small_step]] = True
+        cost[accepted_rows] = new_cost[accepted]
+
+    # Estimate the covariances the same way as curve_fit(), i.e. from the
+    # inverse of J^T J scaled by the reduced chi squared.
+    jac = jacobian(all_rows, parameters)
+    jtj = np.einsum('rni,rnj->rij', jac, jac)
+    covariances = np.full((n_profiles, 4, 4), np.inf)
+    dof = weights.sum(axis=1) - 4
+    rows = np.flatnonzero(~failed & (dof > 0))
+    inverses, singular = _solve_batch(
+        jtj[rows], np.broadcast_to(np.eye(4), (len(rows), 4, 4)))
+    covariances[rows[~singular]] = inverses[~singular] * \
+        (cost[rows] / dof[rows])[~singular, np.newaxis, np.newaxis]
+    return parameters, covariances, converged & ~failed
+
+
+def estimate_gaussian_with_offset(cross_section, indices=None,
+                                  threshold_fraction=0.2, edge_fraction=0.1):
+    """Estimate gaussian (with offset) parameters from moments, without fitting.
+
+    This is a fast, closed-form alternative to fit_gaussian_with_offset(), e.g.
+    for live feedback. It works on the same transformed data, i.e.
+    abs(np.log(cross_section)) for the positive data points, and returns the
+    parameters in the same format. The estimate is made as follows:
+
+    * The offset is taken to be the median of the data points in the outer
+      edge_fraction of the cross section on each side, and is subtracted.
+    * Only the contiguous region around the peak (of the lightly smoothed data)
+      where the data is above threshold_fraction times the peak is kept, which
+      stops noise far from the cloud from biasing the moments.
+    * The center and sigma are calculated from the first and second moments of
+      that region, and the amplitude from its integrated area.
+    * The sigma and amplitude are then corrected for the part of the gaussian
+      that was cut off by the threshold, so that the estimates are unbiased for
+      a gaussian profile.
+
+    Args:
+        cross_section (np.ndarray): A 1D array giving the integrated cross
+            section of the atomic cloud.
+        indices (np.ndarray, optional): (Default = None) The indices (i.e.
+            x-values) corresponding to the data in cross_section. If indices is
+            None, then it will be assumed to be [0, 1, ..., len(cross_section)].
+        threshold_fraction (float, optional): (Default = 0.2) The fraction of
+            the peak height below which data points are excluded from the
+            moments. Must be between 0 and 1.
+        edge_fraction (float, optional): (Default = 0.1) The fraction of the
+            data points on each side of the cross section used to estimate the
+            offset.
+
+    Returns:
+        (tuple of floats): a tuple of the four estimated parameters
+            (center, sigma, amplitude, offset). They are all np.nan if no peak
+            above the offset is found.
+    """
+    # Creates indices if necessary
+    if indices is None:
+        indices = np.arange(len(cross_section))
+
+    # Take only the data points with positive values, and transform them in the
+    # same way as in fit_gaussian_with_offset().
+    keep_indices = (cross_section > 0)  # Array of booleans
+    log_positive_data = abs(np.log(cross_section[keep_indices].astype(float)))
+    positive_indices = indices[keep_indices].astype(float)
+    n_points = len(log_positive_data)
+    if n_points < 3:
+        return np.nan, np.nan, np.nan, np.nan
+
+    # Estimate and subtract the offset using the edges of the cross section.
+    n_edge = max(1, int(edge_fraction * n_points))
+    offset = np.median(
+        np.concatenate([log_positive_data[:n_edge], log_positive_data[-n_edge:]]))
+    signal = log_positive_data - offset
+
+    # Find the contiguous region around the peak which is above the threshold.
+    smoothed_signal = gaussian_filter1d(signal, sigma=1, mode='nearest')
+    peak_index = np.argmax(smoothed_signal)
+    peak_value = smoothed_signal[peak_index]
+    if not peak_value > 0:
+        return np.nan, np.nan, np.nan, np.nan
+    below_threshold = smoothed_signal < threshold_fraction * peak_value
+    left_below = np.flatnonzero(below_threshold[:peak_index])
+    right_below = np.flatnonzero(below_threshold[peak_index:])
+    start = left_below[-1] + 1 if len(left_below) else 0
+    stop = peak_index + right_below[0] if len(right_below) else n_points
+    region_signal = signal[start:stop]
+    region_indices = positive_indices[start:stop]
+
+    # Calculate the moments of the region.
+    total = region_signal.sum()
+    if not total > 0:
+        return np.nan, np.nan, np.nan, np.nan
+    center = (region_indices * region_signal).sum() / total
+    variance = ((region_indices - center)**2 * region_signal).sum() / total
+    spacing = np.median(np.diff(positive_indices)) if n_points > 1 else 1.
+    area = total * spacing
+
+    # Correct for the tails of the gaussian cut off by the threshold. A gaussian
+    # drops to threshold_fraction of its peak at cutoff sigmas from its center,
+    # and the truncated gaussian has a smaller variance and area.
+    if 0 < threshold_fraction < 1:
+        cutoff = np.sqrt(-2 * np.log(threshold_fraction))
+        area_fraction = math.erf(cutoff / np.sqrt(2))
+        variance_fraction = 1 - 2 * cutoff * np.exp(-cutoff**2 / 2) / \
+            (np.sqrt(2 * np.pi) * area_fraction)
+    else:
+        area_fraction = 1.
+        variance_fraction = 1.
+    sigma = np.sqrt(variance / variance_fraction)
+    amplitude = area / (np.sqrt(2 * np.pi) * sigma * area_fraction)
+    return center, sigma, amplitude, offset
@@ -0,0 +1,346 @@
+"""Functions for making and browsing small multi-resolution copies of images.
+
+Looking through many shots' images to find outliers is slow when each full frame
+has to be read from its file and drawn. The functions here write an image
+pyramid for image results, i.e. copies of the image downsampled by averaging
+over 2x2, 4x4, and 8x8 blocks of pixels, stored with a lossy encoding in the
+'image_pyramids' group of the shot file. The 8x level of a 1 megapixel image is
+only about 16 kB of float16, so the levels can be read quickly.
+
+The viewer functions read the lowest resolution level that still fills the
+requested display size, read the levels of many shots in parallel, and tile them
+into one contact sheet that is drawn with a single imshow().
+
+The pyramids are only meant for browsing shots offline, so they aren't written
+while analyzing shots by default. Write them in a separate pass, e.g. from a
+script run over the shots to browse, with write_shot_pyramids().
+
+Example Usage:
+```
+# After the processed images are saved, e.g. in a separate script:
+for h5_path in df['filepath']:
+    write_shot_pyramids(h5_path)
+
+# In a multishot script or interactively:
+plot_contact_sheet(df['filepath'], 'processed_image', thumbnail_shape=(64, 64))
+```
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import labscript_utils.h5_lock
+import h5py
+import matplotlib.pyplot as plt
+import numpy as np
+
+from analysislib.Rydberg.analysis_utils.image_storage import (
+    block_mean,
+    read_image_dataset,
+    write_image_dataset,
+)
+
+PYRAMID_GROUP = 'image_pyramids'
+PYRAMID_FACTORS = (2, 4, 8)
+# The encodings which can be used for the pyramid levels. 'uint8' uses the
+# quantized encoding from the image_storage module with 8 bits.
+PYRAMID_ENCODINGS = ('float16', 'uint8')
+DEFAULT_MAX_WORKERS = 8
+
+
+def build_pyramid(image, factors=PYRAMID_FACTORS):
+    """Calculate the downsampled levels of an image pyramid.
+
+    Each level is calculated from the previous one where possible, which is
+    cheaper than downsampling the full image each time and gives the same
+    result.
+
+    Args:
+        image (np.ndarray): The 2D image.
+        factors (list of ints, optional): (Default = PYRAMID_FACTORS) The
+            downsampling factors of the levels, in increasing order.
+
+    Returns:
+        levels (dict): A dictionary mapping each factor to the downsampled
+            image.
+    """
+    levels = {}
+    previous_factor = 1
+    previous_level = np.asarray(image, dtype=float)
+    for factor in sorted(factors):
+        if factor % previous_factor == 0:
+            level = block_mean(previous_level, factor // previous_factor)
+        else:
+            level = block_mean(np.asarray(image, dtype=float), factor)
+        levels[factor] = level
+        previous_factor, previous_level = factor, level
+    return levels
+
+
+def write_pyramid(h5_group, name, image, factors=PYRAMID_FACTORS,
+                  encoding='float16'):
+    """Write an image pyramid into h5_group[name].
+
+    Each level is saved as a dataset named after its factor, e.g. '4', with
+    image_storage.write_image_dataset().
+
+    Args:
+        h5_group (h5py.Group): The group in which to create the pyramid's group,
+            typically the PYRAMID_GROUP group of a shot file.
+        name (str): The name of the pyramid's group, typically the name of the
+            image result.
+        image (np.ndarray): The full resolution 2D image.
+        factors (list of ints, optional): (Default = PYRAMID_FACTORS) The
+            downsampling factors of the levels.
+        encoding (str, optional): (Default = 'float16') The encoding of the
+            levels, one of PYRAMID_ENCODINGS.
+
+    Raises:
+        ValueError: If encoding isn't one of PYRAMID_ENCODINGS.
+    """
+    if encoding not in PYRAMID_ENCODINGS:
+        message = (f"encoding must be one of {PYRAMID_ENCODINGS} but is "
+                   f"{encoding}.")
+        raise ValueError(message)
+    if encoding == 'float16':
+        write_kwargs = {'lossy': 'float16'}
+    else:
+        write_kwargs = {'lossy': 'quantized', 'quantization_bits': 8}
+
+    if name in h5_group:
+        del h5_group[name]
+    pyramid_group = h5_group.create_group(name)
+    pyramid_group.attrs['full_shape'] = np.asarray(image).shape
+    for factor, level in build_pyramid(image, factors).items():
+        write_image_dataset(pyramid_group, str(factor), level, **write_kwargs)
+
+
+def write_shot_pyramids(h5_path, result_names=None,
+                        results_group='shot_results', factors=PYRAMID_FACTORS,
+                        encoding='float16'):
+    """Write image pyramids for the image results of a shot.
+
+    Args:
+        h5_path (str): The path to the shot's hdf5 file.
+        result_names (list of str, optional): (Default = None) The names of the
+            image results to make pyramids of. If None, pyramids are made for
+            all of the 2D array results in results_group.
+        results_group (str, optional): (Default = 'shot_results') The results
+            group with the image results. As with lyse.Run, it's stored in
+            'results/<results_group>' in the hdf5 file.
+        factors (list of ints, optional): (Default = PYRAMID_FACTORS) The
+            downsampling factors of the levels.
+        encoding (str, optional): (Default = 'float16') The encoding of the
+            levels, one of PYRAMID_ENCODINGS.
+    """
+    with h5py.File(h5_path, 'a') as h5_file:
+        group = h5_file['results'][results_group]
+        if result_names is None:
+            result_names = [
+                name for name, dataset in group.items()
+                if isinstance(dataset, h5py.Dataset) and dataset.ndim == 2
+            ]
+        pyramid_group = h5_file.require_group(PYRAMID_GROUP)
+        for name in result_names:
+            image = read_image_dataset(group[name])
+            write_pyramid(pyramid_group, name, image, factors, encoding)
+
+
+def choose_factor(full_shape, available_factors, max_shape):
+    """Pick the pyramid level with the least data that still fills max_shape.
+
+    That is the level with the largest factor whose image is at least as large
+    as max_shape in one dimension, so that no detail visible at the display size
+    is lost. If even the full resolution image is smaller than max_shape, then
+    the full resolution image (factor 1) is chosen.
+
+    Args:
+        full_shape (tuple of ints): The shape of the full resolution image.
+        available_factors (list of ints): The factors of the pyramid levels.
+        max_shape (tuple of ints): The shape, in pixels, at which the image will
+            be displayed.
+
+    Returns:
+        factor (int): The chosen factor, or 1 for the full resolution image.
+    """
+    chosen_factor = 1
+    for factor in sorted(available_factors):
+        level_shape = (full_shape[0] // factor, full_shape[1] // factor)
+        if level_shape[0] >= max_shape[0] or level_shape[1] >= max_shape[1]:
+            chosen_factor = factor
+    return chosen_factor
+
+
+def read_thumbnail(h5_path, name, max_shape=(64, 64),
+                   results_group='shot_results'):
+    """Read the smallest pyramid level of an image which fills max_shape.
+
+    If the shot has no pyramid for the image, the full resolution image is read
+    from results_group and downsampled instead, which is slower.
+
+    Args:
+        h5_path (str): The path to the shot's hdf5 file.
+        name (str): The name of the image result, e.g. 'processed_image'.
+        max_shape (tuple of ints, optional): (Default = (64, 64)) The shape, in
+            pixels, at which the image will be displayed.
+        results_group (str, optional): (Default = 'shot_results') The results
+            group with the full resolution image, used if there is no pyramid.
+            As with lyse.Run, it's stored in 'results/<results_group>' in the
+            hdf5 file.
+
+    Returns:
+        thumbnail (np.ndarray): The downsampled image.
+        factor (int): The downsampling factor of the thumbnail.
+    """
+    with h5py.File(h5_path, 'r') as h5_file:
+        if PYRAMID_GROUP in h5_file and name in h5_file[PYRAMID_GROUP]:
+            pyramid_group = h5_file[PYRAMID_GROUP][name]
+            full_shape = tuple(pyramid_group.attrs['full_shape'])
+            available_factors = [int(key) for key in pyramid_group.keys()]
+            factor = choose_factor(full_shape, available_factors, max_shape)
+            if factor > 1:
+                return read_image_dataset(pyramid_group[str(factor)]), factor
+        image = read_image_dataset(h5_file['results'][results_group][name])
+    factor = choose_factor(image.shape, PYRAMID_FACTORS, max_shape)
+    return block_mean(np.asarray(image, dtype=float), factor), factor
+
+
+def load_thumbnails(shot_paths, name, max_shape=(64, 64),
+                    max_workers=DEFAULT_MAX_WORKERS):
+    """Read thumbnails of an image result for many shots in parallel.
+
+    Shots which don't have the image, or whose files can't be read, get None.
+
+    Args:
+        shot_paths (iterable of str): The paths to the shots' hdf5 files.
+        name (str): The name of the image result, e.g. 'processed_image'.
+        max_shape (tuple of ints, optional): (Default = (64, 64)) The shape, in
+            pixels, at which each thumbnail will be displayed.
+        max_workers (int, optional): (Default = DEFAULT_MAX_WORKERS) The maximum
+            number of threads used to read the files.
+
+    Returns:
+        thumbnails (list of np.ndarray or None): The thumbnails, in the same
+            order as shot_paths.
+    """
+    def read(h5_path):
+        try:
+            return read_thumbnail(h5_path, name, max_shape)[0]
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(read, shot_paths))
+
+
+def tile_images(images, n_columns=None, padding=1):
+    """Tile many small images into one contact sheet array.
+
+    Each image is placed in a cell the size of the largest image, and the cells
+    are separated by padding pixels. Empty space and missing (None) images are
+    filled with nan so that they show up as blank.
+
+    Args:
+        images (list of np.ndarray or None): The images to tile.
+        n_columns (int, optional): (Default = None) The number of columns of
+            the sheet. If None, the sheet is made roughly square.
+        padding (int, optional): (Default = 1) The number of pixels between
+            cells.
+
+    Returns:
+        sheet (np.ndarray): The contact sheet.
+        cell_origins (list of tuples of ints): The (row, column) of the top left
+            corner of each image's cell in sheet, e.g. for labeling the cells or
+            finding which shot was clicked on.
+    """
+    n_images = len(images)
+    present = [image for image in images if image is not None]
+    if n_images == 0 or not present:
+        return np.full((1, 1), np.nan), []
+    if n_columns is None:
+        n_columns = int(np.ceil(np.sqrt(n_images)))
+    n_rows = int(np.ceil(n_images / n_columns))
+    cell_height = max(image.shape[0] for image in present)
+    cell_width = max(image.shape[1] for image in present)
+
+    sheet = np.full(
+        (n_rows * (cell_height + padding) - padding,
+         n_columns * (cell_width + padding) - padding),
+        np.nan,
+    )
+    cell_origins = []
+    for index, image in enumerate(images):
+        row = (index // n_columns) * (cell_height + padding)
+        col = (index % n_columns) * (cell_width + padding)
+        cell_origins.append((row, col))
+        if image is not None:
+            sheet[row:row + image.shape[0], col:col + image.shape[1]] = image
+    return sheet, cell_origins
+
+
+def plot_contact_sheet(shot_paths, name='processed_image',
+                       thumbnail_shape=(64, 64), n_columns=None, axes=None,
+                       cmap='plasma', vmin=None, vmax=None,
+                       max_workers=DEFAULT_MAX_WORKERS):
+    """Plot thumbnails of an image result for many shots as one contact sheet.
+
+    Clicking on a thumbnail prints the path of its shot.
+
+    Args:
+        shot_paths (iterable of str): The paths to the shots' hdf5 files.
+        name (str, optional): (Default = 'processed_image') The name of the
+            image result.
+        thumbnail_shape (tuple of ints, optional): (Default = (64, 64)) The
+            approximate shape, in pixels, of each thumbnail.
+        n_columns (int, optional): (Default = None) The number of columns of
+            thumbnails. If None, the sheet is made roughly square.
+        axes (matplotlib.axes.Axes, optional): (Default = None) The axes on
+            which to plot. If None, a new figure is created.
+        cmap (str, optional): (Default = 'plasma') The colormap.
+        vmin (float, optional): (Default = None) The lower color limit. If None,
+            the 1st percentile of all of the thumbnails is used.
+        vmax (float, optional): (Default = None) The upper color limit. If None,
+            the 99th percentile of all of the thumbnails is used.
+        max_workers (int, optional): (Default = DEFAULT_MAX_WORKERS) The maximum
+            number of threads used to read the files.
+
+    Returns:
+        axes (matplotlib.axes.Axes): The axes with the contact sheet.
+    """
+    shot_paths = list(shot_paths)
+    thumbnails = load_thumbnails(
+        shot_paths, name, thumbnail_shape, max_workers=max_workers)
+    sheet, cell_origins = tile_images(thumbnails, n_columns=n_columns)
+
+    # Use robust color limits so that a few bad shots don't wash out the rest.
+    finite_values = sheet[np.isfinite(sheet)]
+    if finite_values.size > 0:
+        if vmin is None:
+            vmin = np.percentile(finite_values, 1)
+        if vmax is None:
+            vmax = np.percentile(finite_values, 99)
+
+    if axes is None:
+        fig = plt.figure()
+        axes = fig.add_subplot(111)
+    axes.imshow(sheet, cmap=plt.get_cmap(cmap), vmin=vmin, vmax=vmax,
+                interpolation='nearest')
+    axes.set_title(f"{name} ({len(shot_paths)} shots)")
+    axes.set_axis_off()
+
+    # Print the path of a shot when its thumbnail is clicked.
+    present = [image for image in thumbnails if image is not None]
+    if present:
+        cell_height = max(image.shape[0] for image in present)
+        cell_width = max(image.shape[1] for image in present)
+
+        def on_click(event):
+            if event.inaxes is not axes or event.xdata is None:
+                return
+            row, col = int(round(event.ydata)), int(round(event.xdata))
+            for index, (origin_row, origin_col) in enumerate(cell_origins):
+                if origin_row <= row < origin_row + cell_height and \
+                        origin_col <= col < origin_col + cell_width:
+                    print(shot_paths[index])
+                    return
+
+        axes.figure.canvas.mpl_connect('button_press_event', on_click)
+    return axes
@@ -0,0 +1,230 @@
+"""Functions for storing images compactly in hdf5 files.
+
+Full-frame float64 images are large, so saving one for every shot quickly
+bloats the shot files and makes transferring them slow. The functions here
+store images as chunked hdf5 datasets with the shuffle filter and a fast
+compressor (lzf by default), which is lossless and typically shrinks images a
+lot. Because the datasets are chunked, a region of interest can be read without
+reading or decompressing the whole image.
+
+For images where some loss of precision is acceptable, such as OD images, two
+lossy encodings are also available:
+
+* 'float16': The image is stored as half precision floats, which keeps about
+  three significant digits.
+* 'quantized': The finite values of the image are linearly mapped onto unsigned
+  integers with quantization_bits bits. The scale and offset needed to convert
+  back are stored as attributes of the dataset, and nan values are stored as
+  the largest integer. This keeps the precision as a fixed fraction of the range
+  of the image.
+
+The encoding is recorded in the 'encoding' attribute of the dataset, and
+read_image_dataset() uses that to decode the image automatically. Datasets
+without that attribute, e.g. ones saved with lyse.Run.save_result_array(), are
+returned unchanged, so read_image_dataset() can be used to read any array.
+
+The module also has a few numpy helpers for working with images, such as
+roi_to_slices() and block_mean(), which don't need h5py.
+"""
+import numpy as np
+
+# Default hdf5 settings for images. The lzf compressor is built into h5py and is
+# much faster than gzip while still compressing images well, especially after
+# the shuffle filter.
+IMAGE_COMPRESSION = 'lzf'
+IMAGE_CHUNK_SHAPE = (64, 64)
+ENCODINGS = (None, 'float16', 'quantized')
+
+
+def encode_image(image, lossy=None, quantization_bits=16):
+    """Convert an image into the array and attributes that will be stored.
+
+    Args:
+        image (np.ndarray): The image to encode.
+        lossy (str, optional): (Default = None) The lossy encoding to use, which
+            should be one of the values in ENCODINGS. If None, the image is
+            stored without any loss of precision.
+        quantization_bits (int, optional): (Default = 16) The number of bits
+            per pixel used when lossy is 'quantized'. Should be 8 or 16.
+
+    Raises:
+        ValueError: If lossy isn't one of the values in ENCODINGS, or if
+            quantization_bits isn't 8 or 16.
+
+    Returns:
+        stored_array (np.ndarray): The array to save to the hdf5 file.
+        attributes (dict): The attributes to save with the dataset so that it
+            can be decoded.
+    """
+    if lossy not in ENCODINGS:
+        raise ValueError(f"lossy must be one of {ENCODINGS} but is {lossy}.")
+    image = np.asarray(image)
+    if lossy is None:
+        return image, {}
+    elif lossy == 'float16':
+        return image.astype(np.float16), {'encoding': 'float16'}
+
+    # Otherwise lossy is 'quantized'.
+    if quantization_bits not in (8, 16):
+        message = ("quantization_bits must be 8 or 16 but is "
+                   f"{quantization_bits}.")
+        raise ValueError(message)
+    dtype = np.uint8 if quantization_bits == 8 else np.uint16
+    # Reserve the largest integer for nan.
+    nan_code = np.iinfo(dtype).max
+    n_levels = nan_code - 1
+    finite = np.isfinite(image)
+    if np.any(finite):
+        offset = float(image[finite].min())
+        value_range = float(image[finite].max()) - offset
+    else:
+        offset, value_range = 0., 0.
+    scale = value_range / n_levels if value_range > 0 else 1.
+    codes = np.zeros(image.shape, dtype=dtype)
+    codes[finite] = np.rint((image[finite] - offset) / scale)
+    codes[~finite] = nan_code
+    attributes = {
+        'encoding': 'quantized',
+        'scale': scale,
+        'offset': offset,
+        'nan_code': nan_code,
+    }
+    return codes, attributes
+
+
+def decode_image(stored_array, attributes):
+    """Convert a stored array back into an image.
+
+    Args:
+        stored_array (np.ndarray): The array read from the hdf5 file.
+        attributes (dict-like): The attributes of the dataset, e.g.
+            dataset.attrs.
+
+    Returns:
+        image (np.ndarray): The decoded image. Lossy encodings are converted
+            back to float64. Arrays without an 'encoding' attribute are returned
+            unchanged.
+    """
+    encoding = attributes.get('encoding', None)
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+    if encoding is None:
+        return stored_array
+    elif encoding == 'float16':
+        return stored_array.astype(np.float64)
+    elif encoding == 'quantized':
+        image = stored_array * attributes['scale'] + attributes['offset']
+        image[stored_array == attributes['nan_code']] = np.nan
+        return image
+    raise ValueError(f"Unknown image encoding {encoding}.")
+
+
+def write_image_dataset(h5_group, name, image, lossy=None,
+                        quantization_bits=16, chunks=IMAGE_CHUNK_SHAPE,
+                        compression=IMAGE_COMPRESSION, overwrite=True):
+    """Write an image to an hdf5 group as a chunked, compressed dataset.
+
+    Args:
+        h5_group (h5py.Group): The group in which to create the dataset.
+        name (str): The name of the dataset.
+        image (np.ndarray): The image to save.
+        lossy (str, optional): (Default = None) The lossy encoding to use. See
+            encode_image() for more information.
+        quantization_bits (int, optional): (Default = 16) The number of bits
+            per pixel used when lossy is 'quantized'.
+        chunks (tuple of ints, optional): (Default = IMAGE_CHUNK_SHAPE) The
+            chunk shape. It is clipped to the shape of the image. Smaller chunks
+            make reading small ROIs cheaper but compress slightly less well.
+        compression (str, optional): (Default = IMAGE_COMPRESSION) The
+            compression filter passed to h5py, e.g. 'lzf' or 'gzip'.
+        overwrite (bool, optional): (Default = True) If True, an existing
+            dataset with the same name is replaced. Otherwise h5py will raise an
+            error if the dataset already exists.
+
+    Returns:
+        dataset (h5py.Dataset): The dataset that was created.
+    """
+    stored_array, attributes = encode_image(image, lossy, quantization_bits)
+    if overwrite and name in h5_group:
+        del h5_group[name]
+
+    # Chunking and filters need at least one element in each dimension.
+    if stored_array.ndim == len(chunks) and stored_array.size > 0:
+        chunk_shape = tuple(
+            min(chunk, size) for chunk, size in zip(chunks, stored_array.shape)
+        )
+        dataset = h5_group.create_dataset(
+            name,
+            data=stored_array,
+            chunks=chunk_shape,
+            shuffle=True,
+            compression=compression,
+        )
+    else:
+        dataset = h5_group.create_dataset(name, data=stored_array)
+    for key, value in attributes.items():
+        dataset.attrs[key] = value
+    return dataset
+
+
+def roi_to_slices(roi):
+    """Convert an (x, y, width, height) ROI into (row, column) slices.
+
+    The ROI uses the same format as cv2.selectROI(), where x is the column index
+    and y is the row index of the top left corner.
+
+    Args:
+        roi (tuple of ints): The ROI as (x, y, width, height).
+
+    Returns:
+        slices (tuple of slices): The row slice and column slice, which can be
+            used to index a 2D array or an h5py dataset.
+    """
+    x, y, width, height = [int(value) for value in roi]
+    return (slice(y, y + height), slice(x, x + width))
+
+
+def block_mean(image, factor):
+    """Downsample an image by averaging over factor x factor blocks.
+
+    Any rows or columns that don't fill up a complete block at the bottom or
+    right edge of the image are dropped.
+
+    Args:
+        image (np.ndarray): The 2D image to downsample.
+        factor (int): The size of the blocks, in pixels, to average over.
+
+    Returns:
+        binned_image (np.ndarray): The downsampled image.
+    """
+    if factor <= 1:
+        return image
+    n_rows = (image.shape[0] // factor) * factor
+    n_cols = (image.shape[1] // factor) * factor
+    binned_image = image[:n_rows, :n_cols].reshape(
+        n_rows // factor, factor, n_cols // factor, factor,
+    ).mean(axis=(1, 3))
+    return binned_image
+
+
+def read_image_dataset(dataset, roi=None):
+    """Read and decode an image, or only an ROI of it, from an hdf5 dataset.
+
+    Only the chunks of the dataset that overlap with the ROI are read and
+    decompressed, so reading a small ROI of a large image is much faster than
+    reading the whole image.
+
+    Args:
+        dataset (h5py.Dataset): The dataset to read.
+        roi (tuple of ints, optional): (Default = None) If provided, only this
+            region is read. It should be given as (x, y, width, height), in the
+            same format as cv2.selectROI(). If None, the whole image is read.
+
+    Returns:
+        image (np.ndarray): The decoded image or ROI of the image.
+    """
+    if roi is None:
+        stored_array = dataset[()]
+    else:
+        stored_array = dataset[roi_to_slices(roi)]
+    return decode_image(stored_array, dataset.attrs)
@@ -1,5 +1,19 @@
 import numpy as np
 import scipy.optimize
+try:
+    from numba import jit
+except ImportError:
+    # numba is optional. Without it the residuals and jacobian are calculated
+    # with numpy outer products instead of compiled loops.
+    jit = None
+
+from analysislib.Rydberg.analysis_utils.image_storage import block_mean
+
+# Binning factors used by fitgaussian_multiresolution(), from coarsest to finest.
+MULTIRESOLUTION_FACTORS = (8, 4, 2)
+# Levels where the binned image would be smaller than this many pixels along
+# either axis are skipped.
+MIN_BINNED_SIZE = 16
 
 def gaussian(offset, height, center_x, center_y, width_x, width_y):
     """Returns a gaussian function with the given parameters"""
@@ -26,6 +40,129 @@ def moments(data):
 
     return offset, height, x, y, np.abs(width_x), np.abs(width_y)
 
+def _fill_residuals_loop(x_factor, y_factor, offset, height, data, residuals):
+    # Evaluate offset + height * x_factor[i] * y_factor[j] - data[i, j] for the
+    # flattened image.
+    n_y = y_factor.size
+    for i in range(x_factor.size):
+        for j in range(n_y):
+            residuals[i * n_y + j] = (offset + height * x_factor[i] * y_factor[j]
+                                      - data[i, j])
+    return residuals
+
+
+def _fill_jacobian_loop(x_factor, y_factor, x_derivatives, y_derivatives,
+                        height, jacobian):
+    # Each column of the jacobian is an outer product of 1D factors, so only
+    # the 1D factors need to be computed with exponentials.
+    n_y = y_factor.size
+    for i in range(x_factor.size):
+        for j in range(n_y):
+            k = i * n_y + j
+            gaussian_value = x_factor[i] * y_factor[j]
+            jacobian[k, 0] = 1.
+            jacobian[k, 1] = gaussian_value
+            jacobian[k, 2] = height * x_derivatives[0, i] * y_factor[j]
+            jacobian[k, 3] = height * x_factor[i] * y_derivatives[0, j]
+            jacobian[k, 4] = height * x_derivatives[1, i] * y_factor[j]
+            jacobian[k, 5] = height * x_factor[i] * y_derivatives[1, j]
+    return jacobian
+
+
+def _fill_residuals_numpy(x_factor, y_factor, offset, height, data, residuals):
+    # The same as _fill_residuals_loop(), with an outer product.
+    residuals[:] = (offset + height * np.outer(x_factor, y_factor)
+                    - data).ravel()
+    return residuals
+
+
+def _fill_jacobian_numpy(x_factor, y_factor, x_derivatives, y_derivatives,
+                         height, jacobian):
+    # The same as _fill_jacobian_loop(), with outer products.
+    jacobian[:, 0] = 1.
+    jacobian[:, 1] = np.outer(x_factor, y_factor).ravel()
+    jacobian[:, 2] = height * np.outer(x_derivatives[0], y_factor).ravel()
+    jacobian[:, 3] = height * np.outer(x_factor, y_derivatives[0]).ravel()
+    jacobian[:, 4] = height * np.outer(x_derivatives[1], y_factor).ravel()
+    jacobian[:, 5] = height * np.outer(x_factor, y_derivatives[1]).ravel()
+    return jacobian
+
+
+# Use the compiled loops if numba is installed, since they avoid allocating the
+# temporary outer products.
+if jit is None:
+    _fill_residuals = _fill_residuals_numpy
+    _fill_jacobian = _fill_jacobian_numpy
+else:
+    _fill_residuals = jit(nopython=True)(_fill_residuals_loop)
+    _fill_jacobian = jit(nopython=True)(_fill_jacobian_loop)
+
+
+class Gaussian2DModel(object):
+    """A 2D gaussian with offset on a fixed pixel grid, for fast fitting.
+
+    The model has the same parameters as gaussian(), i.e.
+    (offset, height, center_x, center_y, width_x, width_y), where x is the
+    first (row) index of the image and y is the second. The gaussian is
+    separable, so it is evaluated as an outer product of one exponential factor
+    along x and one along y. The factors for the most recent parameters are
+    cached so that they're shared between the residuals and the jacobian, which
+    scipy.optimize.leastsq() requests for the same parameters.
+
+    Attributes:
+        data (np.ndarray): The image being fitted.
+        n_evaluations (int): The number of times the residuals were evaluated.
+    """
+
+    def __init__(self, data):
+        """Set up the model for fitting an image.
+
+        Args:
+            data (np.ndarray): The 2D image to fit.
+        """
+        self.data = np.ascontiguousarray(data, dtype=float)
+        self.x = np.arange(self.data.shape[0], dtype=float)
+        self.y = np.arange(self.data.shape[1], dtype=float)
+        self._cached_params = None
+        self.n_evaluations = 0
+
+    def _factors(self, params):
+        """Get the 1D factors and their derivatives for a set of parameters."""
+        params = tuple(params)
+        if params != self._cached_params:
+            _, _, center_x, center_y, width_x, width_y = params
+            dx = self.x - center_x
+            dy = self.y - center_y
+            x_factor = np.exp(-(dx / width_x)**2 / 2)
+            y_factor = np.exp(-(dy / width_y)**2 / 2)
+            # Derivatives of the factors with respect to the center and width.
+            x_derivatives = np.array([
+                x_factor * dx / width_x**2,
+                x_factor * dx**2 / width_x**3,
+            ])
+            y_derivatives = np.array([
+                y_factor * dy / width_y**2,
+                y_factor * dy**2 / width_y**3,
+            ])
+            self._cached_factors = (
+                x_factor, y_factor, x_derivatives, y_derivatives)
+            self._cached_params = params
+        return self._cached_factors
+
+    def residuals(self, params):
+        """Calculate the flattened residuals (model - data)."""
+        self.n_evaluations += 1
+        x_factor, y_factor, _, _ = self._factors(params)
+        return _fill_residuals(x_factor, y_factor, params[0], params[1],
+                               self.data, np.empty(self.data.size))
+
+    def jacobian(self, params):
+        """Calculate the jacobian of the flattened residuals."""
+        x_factor, y_factor, x_derivatives, y_derivatives = self._factors(params)
+        return _fill_jacobian(x_factor, y_factor, x_derivatives, y_derivatives,
+                              params[1], np.empty((self.data.size, 6)))
+
+
 def fitgaussian(data):
     """Returns (offset, height, x, y, width_x, width_y)
     the gaussian parameters of a 2D distribution found by a fit"""
@@ -33,15 +170,91 @@ def fitgaussian(data):
     data[np.isnan(data)] = 1
     data[np.isinf(data)] = 1
     params = moments(data)
-    errorfunction = lambda p: np.ravel(gaussian(*p)(*np.indices(data.shape)) -
-                                    data)
+    model = Gaussian2DModel(data)
     #return params
-    p, success = scipy.optimize.leastsq(errorfunction,params, maxfev = 300)
+    p, success = scipy.optimize.leastsq(
+        model.residuals, params, Dfun=model.jacobian, maxfev=300)
     return p
     
     
 
-def find_atom_number(data_roi):
+def _fit_level(data, initial_params, maxfev):
+    """Fit the gaussian to one level of the image pyramid."""
+    model = Gaussian2DModel(data)
+    p, success = scipy.optimize.leastsq(
+        model.residuals, initial_params, Dfun=model.jacobian, maxfev=maxfev)
+    return p
+
+
+def _rescale_params(params, factor):
+    """Convert fit parameters from binned pixel coordinates to full ones.
+
+    Binned pixel k covers full resolution pixels k * factor to
+    (k + 1) * factor - 1, so its center is at k * factor + (factor - 1) / 2.
+    """
+    offset, height, x, y, width_x, width_y = params
+    shift = (factor - 1) / 2.
+    return (offset, height, factor * x + shift, factor * y + shift,
+            factor * abs(width_x), factor * abs(width_y))
+
+
+def fitgaussian_multiresolution(data, factors=MULTIRESOLUTION_FACTORS,
+                                coarse_maxfev=100, maxfev=30):
+    """Fit a 2D gaussian by refining fits to binned copies of the image.
+
+    The image is binned by averaging over blocks of pixels for each of the
+    factors, e.g. 8x8, 4x4, then 2x2. The coarsest level is fitted starting
+    from moments() of the binned image, and the result of each level is used as
+    the initial guess for the next finer level. The fit at full resolution then
+    only needs a few iterations since it starts close to the minimum, so the
+    result matches fitgaussian() but most of the iterations are done on images
+    with far fewer pixels. Levels where the binned image would be smaller than
+    MIN_BINNED_SIZE along either axis are skipped, so small images are just
+    fitted directly.
+
+    Args:
+        data (np.ndarray): The 2D image to fit. As in fitgaussian(), nan and inf
+            values are replaced with 1 in place.
+        factors (tuple of ints, optional): (Default = MULTIRESOLUTION_FACTORS)
+            The binning factors of the levels to fit, from coarsest to finest.
+        coarse_maxfev (int, optional): (Default = 100) The maximum number of
+            function evaluations for the fit at each binned level.
+        maxfev (int, optional): (Default = 30) The maximum number of function
+            evaluations for the final fit at full resolution.
+
+    Returns:
+        (np.ndarray): The fitted parameters
+            (offset, height, x, y, width_x, width_y) in full resolution pixel
+            coordinates, in the same format as fitgaussian().
+    """
+    data[np.isnan(data)] = 1
+    data[np.isinf(data)] = 1
+
+    params = None
+    for factor in factors:
+        binned_data = block_mean(data, factor)
+        if min(binned_data.shape) < MIN_BINNED_SIZE:
+            continue
+        if params is None:
+            level_guess = moments(binned_data)
+        else:
+            # Convert the parameters from the previous level, which are in
+            # full resolution coordinates, to this level's coordinates.
+            offset, height, x, y, width_x, width_y = params
+            shift = (factor - 1) / 2.
+            level_guess = (offset, height, (x - shift) / factor,
+                           (y - shift) / factor, width_x / factor,
+                           width_y / factor)
+        level_params = _fit_level(binned_data, level_guess, coarse_maxfev)
+        params = _rescale_params(level_params, factor)
+
+    if params is None:
+        # The image is too small to bin, so just fit it directly.
+        return fitgaussian(data)
+    return _fit_level(data, params, maxfev)
+
+
+def find_atom_number(data_roi, multiresolution=True):
 
     TOP_MAG = 4.0/(10.0) # we are using a 10cm/15cm telescope for the top camera SC 2019/03/25  *)
     SIDE_MAG = 3.0/10.0 # we are using a 3cm/25cm telescope for the top camera SC 2019/03/25  *)
@@ -49,7 +262,11 @@ def find_atom_number(data_roi):
     CROSS_SECTION = 0.29 #micro meter ^2
     BASLER_PIXEL_RATIO = 3.45 #micrometer / pixel
 
-    offset, height, x, y, width_x, width_y = fitgaussian(np.log(data_roi))
+    if multiresolution:
+        fit_function = fitgaussian_multiresolution
+    else:
+        fit_function = fitgaussian
+    offset, height, x, y, width_x, width_y = fit_function(np.log(data_roi))
     atom_number = float(round(2*np.pi*(BASLER_PIXEL_RATIO**2/CROSS_SECTION)*(SIDE_MAG**2) * np.abs(height)* np.abs(width_x)* np.abs(width_y),0))
 
     return atom_number, offset, height, x, y, np.abs(width_x), np.abs(width_y)
@@ -0,0 +1,287 @@
+"""Classes for live plots that are updated on every shot.
+
+Lyse runs singleshot routines once per shot, and creating new axes, images,
+colorbars, etc. each time makes the artists pile up on the figure so that the
+memory usage grows and drawing gets slower and slower over a long run. The
+classes here instead create all of their artists once, then update their data
+on each shot and redraw them using blitting, so the cost of redrawing stays
+constant however many shots are processed.
+
+The blitting follows the approach from the matplotlib blitting tutorial. The
+artists whose data change from shot to shot are marked as animated so that they
+are skipped when the full figure is drawn. Whenever the full figure is drawn,
+whether by this code or by Lyse, the static background is cached and the
+animated artists are drawn on top of it. On most shots only the animated
+artists are redrawn on top of the cached background. A full redraw is only done
+when something static changes, such as the colorbar limits or the limits of the
+cross section axes.
+"""
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib import patches
+
+
+class AbsorptionImageLiveView(object):
+    """A live view of the processed absorption image, its ROI, and the fits.
+
+    The figure has the processed image with a rectangle marking the ROI in the
+    top left, the horizontal cross section and its fit below the image, the
+    vertical cross section and its fit to the right of the image, and some text
+    results in the bottom right. All of the artists are created once in
+    __init__() and then updated by update().
+
+    Attributes:
+        fig (matplotlib.figure.Figure): The figure with the live view.
+        image_axis (matplotlib.axes.Axes): The axes with the processed image.
+        horizontal_axis (matplotlib.axes.Axes): The axes with the horizontal
+            cross section.
+        vertical_axis (matplotlib.axes.Axes): The axes with the vertical cross
+            section.
+        text_axis (matplotlib.axes.Axes): The axes with the text results.
+        n_full_draws (int): The number of times that the full figure has been
+            drawn. This is mainly useful for checking that most shots only
+            need blitting.
+    """
+
+    def __init__(self, figsize=None, cmap='plasma', key_press_callback=None,
+                 n_text_lines=2, clim_hysteresis=0.1):
+        """Create the figure and all of its artists.
+
+        Args:
+            figsize (tuple of floats, optional): (Default = None) The size of
+                the figure, passed to plt.figure(). If None, matplotlib's
+                default figure size is used.
+            cmap (str, optional): (Default = 'plasma') The name of the colormap
+                used for the image.
+            key_press_callback (function, optional): (Default = None) A function
+                to connect to the figure's 'key_press_event', e.g. for asking
+                the user to select a new ROI.
+            n_text_lines (int, optional): (Default = 2) The number of lines of
+                text results that can be displayed.
+            clim_hysteresis (float, optional): (Default = 0.1) The color limits
+                of the image (and therefore the colorbar) are only changed when
+                the image's data range moves outside of the current limits, or
+                shrinks by more than this fraction of the current range. This
+                avoids a full redraw on every shot due to small fluctuations.
+        """
+        self.clim_hysteresis = clim_hysteresis
+        self.n_full_draws = 0
+        self._background = None
+
+        self.fig = plt.figure(constrained_layout=True, figsize=figsize)
+        gs = self.fig.add_gridspec(3, 3)
+        if key_press_callback is not None:
+            self.fig.canvas.mpl_connect('key_press_event', key_press_callback)
+
+        # the image occupies grid spaces [0, 0], [0, 1], [1, 0], and [1, 1] in our 3x3 grid
+        self.image_axis = self.fig.add_subplot(gs[0:2, 0:2])
+        self.image_plot = self.image_axis.imshow(
+            np.zeros((2, 2)),
+            cmap=plt.get_cmap(cmap),
+            vmin=0,
+            vmax=1,
+            animated=True,
+        )
+        self.colorbar = self.fig.colorbar(self.image_plot, ax=self.image_axis)
+        self.roi_rectangle = patches.Rectangle(
+            (0, 0), 0, 0, linewidth=1, edgecolor='w', facecolor='none',
+            animated=True,
+        )
+        self.image_axis.add_patch(self.roi_rectangle)
+
+        # the cross sections share their axes with the image.
+        self.horizontal_axis = self.fig.add_subplot(
+            gs[2, 0:2], sharex=self.image_axis)
+        self.horizontal_data_plot = self.horizontal_axis.scatter(
+            [], [], s=1, c='y', animated=True)
+        self.horizontal_fit_plot = self.horizontal_axis.plot(
+            [], [], c='r', animated=True)[0]
+
+        self.vertical_axis = self.fig.add_subplot(
+            gs[0:2, 2], sharey=self.image_axis)
+        self.vertical_data_plot = self.vertical_axis.scatter(
+            [], [], s=1, c='y', animated=True)
+        self.vertical_fit_plot = self.vertical_axis.plot(
+            [], [], c='r', animated=True)[0]
+        self.vertical_axis.invert_xaxis()
+
+        # add in some text results for the plot
+        self.text_axis = self.fig.add_subplot(gs[2, 2])
+        self.text_axis.set_axis_off()
+        self.text_artists = [
+            self.text_axis.text(
+                0, 0.75 - 0.375 * j, "", animated=True,
+            ) for j in range(n_text_lines)
+        ]
+
+        self._animated_artists = [
+            self.image_plot,
+            self.roi_rectangle,
+            self.horizontal_data_plot,
+            self.horizontal_fit_plot,
+            self.vertical_data_plot,
+            self.vertical_fit_plot,
+            *self.text_artists,
+        ]
+
+        # Cache the background and draw the animated artists whenever the full
+        # figure is drawn, even if that draw is triggered by Lyse.
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        """Cache the static background and draw the animated artists."""
+        canvas = self.fig.canvas
+        if event is not None and event.canvas != canvas:
+            return
+        self.n_full_draws += 1
+        if getattr(canvas, 'supports_blit', False):
+            self._background = canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self._animated_artists:
+            self.fig.draw_artist(artist)
+
+    def _update_clim(self, image):
+        """Update the color limits if needed, returning True if they changed."""
+        finite_image = image[np.isfinite(image)]
+        if finite_image.size == 0:
+            return False
+        data_min, data_max = finite_image.min(), finite_image.max()
+        vmin, vmax = self.image_plot.get_clim()
+        current_range = vmax - vmin
+        outside = data_min < vmin or data_max > vmax
+        shrunk = (current_range - (data_max - data_min)) > \
+            self.clim_hysteresis * current_range
+        if outside or shrunk:
+            # Pad the limits a bit so that small fluctuations in the data range
+            # on the following shots don't require changing them again.
+            padding = 0.5 * self.clim_hysteresis * (data_max - data_min)
+            if padding <= 0:
+                padding = 0.5
+            # The colorbar is updated automatically when the clim changes.
+            self.image_plot.set_clim(data_min - padding, data_max + padding)
+            return True
+        return False
+
+    @staticmethod
+    def _expand_limits(limits, values, inverted=False):
+        """Get new axis limits if values don't fit inside of limits.
+
+        Returns None if the values fit within the current limits, otherwise the
+        new limits with some padding so that they don't need to be changed
+        again for small fluctuations.
+        """
+        finite_values = values[np.isfinite(values)]
+        if finite_values.size == 0:
+            return None
+        low, high = sorted(limits)
+        data_low, data_high = finite_values.min(), finite_values.max()
+        if data_low >= low and data_high <= high:
+            return None
+        padding = 0.1 * max(data_high - data_low, 1e-12)
+        new_limits = (data_low - padding, data_high + padding)
+        if inverted:
+            new_limits = new_limits[::-1]
+        return new_limits
+
+    def update(self, processed_image, roi, horizontal_indices, horizontal_data,
+               horizontal_fit_positions, horizontal_fit_values,
+               vertical_indices, vertical_data, vertical_fit_positions,
+               vertical_fit_values, text_lines=()):
+        """Update the live view with the results from a new shot.
+
+        Args:
+            processed_image (np.ndarray): The 2D image to display.
+            roi (tuple of ints): The ROI as (x, y, width, height), in the same
+                format as returned by cv2.selectROI().
+            horizontal_indices (np.ndarray): The positions of the points in the
+                horizontal cross section.
+            horizontal_data (np.ndarray): The values of the horizontal cross
+                section.
+            horizontal_fit_positions (np.ndarray): The positions at which the
+                fit to the horizontal cross section was evaluated.
+            horizontal_fit_values (np.ndarray): The values of the fit to the
+                horizontal cross section.
+            vertical_indices (np.ndarray): The positions of the points in the
+                vertical cross section.
+            vertical_data (np.ndarray): The values of the vertical cross
+                section.
+            vertical_fit_positions (np.ndarray): The positions at which the fit
+                to the vertical cross section was evaluated.
+            vertical_fit_values (np.ndarray): The values of the fit to the
+                vertical cross section.
+            text_lines (list of str, optional): (Default = ()) The lines of text
+                to display. Any extra lines beyond n_text_lines are ignored.
+        """
+        full_redraw = self._background is None
+
+        # Update the image. The extent only needs to change if the image shape
+        # changes, which requires a full redraw to update the axis limits.
+        if self.image_plot.get_array().shape != processed_image.shape:
+            n_rows, n_cols = processed_image.shape
+            self.image_plot.set_extent((-0.5, n_cols - 0.5, n_rows - 0.5, -0.5))
+            full_redraw = True
+        self.image_plot.set_data(processed_image)
+        full_redraw |= self._update_clim(processed_image)
+
+        # Update the ROI rectangle.
+        x0, y0, width, height = roi
+        self.roi_rectangle.set_bounds(x0, y0, width, height)
+
+        # Update the cross sections and their fits.
+        self.horizontal_data_plot.set_offsets(
+            np.column_stack((horizontal_indices, horizontal_data)))
+        self.horizontal_fit_plot.set_data(
+            horizontal_fit_positions, horizontal_fit_values)
+        self.vertical_data_plot.set_offsets(
+            np.column_stack((vertical_data, vertical_indices)))
+        # The vertical cross section is plotted sideways, so its values go
+        # along the x-axis.
+        self.vertical_fit_plot.set_data(
+            vertical_fit_values, vertical_fit_positions)
+
+        # Only rescale the cross section axes if the data no longer fit.
+        horizontal_values = np.concatenate(
+            (np.asarray(horizontal_data, dtype=float),
+             np.asarray(horizontal_fit_values, dtype=float)))
+        new_ylim = self._expand_limits(
+            self.horizontal_axis.get_ylim(), horizontal_values)
+        if new_ylim is not None:
+            self.horizontal_axis.set_ylim(new_ylim)
+            full_redraw = True
+        vertical_values = np.concatenate(
+            (np.asarray(vertical_data, dtype=float),
+             np.asarray(vertical_fit_values, dtype=float)))
+        new_xlim = self._expand_limits(
+            self.vertical_axis.get_xlim(), vertical_values, inverted=True)
+        if new_xlim is not None:
+            self.vertical_axis.set_xlim(new_xlim)
+            full_redraw = True
+
+        # Update the text.
+        for text_artist, text in zip(self.text_artists, text_lines):
+            text_artist.set_text(text)
+
+        self.redraw(full_redraw=full_redraw)
+
+    def redraw(self, full_redraw=False):
+        """Redraw the figure, using blitting when possible.
+
+        Args:
+            full_redraw (bool, optional): (Default = False) If True, the whole
+                figure is redrawn, which also updates the cached background.
+                Otherwise only the animated artists are redrawn on top of the
+                cached background.
+        """
+        canvas = self.fig.canvas
+        if full_redraw or self._background is None or \
+                not getattr(canvas, 'supports_blit', False):
+            # This triggers self._on_draw(), which caches the new background
+            # and draws the animated artists on top of it.
+            canvas.draw()
+        else:
+            canvas.restore_region(self._background)
+            self._draw_animated()
+            canvas.blit(self.fig.bbox)
+        canvas.flush_events()
@@ -0,0 +1,212 @@
+"""Vectorized M-LOOP cost functions.
+
+The cost functions here calculate M-LOOP costs and their uncertainties from
+arrays of results, with one entry per repeated-shot group, so the costs for all
+of the groups of a dataset are calculated with a few array operations rather
+than one python call per group. They're registered in COST_FUNCTIONS under the
+names used for the mloop_cost_function_name global; see
+multishot_routines/mloop_calculate_cost.py for a description of each one.
+
+The peak OD used by several of the costs is the mean of the brightest pixels of
+the OD image. top_k_mean() finds those with np.partition(), which is linear in
+the number of pixels, rather than fully sorting the image.
+
+Cost functions given as python source in globals, as used by
+mloop_calculate_cost_global_function.py, can be compiled with
+compile_cost_function(), which caches the compiled function by its source so
+that eval() only runs when the source changes.
+
+Example Usage:
+```
+values = GroupValues(dataset.repeatedshot_list)
+costs, uncertainties = evaluate_costs('psd_3d_proxy_peak_od', values)
+```
+"""
+from functools import lru_cache
+
+import numpy as np
+
+# The peak OD that is considered typical when scaling the PSD proxy costs.
+TYPICAL_PEAK_OD = 0.1
+DEFAULT_N_PEAK_PIXELS = 10
+
+
+def top_k_mean(image, k):
+    """Average the k largest values of an image.
+
+    This uses np.partition() so that it takes time proportional to the number
+    of pixels rather than sorting the whole image. It gives the same result as
+    np.mean(np.sort(image, axis=None)[-k:]). In particular np.partition() orders
+    nan and inf values the same way np.sort() does, with nan last, so a nan in
+    the image gives a nan mean and an inf gives an inf mean, which flags a bad
+    image rather than hiding it.
+
+    Args:
+        image (np.ndarray): The image, e.g. an OD image.
+        k (int): The number of values to average. If the image has fewer values
+            than this, all of them are averaged.
+
+    Returns:
+        mean (float): The mean of the k largest values, or nan if the image is
+            empty.
+    """
+    values = np.asarray(image, dtype=float).ravel()
+    if values.size == 0:
+        return np.nan
+    k = int(min(max(k, 1), values.size))
+    largest = np.partition(values, values.size - k)[values.size - k:]
+    return float(largest.mean())
+
+
+class GroupValues(object):
+    """Lazily collects attributes of many objects into arrays.
+
+    values[name] gives np.array([getattr(object_, name) for object_ in
+    objects]), which is calculated the first time it's requested and cached.
+    This lets the cost functions access the results and globals of many
+    RepeatedShot (or Shot) instances as arrays, while only collecting the
+    attributes that the selected cost function actually uses. Values which
+    aren't attributes, such as the peak OD of an averaged OD image, can be
+    calculated on demand by passing functions as derived.
+    """
+
+    def __init__(self, objects, derived=None):
+        """Create a GroupValues.
+
+        Args:
+            objects (list): The objects, e.g. RepeatedShot instances.
+            derived (dict, optional): (Default = None) Maps names to functions
+                which take one of the objects and return the value for that
+                name. These are used instead of getattr() for those names.
+        """
+        self.objects = list(objects)
+        self.derived = {} if derived is None else dict(derived)
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            function = self.derived.get(
+                name, lambda object_: getattr(object_, name))
+            self._arrays[name] = np.array(
+                [function(object_) for object_ in self.objects])
+        return self._arrays[name]
+
+
+def _scaled_atom_number(values):
+    # Scale the atom number relative to the threshold to keep costs ~1, and set
+    # it to 0 if it was measured to be a negative value.
+    atom_number_prime = values['atom_number'] / \
+        values['mloop_cost_atom_threshold']
+    return np.maximum(0, atom_number_prime)
+
+
+def atom_number(values):
+    return np.asarray(values['atom_number'], dtype=float)
+
+
+def atom_number_uncertainty(values):
+    """Use the atom number uncertainty, replacing nan (one shot) with zero."""
+    uncertainty = np.asarray(values['atom_number_uncertainty'], dtype=float)
+    return np.where(np.isnan(uncertainty), 0., uncertainty)
+
+
+def psd_3d_proxy_peak_od(values):
+    atom_number_ = np.asarray(values['atom_number'], dtype=float)
+    atom_threshold = values['mloop_cost_atom_threshold']
+
+    # Scale peak_od and atom_number to make the resulting cost ~1.
+    peak_od_prime = values['peak_od'] / TYPICAL_PEAK_OD
+    atom_number_prime = atom_number_ / atom_threshold
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # Calculate the proxy for the PSD.
+        psd_proxy = peak_od_prime**3 / atom_number_prime**2
+
+        # Suppress noise in the cost at low atom numbers.
+        thresholding_value = np.where(
+            atom_number_ >= 0,
+            2. / (np.exp(atom_threshold / atom_number_) + 1.),
+            0.,
+        )
+        return psd_proxy * thresholding_value
+
+
+def bec_number_proxy(values):
+    # PSD proxy scales as 1/N^(1/5) at T=0, so need to multiply it by N^(6/5) to
+    # get something that scales as N at T=0.
+    return psd_3d_proxy_peak_od(values) * _scaled_atom_number(values)**(6. / 5.)
+
+
+def bec_root_n_proxy(values):
+    # Multiply by N^(1/5)*N^(1/2) = N^(7/10) to scale as N^(1/2) at T=0.
+    return psd_3d_proxy_peak_od(values) * _scaled_atom_number(values)**0.7
+
+
+def bec_fourth_root_n_proxy(values):
+    # Multiply by N^(1/5)*N^(1/4) = N^(9/20) to scale as N^(1/4) at T=0.
+    return psd_3d_proxy_peak_od(values) * _scaled_atom_number(values)**0.45
+
+
+def constant_uncertainty(values):
+    """Set the uncertainty to the value of mloop_cost_constant_uncertainty.
+
+    If constant_uncertainty() is used but a good value for uncertainty isn't
+    known, simply set mloop_cost_constant_uncertainty to zero. In that case,
+    M-LOOP will automatically set it to minimum_uncertainty.
+    """
+    return np.asarray(values['mloop_cost_constant_uncertainty'], dtype=float)
+
+
+# The keys are the allowed values of the mloop_cost_function_name global. The
+# values are tuples where the first entry is the function that calculates the
+# cost, and the second entry is the function that calculates its uncertainty.
+COST_FUNCTIONS = {
+    'atom_number': (atom_number, atom_number_uncertainty),
+    'psd_3d_proxy_peak_od': (psd_3d_proxy_peak_od, constant_uncertainty),
+    'bec_number_proxy': (bec_number_proxy, constant_uncertainty),
+    'bec_root_n_proxy': (bec_root_n_proxy, constant_uncertainty),
+    'bec_fourth_root_n_proxy': (bec_fourth_root_n_proxy, constant_uncertainty),
+}
+
+
+def evaluate_costs(cost_function_name, values):
+    """Calculate a registered cost and its uncertainty for many groups at once.
+
+    Args:
+        cost_function_name (str): The key of the cost in COST_FUNCTIONS.
+        values (GroupValues or dict): Maps the names of results and globals to
+            arrays with one entry per group.
+
+    Raises:
+        KeyError: If cost_function_name isn't in COST_FUNCTIONS.
+
+    Returns:
+        costs (np.ndarray): The cost of each group.
+        uncertainties (np.ndarray): The uncertainty of each group's cost.
+    """
+    cost_function, uncertainty_function = COST_FUNCTIONS[cost_function_name]
+    costs = np.broadcast_to(cost_function(values), (len(values),))
+    uncertainties = np.broadcast_to(
+        uncertainty_function(values), (len(values),))
+    return costs, uncertainties
+
+
+@lru_cache(maxsize=64)
+def compile_cost_function(source):
+    """Compile a cost function from python source, e.g. from a global.
+
+    Compiled functions are cached by their source, so calling this again with
+    the same string doesn't call eval() again. The source is evaluated in this
+    module's namespace, so numpy is available as np.
+
+    Args:
+        source (str): Python code which evaluates to a function, e.g.
+            'lambda repeatedshot: repeatedshot.atom_number'.
+
+    Returns:
+        function (function): The function.
+    """
+    return eval(compile(source, '<mloop cost function>', 'eval'))
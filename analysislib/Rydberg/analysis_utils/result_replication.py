@@ -0,0 +1,423 @@
+"""Replicate results to a second copy of a shot file in the background.
+
+Some results, such as the M-LOOP costs, need to be saved both to the original
+shot file on the control computer and to the copy of it on the analysis
+computer. Writing to both copies before returning means that every result has
+to wait on the slower of the two files. Instead, the functions here save the
+result to one copy right away, and append it to a small journal. A background
+thread then applies the journal to the other copy in batches, opening each
+replica file only once per batch. The journal is a JSON lines file, so results
+which weren't replicated yet (e.g. because Lyse was restarted) are replicated
+the next time a ResultReplicator is created with the same journal. Only one
+ResultReplicator may use a journal at a time. Lyse runs each routine in its own
+worker process, so each routine should use its own journal, e.g. from
+get_journal_path() with the routine's name.
+
+The path of the other copy of a shot file is usually found by replacing the
+start of the original path, e.g. the data directory on the control computer,
+with the data directory on the analysis computer. PathPrefixMapping does that,
+and analysis_copy_mapping() creates one from the analysis_copy_original_prefix
+and analysis_copy_prefix globals.
+
+Call ResultReplicator.flush() when the other copy must be up to date before
+continuing.
+
+Example Usage:
+```
+mapping = analysis_copy_mapping(shot.get_globals())
+replicator = ResultReplicator(mapping, get_journal_path('my_routine'))
+save_result_and_replicate(shot, 'mloop_cost', cost, 'results/mloop_costs',
+                          replicator)
+# Later, if needed:
+replicator.flush()
+```
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+import labscript_utils.h5_lock
+import h5py
+import numpy as np
+
+DEFAULT_BATCH_INTERVAL = 0.5  # seconds.
+DEFAULT_RETRY_INTERVAL = 5.0  # seconds.
+# The globals giving the start of the original shot file paths and what to
+# replace it with to get the paths of the copies on the analysis computer.
+ORIGINAL_PREFIX_GLOBAL = 'analysis_copy_original_prefix'
+COPY_PREFIX_GLOBAL = 'analysis_copy_prefix'
+
+
+def get_journal_path(name):
+    """Get a journal path in the temporary directory which is unique to name.
+
+    Args:
+        name (str): Identifies the user of the journal, e.g. the name of the
+            Lyse routine.
+
+    Returns:
+        journal_path (str): The path of the journal file.
+    """
+    return os.path.join(tempfile.gettempdir(),
+                        f'{name}_replication_journal.jsonl')
+
+
+class PathPrefixMapping(object):
+    """Maps shot file paths to another copy by replacing the start of the path.
+
+    Instances can be used as the replica_path_function of a ResultReplicator.
+    Two instances are equal if they have the same prefixes.
+
+    Attributes:
+        original_prefix (str): The start of the paths to replace, e.g. the data
+            directory on the control computer.
+        copy_prefix (str): What to replace original_prefix with, e.g. the data
+            directory on the analysis computer.
+    """
+
+    def __init__(self, original_prefix, copy_prefix):
+        self.original_prefix = os.path.normpath(original_prefix)
+        self.copy_prefix = os.path.normpath(copy_prefix)
+
+    def __call__(self, h5_path):
+        """Get the path of the other copy of a shot file.
+
+        Raises:
+            ValueError: If h5_path isn't inside original_prefix.
+        """
+        h5_path = os.path.normpath(h5_path)
+        try:
+            relative_path = os.path.relpath(h5_path, self.original_prefix)
+        except ValueError:
+            # On Windows, the paths are on different drives.
+            relative_path = os.pardir
+        if relative_path == os.pardir or \
+                relative_path.startswith(os.pardir + os.sep):
+            message = (f"The shot file {h5_path} isn't in "
+                       f"{self.original_prefix}, so the path of its copy isn't "
+                       "known.")
+            raise ValueError(message)
+        return os.path.join(self.copy_prefix, relative_path)
+
+    def __eq__(self, other):
+        if not isinstance(other, PathPrefixMapping):
+            return NotImplemented
+        return (self.original_prefix, self.copy_prefix) == \
+            (other.original_prefix, other.copy_prefix)
+
+    def __hash__(self):
+        return hash((self.original_prefix, self.copy_prefix))
+
+
+def analysis_copy_mapping(shot_globals):
+    """Get the mapping to the analysis computer's copies of the shot files.
+
+    Args:
+        shot_globals (dict): The globals of a shot, e.g. from
+            lyse.Run.get_globals().
+
+    Returns:
+        mapping (PathPrefixMapping or None): The mapping, or None if either of
+            the ORIGINAL_PREFIX_GLOBAL and COPY_PREFIX_GLOBAL globals isn't set.
+    """
+    original_prefix = shot_globals.get(ORIGINAL_PREFIX_GLOBAL)
+    copy_prefix = shot_globals.get(COPY_PREFIX_GLOBAL)
+    if not original_prefix or not copy_prefix:
+        return None
+    return PathPrefixMapping(original_prefix, copy_prefix)
+
+
+def _to_json_value(value):
+    """Convert a result into a value that can be stored in the journal."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def write_results(h5_path, entries):
+    """Write several results to one hdf5 file, opening it only once.
+
+    The results are saved as attributes of their groups, in the same way as
+    lyse.Run.save_result().
+
+    Args:
+        h5_path (str): The path of the hdf5 file.
+        entries (list of dict): The results to write. Each should have the keys
+            'group', 'name', and 'value'.
+
+    Raises:
+        OSError: If the file doesn't exist yet. It isn't created here since
+            that would clash with the file being transferred later.
+    """
+    with h5py.File(h5_path, 'r+') as h5_file:
+        for entry in entries:
+            group = h5_file.require_group(entry['group'])
+            group.attrs[entry['name']] = entry['value']
+
+
+class ResultReplicator(object):
+    """Replicates results to the other copies of shot files in the background.
+
+    Attributes:
+        replica_path_function (function): Takes the path of the copy of a shot
+            file that results are saved to directly, and returns the path of the
+            other copy that they should be replicated to.
+        journal_path (str): The path of the journal file.
+        n_pending (int): The number of results that haven't been replicated yet.
+    """
+
+    def __init__(self, replica_path_function, journal_path,
+                 batch_interval=DEFAULT_BATCH_INTERVAL,
+                 retry_interval=DEFAULT_RETRY_INTERVAL):
+        """Create a ResultReplicator and start its background thread.
+
+        Any results in the journal that weren't replicated yet are queued
+        again.
+
+        Args:
+            replica_path_function (function): A function which takes the path of
+                a shot file and returns the path of its other copy, e.g. a
+                PathPrefixMapping.
+            journal_path (str): The path of the journal file, e.g. from
+                get_journal_path(). No other ResultReplicator, in this process
+                or any other, may use the same journal at the same time.
+            batch_interval (float, optional): (Default = DEFAULT_BATCH_INTERVAL)
+                How long, in seconds, the background thread waits to collect
+                more results before replicating a batch.
+            retry_interval (float, optional): (Default = DEFAULT_RETRY_INTERVAL)
+                How long, in seconds, to wait before retrying results which
+                couldn't be replicated, e.g. because the other copy doesn't
+                exist yet.
+        """
+        self.replica_path_function = replica_path_function
+        self.journal_path = journal_path
+        self.batch_interval = batch_interval
+        self.retry_interval = retry_interval
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._next_sequence_number = 0
+        self._n_in_progress = 0
+        self._last_error = None
+        self._flush_requested = False
+        self._stopping = False
+
+        # Requeue anything that wasn't replicated before, then compact the
+        # journal so that it doesn't grow forever.
+        self._pending = self._read_unapplied_entries()
+        if self._pending:
+            self._next_sequence_number = max(
+                entry['seq'] for entry in self._pending) + 1
+        self._rewrite_journal(self._pending)
+
+        self._thread = threading.Thread(
+            target=self._run, name='ResultReplicator', daemon=True)
+        self._thread.start()
+
+    @property
+    def n_pending(self):
+        with self._condition:
+            return len(self._pending) + self._n_in_progress
+
+    def _read_unapplied_entries(self):
+        if not os.path.exists(self.journal_path):
+            return []
+        entries = {}
+        applied = set()
+        with open(self.journal_path, 'r') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Ignore a partially written last line.
+                    continue
+                if 'applied' in record:
+                    applied.update(record['applied'])
+                else:
+                    entries[record['seq']] = record
+        return [entry for seq, entry in sorted(entries.items())
+                if seq not in applied]
+
+    def _rewrite_journal(self, entries):
+        with open(self.journal_path, 'w') as journal:
+            for entry in entries:
+                journal.write(json.dumps(entry) + '\n')
+
+    def _append_to_journal(self, record):
+        with open(self.journal_path, 'a') as journal:
+            journal.write(json.dumps(record) + '\n')
+
+    def submit(self, h5_path, group, name, value):
+        """Queue a result to be replicated to the other copy of a shot file.
+
+        This doesn't save the result to h5_path itself; see
+        save_result_and_replicate() for that.
+
+        Args:
+            h5_path (str): The path of the copy of the shot file that the result
+                was saved to.
+            group (str): The group in the hdf5 file, e.g. 'results/mloop_costs'.
+            name (str): The name of the result.
+            value (scalar or array-like): The value of the result.
+        """
+        with self._condition:
+            entry = {
+                'seq': self._next_sequence_number,
+                'replica': self.replica_path_function(h5_path),
+                'group': group,
+                'name': name,
+                'value': _to_json_value(value),
+            }
+            self._next_sequence_number += 1
+            self._append_to_journal(entry)
+            self._pending.append(entry)
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until all queued results have been replicated.
+
+        Args:
+            timeout (float, optional): (Default = None) The maximum time, in
+                seconds, to wait. If None, wait as long as necessary.
+
+        Raises:
+            TimeoutError: If the results weren't all replicated within timeout.
+                The error message includes the last replication error, if any.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            # Wake up the background thread so that it doesn't wait for the
+            # rest of batch_interval or retry_interval.
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._pending or self._n_in_progress:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        message = (f"{len(self._pending) + self._n_in_progress}"
+                                   " results haven't been replicated. Last "
+                                   f"error: {self._last_error!r}")
+                        raise TimeoutError(message)
+                self._condition.wait(remaining)
+
+    def close(self, flush=True, timeout=None):
+        """Stop the background thread.
+
+        Args:
+            flush (bool, optional): (Default = True) Whether to wait for the
+                queued results to be replicated first. Results which aren't
+                replicated stay in the journal and are replicated by the next
+                ResultReplicator that uses it.
+            timeout (float, optional): (Default = None) The maximum time, in
+                seconds, to wait when flushing.
+        """
+        if flush:
+            self.flush(timeout=timeout)
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                # Give other results a chance to arrive so they can be written
+                # in the same batch, unless someone is waiting on a flush.
+                if not self._flush_requested:
+                    self._condition.wait(self.batch_interval)
+                if self._stopping:
+                    return
+                batch, self._pending = self._pending, []
+                self._n_in_progress = len(batch)
+
+            failed = self._replicate(batch)
+
+            with self._condition:
+                self._n_in_progress = 0
+                # Put failed results back at the front of the queue.
+                self._pending = failed + self._pending
+                if not self._pending:
+                    self._flush_requested = False
+                self._condition.notify_all()
+                if failed and not self._stopping:
+                    self._condition.wait(self.retry_interval)
+
+    def _replicate(self, batch):
+        """Write a batch of results, returning the ones that failed."""
+        by_replica = {}
+        for entry in batch:
+            by_replica.setdefault(entry['replica'], []).append(entry)
+
+        failed = []
+        applied = []
+        for replica_path, entries in by_replica.items():
+            try:
+                write_results(replica_path, entries)
+                applied.extend(entry['seq'] for entry in entries)
+            except Exception as error:
+                self._last_error = error
+                failed.extend(entries)
+        if applied:
+            with self._condition:
+                self._append_to_journal({'applied': applied})
+        return failed
+
+
+def save_result_and_replicate(shot, name, value, group, replicator):
+    """Save a scalar result to a shot and queue it for replication.
+
+    This is a replacement for saving the result to both copies of the shot file
+    synchronously. The result is saved to shot's file right away, and to the
+    other copy in the background by replicator.
+
+    Args:
+        shot (lyse.Run-like): The shot to save the result to, e.g. a
+            data_classes.Shot instance for the copy of the file that must be up
+            to date right away.
+        name (str): The name of the result.
+        value (scalar): The value of the result.
+        group (str): The group in the hdf5 file, e.g. 'results/mloop_costs'.
+        replicator (ResultReplicator): The replicator that copies the result to
+            the other copy of the shot file.
+    """
+    shot.save_result(name, value, group=group)
+    replicator.submit(shot.h5_path, group, name, value)
+
+
+def update_replicator(replicator, replica_path_function, journal_path):
+    """Reuse a ResultReplicator if it still replicates to the same copies.
+
+    This is for replicators kept in routine_storage, whose replica path function
+    comes from globals that may change between runs.
+
+    Args:
+        replicator (ResultReplicator or None): The existing replicator, if any.
+        replica_path_function (function or None): The function that the
+            replicator should use, e.g. from analysis_copy_mapping(). If None,
+            no replicator is needed.
+        journal_path (str): The path of the journal for a new replicator.
+
+    Returns:
+        replicator (ResultReplicator or None): replicator if its
+            replica_path_function is equal to replica_path_function, otherwise
+            a new replicator, or None if replica_path_function is None. A
+            replicator that is replaced is closed without flushing, so the
+            results that it hadn't replicated stay in the journal and are
+            replicated by the new one.
+    """
+    if replicator is not None:
+        if replicator.replica_path_function == replica_path_function:
+            return replicator
+        replicator.close(flush=False)
+    if replica_path_function is None:
+        return None
+    return ResultReplicator(replica_path_function, journal_path)
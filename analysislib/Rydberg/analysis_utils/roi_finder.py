@@ -0,0 +1,179 @@
+"""Functions for automatically finding the region of interest around a cloud.
+
+The functions here are used by Shot.process_image() to pick a region of
+interest (ROI) without having to ask the user to draw one with
+cv2.selectROI(), which blocks Lyse until someone clicks on the image. The
+cloud is located by smoothing a downsampled copy of the processed image,
+thresholding it, and keeping the connected component that contains the peak.
+The center and width of the cloud are then calculated from the moments of that
+component and the ROI is padded by a configurable number of sigmas.
+
+ROIs are returned in the same (x, y, width, height) format as
+cv2.selectROI(), where x is the column index and y is the row index of the top
+left corner of the rectangle, so that they can be used interchangeably with
+manually selected ROIs.
+"""
+import numpy as np
+from scipy.ndimage import gaussian_filter, label
+
+from analysislib.Rydberg.analysis_utils.image_storage import block_mean
+
+
+def expand_roi(roi, margin, image_shape):
+    """Grow an ROI by a fraction of its size on every side.
+
+    Args:
+        roi (tuple of ints): The ROI as (x, y, width, height), in the same
+            format as returned by cv2.selectROI().
+        margin (float): The amount to grow the ROI by on each side, as a
+            fraction of its width/height. For example margin=0.5 doubles the
+            width and height of the ROI.
+        image_shape (tuple of ints): The shape of the image, which is used to
+            clip the expanded ROI so that it stays inside of the image.
+
+    Returns:
+        expanded_roi (tuple of ints): The expanded ROI as (x, y, width,
+            height).
+    """
+    x, y, width, height = [int(value) for value in roi]
+    pad_x = int(np.ceil(margin * width))
+    pad_y = int(np.ceil(margin * height))
+    x_start = max(x - pad_x, 0)
+    y_start = max(y - pad_y, 0)
+    x_stop = min(x + width + pad_x, image_shape[1])
+    y_stop = min(y + height + pad_y, image_shape[0])
+    return (x_start, y_start, x_stop - x_start, y_stop - y_start)
+
+
+def find_roi(processed_image, n_sigmas=3., downsample=4, smoothing_sigma=1.,
+             threshold_fraction=0.5, detection_threshold=5.,
+             previous_roi=None, search_margin=1., min_size=8):
+    """Automatically find an ROI around the atomic cloud in an image.
+
+    The processed image (atoms image divided by no-atoms image) is converted to
+    an absorption signal (one minus the transmission), downsampled by averaging
+    over blocks of pixels, and smoothed with a gaussian filter. The pixels with
+    signal above threshold_fraction of the peak signal are then labeled into
+    connected components, and only the component that includes the peak is
+    kept. The center of the cloud is given by the signal-weighted first moments
+    of that component and its width by the second moments. Because only the
+    part of the cloud above threshold_fraction of the peak is included, the
+    second moments underestimate the width of a gaussian cloud, so they are
+    corrected analytically assuming a gaussian profile. The widths are also
+    corrected for the broadening from the smoothing filter.
+
+    Pixels with a value of exactly zero in processed_image are treated as having
+    no absorption. Those are the pixels that Shot.process_image() zeroes out
+    because they had infinite or nan values, typically because there was no
+    light in the no-atoms image, and they shouldn't be mistaken for atoms.
+
+    If previous_roi is provided, then the search is restricted to that ROI
+    expanded by search_margin on each side. This makes the ROI follow the cloud
+    from shot to shot and makes it robust against other features elsewhere in
+    the image.
+
+    Args:
+        processed_image (np.ndarray): A 2D array of the atoms image divided by
+            the no-atoms image, as calculated in Shot.process_image().
+        n_sigmas (float, optional): (Default = 3.) The ROI extends this many
+            sigmas of the cloud's gaussian width from the cloud's center in
+            each direction.
+        downsample (int, optional): (Default = 4) The image is downsampled by
+            averaging blocks of downsample x downsample pixels before searching
+            for the cloud. Larger values are faster but less precise.
+        smoothing_sigma (float, optional): (Default = 1.) The sigma, in
+            downsampled pixels, of the gaussian filter used to smooth the
+            image.
+        threshold_fraction (float, optional): (Default = 0.5) Pixels with
+            signal above this fraction of the peak signal are considered part of
+            the cloud when calculating the moments.
+        detection_threshold (float, optional): (Default = 5.) The peak signal
+            must be at least this many times larger than the noise in the
+            smoothed image (estimated from its median absolute deviation) for a
+            cloud to be considered found.
+        previous_roi (tuple of ints, optional): (Default = None) An ROI as
+            (x, y, width, height), typically the one used for the previous shot.
+            If provided, only the region around it is searched.
+        search_margin (float, optional): (Default = 1.) When previous_roi is
+            provided, it is expanded by this fraction of its size on each side
+            to get the region that is searched. See expand_roi() for more
+            information.
+        min_size (int, optional): (Default = 8) The minimum width and height,
+            in full resolution pixels, of the returned ROI.
+
+    Returns:
+        roi (tuple of ints or None): The ROI as (x, y, width, height), in the
+            same format as cv2.selectROI(). If no cloud is found, None is
+            returned instead.
+    """
+    image_shape = processed_image.shape
+
+    # Restrict the search to the area around the previous ROI if requested.
+    if previous_roi is not None:
+        search_roi = expand_roi(previous_roi, search_margin, image_shape)
+    else:
+        search_roi = (0, 0, image_shape[1], image_shape[0])
+    search_x, search_y, search_width, search_height = search_roi
+    image = processed_image[search_y:search_y + search_height,
+                            search_x:search_x + search_width]
+
+    # Convert to absorption signal, ignoring pixels that were zeroed out.
+    signal = np.where(image > 0, 1. - image, 0.)
+
+    # Downsample and smooth. Make sure that the downsampled image isn't too
+    # small to find anything in.
+    downsample = max(min(int(downsample), min(signal.shape) // 4), 1)
+    binned = block_mean(signal, downsample)
+    smoothed = gaussian_filter(binned, smoothing_sigma, mode='nearest')
+
+    # Subtract off the background level and estimate the noise.
+    smoothed = smoothed - np.median(smoothed)
+    noise = 1.4826 * np.median(np.abs(smoothed))
+    peak_index = np.unravel_index(np.argmax(smoothed), smoothed.shape)
+    peak_value = smoothed[peak_index]
+    if peak_value <= 0 or peak_value < detection_threshold * noise:
+        return None
+
+    # Keep only the connected component above threshold that contains the
+    # peak.
+    labels, _ = label(smoothed > threshold_fraction * peak_value)
+    component = (labels == labels[peak_index])
+    weights = np.where(component, smoothed, 0.)
+    total_weight = weights.sum()
+
+    # Calculate the first and second moments of the component.
+    rows = np.arange(smoothed.shape[0])
+    cols = np.arange(smoothed.shape[1])
+    row_weights = weights.sum(axis=1)
+    col_weights = weights.sum(axis=0)
+    center_row = (rows * row_weights).sum() / total_weight
+    center_col = (cols * col_weights).sum() / total_weight
+    var_row = ((rows - center_row)**2 * row_weights).sum() / total_weight
+    var_col = ((cols - center_col)**2 * col_weights).sum() / total_weight
+
+    # Correct the variances for the truncation at threshold_fraction of the
+    # peak. For a 2D gaussian truncated where it drops to a fraction f of its
+    # peak, i.e. at radius R = sqrt(-2 ln(f)) in units of sigma, the weighted
+    # variance along each axis is sigma**2 * (2 - (R**2 + 2) * f) / (2 - 2 * f).
+    f = threshold_fraction
+    r_squared = -2 * np.log(f)
+    truncation_factor = (2 - (r_squared + 2) * f) / (2 - 2 * f)
+    var_row = var_row / truncation_factor
+    var_col = var_col / truncation_factor
+
+    # Remove the broadening from the smoothing filter, then convert to full
+    # resolution pixels.
+    sigma_row = np.sqrt(max(var_row - smoothing_sigma**2, 0.25)) * downsample
+    sigma_col = np.sqrt(max(var_col - smoothing_sigma**2, 0.25)) * downsample
+    center_row = (center_row + 0.5) * downsample - 0.5 + search_y
+    center_col = (center_col + 0.5) * downsample - 0.5 + search_x
+
+    # Pad by n_sigmas in each direction and clip to the image.
+    half_height = max(n_sigmas * sigma_row, min_size / 2)
+    half_width = max(n_sigmas * sigma_col, min_size / 2)
+    y_start = max(int(np.floor(center_row - half_height)), 0)
+    x_start = max(int(np.floor(center_col - half_width)), 0)
+    y_stop = min(int(np.ceil(center_row + half_height)) + 1, image_shape[0])
+    x_stop = min(int(np.ceil(center_col + half_width)) + 1, image_shape[1])
+    roi = (x_start, y_start, x_stop - x_start, y_stop - y_start)
+    return roi
@@ -0,0 +1,380 @@
+"""Classes and functions for calculating statistics one sample at a time.
+
+Averaging many images by first loading all of them into memory uses a lot of
+RAM, and loading them one after another in a loop leaves the CPU idle while
+waiting on file I/O. The RunningStatistics class here instead updates a running
+mean and variance as each sample arrives using Welford's algorithm, which is
+numerically stable and uses a fixed amount of memory however many samples are
+added. average_images() combines that with reading the images from the shot
+files on a thread pool so that the I/O for the next images happens while the
+current one is being added. LineAggregator uses RunningStatistics to keep the
+averaged points of a scan plot up to date as new shots arrive.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import labscript_utils.h5_lock
+import h5py
+import numpy as np
+
+from analysislib.Rydberg.analysis_utils.dataframe_utils import (
+    IncrementalRows, column_values,
+)
+from analysislib.Rydberg.analysis_utils.image_storage import read_image_dataset
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class RunningStatistics(object):
+    """Running mean and variance of scalars or arrays, using Welford's algorithm.
+
+    Samples are accumulated in float64. Nan values in a sample are ignored, so
+    the number of samples can differ from element to element for arrays. The
+    count is therefore tracked per element.
+
+    Attributes:
+        count (np.ndarray or float): The number of finite samples that have been
+            added for each element.
+        mean (np.ndarray or float): The mean of the samples for each element.
+            Elements without any samples have a mean of nan.
+    """
+
+    def __init__(self):
+        self._count = None
+        self._mean = None
+        # The sum of squared deviations from the mean, called M2 by Welford.
+        self._m2 = None
+
+    def add(self, sample):
+        """Add one sample.
+
+        Args:
+            sample (float or np.ndarray): The sample to add. All samples should
+                have the same shape.
+
+        Raises:
+            ValueError: If sample doesn't have the same shape as the previous
+                samples.
+        """
+        sample = np.asarray(sample, dtype=np.float64)
+        if self._count is None:
+            self._count = np.zeros(sample.shape)
+            self._mean = np.zeros(sample.shape)
+            self._m2 = np.zeros(sample.shape)
+        elif sample.shape != self._count.shape:
+            message = (f"Sample has shape {sample.shape} but previous samples "
+                       f"had shape {self._count.shape}.")
+            raise ValueError(message)
+
+        # Only update the elements which are finite.
+        finite = np.isfinite(sample)
+        self._count += finite
+        delta = np.where(finite, sample - self._mean, 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self._mean += np.where(finite, delta / self._count, 0.)
+        self._m2 += np.where(finite, delta * (sample - self._mean), 0.)
+
+    def merge(self, other):
+        """Combine the samples of another RunningStatistics instance into this one.
+
+        This uses the parallel version of the algorithm from Chan et al., so the
+        result is the same as if all of the samples had been added to this
+        instance.
+
+        Args:
+            other (RunningStatistics): The instance whose samples to include.
+        """
+        if other._count is None:
+            return
+        if self._count is None:
+            self._count = other._count.copy()
+            self._mean = other._mean.copy()
+            self._m2 = other._m2.copy()
+            return
+        count = self._count + other._count
+        delta = other._mean - self._mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(count > 0, other._count / count, 0.)
+        self._mean = self._mean + delta * weight
+        self._m2 = self._m2 + other._m2 + delta**2 * self._count * weight
+        self._count = count
+
+    def _result(self, array):
+        # Return python floats for scalar samples, like np.mean() does.
+        if array.ndim == 0:
+            return float(array)
+        return array
+
+    @property
+    def count(self):
+        if self._count is None:
+            return 0
+        return self._result(self._count.copy())
+
+    @property
+    def mean(self):
+        if self._count is None:
+            return np.nan
+        mean = np.where(self._count > 0, self._mean, np.nan)
+        return self._result(mean)
+
+    def variance(self, ddof=1):
+        """Get the variance of the samples.
+
+        Args:
+            ddof (int, optional): (Default = 1) The delta degrees of freedom,
+                as for np.var(). The default gives the sample variance.
+
+        Returns:
+            variance (np.ndarray or float): The variance for each element.
+                Elements with ddof or fewer samples have a variance of nan.
+        """
+        if self._count is None:
+            return np.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = np.where(
+                self._count > ddof, self._m2 / (self._count - ddof), np.nan)
+        return self._result(variance)
+
+    def std(self, ddof=1):
+        """Get the standard deviation of the samples.
+
+        Args:
+            ddof (int, optional): (Default = 1) The delta degrees of freedom,
+                as for np.std().
+
+        Returns:
+            std (np.ndarray or float): The standard deviation for each element.
+        """
+        return np.sqrt(self.variance(ddof=ddof))
+
+    def sem(self, ddof=1):
+        """Get the standard error of the mean of the samples.
+
+        Args:
+            ddof (int, optional): (Default = 1) The delta degrees of freedom
+                used when calculating the standard deviation.
+
+        Returns:
+            sem (np.ndarray or float): The standard error of the mean for each
+                element.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.std(ddof=ddof) / np.sqrt(self.count)
+
+
+class LineAggregator(object):
+    """Incrementally averages a result for each point of the lines of a scan plot.
+
+    Shots are grouped into lines by their values of line_columns, and into
+    points on each line by their value of x_column. A RunningStatistics instance
+    is kept for each point, so each new shot is added in constant time rather
+    than regrouping the whole dataframe. Call update() with the full dataframe
+    each time; only the rows added since the previous call are processed.
+
+    The dataframe is assumed to only grow by appending rows. If that isn't the
+    case, e.g. because shots were removed from Lyse, or if the y values of
+    already processed rows changed, e.g. because the singleshot routines were
+    rerun after changing the ROI, the aggregator starts over from the full
+    dataframe. See dataframe_utils.IncrementalRows.
+
+    Attributes:
+        line_columns (tuple): The columns whose values distinguish lines.
+        x_column (str or tuple): The column giving the x value of each point.
+        y_column (str or tuple): The column with the result to average.
+        n_rows (int): The number of dataframe rows that have been processed.
+    """
+
+    def __init__(self, line_columns, x_column, y_column):
+        """Create a LineAggregator.
+
+        Args:
+            line_columns (list): The columns whose values distinguish lines.
+                Can be empty, in which case all shots are on one line.
+            x_column (str or tuple): The column giving the x value of each
+                point.
+            y_column (str or tuple): The column with the result to average,
+                e.g. ('shot_results', 'atom_number').
+        """
+        self.line_columns = tuple(line_columns)
+        self.x_column = x_column
+        self.y_column = y_column
+        self._rows = IncrementalRows(watched_columns=[y_column])
+        self.reset()
+
+    @property
+    def n_rows(self):
+        """The number of dataframe rows that have been processed."""
+        return self._rows.n_rows
+
+    def reset(self):
+        """Forget all of the processed rows."""
+        self._rows.reset()
+        # Maps line key -> {x value: RunningStatistics}.
+        self._lines = {}
+
+    def settings_match(self, line_columns, x_column, y_column):
+        """Check if this aggregator was created with the given settings."""
+        return (self.line_columns, self.x_column, self.y_column) == \
+            (tuple(line_columns), x_column, y_column)
+
+    def update(self, df):
+        """Add the rows of df which haven't been processed yet.
+
+        Args:
+            df (pd.DataFrame): The dataframe, e.g. from lyse.data(). It must
+                have a 'filepath' column.
+
+        Returns:
+            n_new_rows (int): The number of rows that were added. If the
+                aggregator started over, this is the number of rows in df.
+        """
+        new_rows, restarted = self._rows.update(df)
+        if restarted:
+            self._lines = {}
+        if len(new_rows) == 0:
+            return 0
+        line_values = [column_values(new_rows, column)
+                       for column in self.line_columns]
+        x_values = column_values(new_rows, self.x_column)
+        y_values = column_values(new_rows, self.y_column)
+        for i in range(len(new_rows)):
+            line_key = tuple(values[i] for values in line_values)
+            points = self._lines.setdefault(line_key, {})
+            statistics = points.get(x_values[i])
+            if statistics is None:
+                statistics = points[x_values[i]] = RunningStatistics()
+            statistics.add(y_values[i])
+        return len(new_rows)
+
+    def lines(self, ddof=1):
+        """Get the current data for each line, sorted by x value.
+
+        Args:
+            ddof (int, optional): (Default = 1) The delta degrees of freedom
+                used for the standard deviations.
+
+        Returns:
+            lines (dict): Maps each line's values of line_columns (as a tuple)
+                to a tuple of arrays (x_values, means, stds, counts). The stds
+                are nan for points with only one shot.
+        """
+        lines = {}
+        for line_key, points in self._lines.items():
+            x_values = sorted(points)
+            statistics = [points[x_value] for x_value in x_values]
+            lines[line_key] = (
+                np.array(x_values),
+                np.array([stats.mean for stats in statistics]),
+                np.array([stats.std(ddof=ddof) for stats in statistics]),
+                np.array([stats.count for stats in statistics]),
+            )
+        return lines
+
+
+def stream_datasets(shot_paths, dataset_path, roi=None,
+                    max_workers=DEFAULT_MAX_WORKERS, max_in_flight=None):
+    """Read a dataset from each shot's hdf5 file on a thread pool.
+
+    The datasets are yielded in the same order as shot_paths. At most
+    max_in_flight reads are queued at a time, so only that many arrays are held
+    in memory however many shots there are.
+
+    Args:
+        shot_paths (iterable of str): The paths to the shots' hdf5 files.
+        dataset_path (str): The path to the dataset within each hdf5 file, e.g.
+            'images/basler/CMOT/atoms' or 'shot_results/processed_image'.
+        roi (tuple of ints, optional): (Default = None) If provided, only this
+            region of each dataset is read. It should be given as (x, y, width,
+            height) in the same format as cv2.selectROI().
+        max_workers (int, optional): (Default = DEFAULT_MAX_WORKERS) The maximum
+            number of threads used to read the files.
+        max_in_flight (int, optional): (Default = None) The maximum number of
+            reads that are queued at once. If None, twice max_workers is used.
+
+    Yields:
+        array (np.ndarray): The array from each file, decoded with
+            image_storage.read_image_dataset().
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+
+    def read_dataset(h5_path):
+        with h5py.File(h5_path, 'r') as h5_file:
+            return read_image_dataset(h5_file[dataset_path], roi=roi)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        for h5_path in shot_paths:
+            futures.append(executor.submit(read_dataset, h5_path))
+            if len(futures) >= max_in_flight:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def average_datasets(shot_paths, dataset_path, roi=None,
+                     max_workers=DEFAULT_MAX_WORKERS, max_in_flight=None):
+    """Get the mean, standard deviation, and count of a dataset across shots.
+
+    The datasets are read in parallel by stream_datasets() and accumulated with
+    a RunningStatistics instance, so the memory use doesn't grow with the
+    number of shots.
+
+    Args:
+        shot_paths (iterable of str): The paths to the shots' hdf5 files.
+        dataset_path (str): The path to the dataset within each hdf5 file.
+        roi (tuple of ints, optional): (Default = None) If provided, only this
+            region of each dataset is read and averaged.
+        max_workers (int, optional): (Default = DEFAULT_MAX_WORKERS) The maximum
+            number of threads used to read the files.
+        max_in_flight (int, optional): (Default = None) The maximum number of
+            reads that are queued at once. See stream_datasets().
+
+    Returns:
+        mean (np.ndarray): The per-pixel mean.
+        std (np.ndarray): The per-pixel sample standard deviation. Pixels with
+            fewer than two samples get nan.
+        count (np.ndarray): The per-pixel number of finite samples.
+    """
+    statistics = RunningStatistics()
+    for array in stream_datasets(shot_paths, dataset_path, roi=roi,
+                                 max_workers=max_workers,
+                                 max_in_flight=max_in_flight):
+        statistics.add(array)
+    return statistics.mean, statistics.std(), statistics.count
+
+
+def average_images(shot_paths, orientation, label, frametype, roi=None,
+                   max_workers=DEFAULT_MAX_WORKERS, max_in_flight=None):
+    """Get the mean, standard deviation, and count of a camera image across shots.
+
+    This is the streaming, parallel equivalent of calling
+    run.get_image(orientation, label, frametype) for each shot and averaging
+    the results. The images are converted to float64 before accumulating them,
+    so there is no integer overflow.
+
+    Args:
+        shot_paths (iterable of str): The paths to the shots' hdf5 files.
+        orientation (str): The orientation of the camera, e.g. 'basler'.
+        label (str): The 'name' argument passed to camera.expose() in the
+            labscript, e.g. 'CMOT'.
+        frametype (str): The 'frametype' argument passed to camera.expose() in
+            the labscript, e.g. 'atoms' or 'no_atoms'.
+        roi (tuple of ints, optional): (Default = None) If provided, only this
+            region of each image is read and averaged.
+        max_workers (int, optional): (Default = DEFAULT_MAX_WORKERS) The maximum
+            number of threads used to read the files.
+        max_in_flight (int, optional): (Default = None) The maximum number of
+            reads that are queued at once. See stream_datasets().
+
+    Returns:
+        mean (np.ndarray): The per-pixel mean image.
+        std (np.ndarray): The per-pixel sample standard deviation image.
+        count (np.ndarray): The per-pixel number of finite samples.
+    """
+    dataset_path = f'images/{orientation}/{label}/{frametype}'
+    return average_datasets(
+        shot_paths, dataset_path, roi=roi, max_workers=max_workers,
+        max_in_flight=max_in_flight,
+    )
@@ -0,0 +1,385 @@
+"""Bin the results of two-parameter scans onto a grid and plot color maps.
+
+The points of a two-parameter scan are binned onto a grid whose axes are the
+distinct values of the two scanned globals. All shots with the same pair of
+values fall in the same cell, and the mean, standard deviation, and number of
+shots of each cell are calculated with np.unique() inverse indices and
+np.bincount() reductions rather than a python loop or a dataframe pivot.
+grid_scan() does this for a full set of points at once.
+
+ScanGrid keeps the same statistics up to date as shots arrive. Each call to
+update() only bins the dataframe rows added since the previous call, and merges
+their statistics into the existing cells, so each shot is added in constant
+time. ScanGridPlot draws a ScanGrid with pcolormesh() and, when no new scan
+values have appeared, only writes the cells that changed into the existing
+mesh instead of creating a new one, so the plot stays responsive for large
+scans (e.g. 100x100 points with repeats).
+
+Example Usage:
+```
+scan_grid = ScanGrid('x_global', 'y_global', ('shot_results', 'atom_number'))
+scan_plot = ScanGridPlot(xlabel='x_global', ylabel='y_global')
+changed_cells = scan_grid.update(df)
+scan_plot.update(scan_grid, changed_cells)
+```
+"""
+import matplotlib.pyplot as plt
+import numpy as np
+
+from analysislib.Rydberg.analysis_utils.dataframe_utils import (
+    IncrementalRows, column_values,
+)
+
+
+def _cell_statistics(flat_indices, values, n_cells):
+    """Get the count, mean, and M2 of the values in each cell with np.bincount.
+
+    M2 is the sum of squared deviations from the mean, as used by Welford's
+    algorithm. Cells without any values get a mean of 0.
+    """
+    counts = np.bincount(flat_indices, minlength=n_cells)
+    sums = np.bincount(flat_indices, weights=values, minlength=n_cells)
+    means = np.zeros(n_cells)
+    np.divide(sums, counts, out=means, where=counts > 0)
+    # Use a second pass for the deviations, which is more accurate than
+    # accumulating sums of squares.
+    deviations = values - means[flat_indices]
+    m2 = np.bincount(flat_indices, weights=deviations**2, minlength=n_cells)
+    return counts, means, m2
+
+
+def _cell_std(counts, m2, ddof):
+    std = np.full(np.shape(counts), np.nan)
+    np.sqrt(m2 / np.maximum(counts - ddof, 1), out=std, where=counts > ddof)
+    return std
+
+
+def grid_scan(x_values, y_values, z_values, ddof=1):
+    """Bin scan points onto a grid of their distinct x and y values.
+
+    Points with a non-finite z value are ignored.
+
+    Args:
+        x_values (array-like): The x value (e.g. the first scanned global) of
+            each point.
+        y_values (array-like): The y value (e.g. the second scanned global) of
+            each point.
+        z_values (array-like): The result of each point, e.g. the atom number.
+        ddof (int, optional): (Default = 1) The delta degrees of freedom used
+            for the standard deviations.
+
+    Returns:
+        x_axis (np.ndarray): The sorted distinct x values.
+        y_axis (np.ndarray): The sorted distinct y values.
+        mean (np.ndarray): The mean of the points in each cell, with shape
+            (len(y_axis), len(x_axis)). Empty cells are nan.
+        std (np.ndarray): The standard deviation of the points in each cell.
+            Cells with ddof or fewer points are nan.
+        count (np.ndarray): The number of points in each cell.
+    """
+    z_values = np.asarray(z_values, dtype=float)
+    finite = np.isfinite(z_values)
+    x_axis, x_indices = np.unique(np.asarray(x_values)[finite],
+                                  return_inverse=True)
+    y_axis, y_indices = np.unique(np.asarray(y_values)[finite],
+                                  return_inverse=True)
+    shape = (len(y_axis), len(x_axis))
+    flat_indices = np.ravel_multi_index((y_indices, x_indices), shape)
+    counts, means, m2 = _cell_statistics(
+        flat_indices, z_values[finite], shape[0] * shape[1])
+
+    means[counts == 0] = np.nan
+    std = _cell_std(counts, m2, ddof)
+    return (x_axis, y_axis, means.reshape(shape), std.reshape(shape),
+            counts.reshape(shape))
+
+
+class ScanGrid(object):
+    """Incrementally bins a result of a two-parameter scan onto a grid.
+
+    The statistics of each cell are stored in the order that the scan values
+    first appeared, so that new values can be added without moving the existing
+    cells. grid() returns them sorted by the scan values. Call update() with the
+    full dataframe each time; only the rows added since the previous call are
+    processed.
+
+    The dataframe is assumed to only grow by appending rows. If that isn't the
+    case, e.g. because shots were removed from Lyse, or if the z values of
+    already processed rows changed, e.g. because the singleshot routines were
+    rerun after changing the ROI, the grid starts over from the full dataframe.
+    See dataframe_utils.IncrementalRows.
+
+    Attributes:
+        x_column (str or tuple): The column giving the x value of each shot.
+        y_column (str or tuple): The column giving the y value of each shot.
+        z_column (str or tuple): The column with the result to average.
+        n_rows (int): The number of dataframe rows that have been processed.
+    """
+
+    def __init__(self, x_column, y_column, z_column):
+        """Create a ScanGrid.
+
+        Args:
+            x_column (str or tuple): The column giving the x value of each shot,
+                e.g. the first scanned global.
+            y_column (str or tuple): The column giving the y value of each shot.
+            z_column (str or tuple): The column with the result to average,
+                e.g. ('shot_results', 'atom_number').
+        """
+        self.x_column = x_column
+        self.y_column = y_column
+        self.z_column = z_column
+        self._rows = IncrementalRows(watched_columns=[z_column])
+        self.reset()
+
+    @property
+    def n_rows(self):
+        """The number of dataframe rows that have been processed."""
+        return self._rows.n_rows
+
+    def reset(self):
+        """Forget all of the processed rows."""
+        self._rows.reset()
+        self._clear_cells()
+
+    def _clear_cells(self):
+        # Map each scan value to its index along the axis, in the order the
+        # values first appeared.
+        self._x_lookup = {}
+        self._y_lookup = {}
+        self._counts = np.zeros((0, 0), dtype=int)
+        self._means = np.zeros((0, 0))
+        self._m2 = np.zeros((0, 0))
+
+    def settings_match(self, x_column, y_column, z_column):
+        """Check if this grid was created with the given settings."""
+        return (self.x_column, self.y_column, self.z_column) == \
+            (x_column, y_column, z_column)
+
+    @property
+    def shape(self):
+        """The shape of the grid: (number of y values, number of x values)."""
+        return self._counts.shape
+
+    @staticmethod
+    def _axis_indices(lookup, values):
+        # Look up each distinct value once rather than once per shot.
+        distinct_values, inverse = np.unique(values, return_inverse=True)
+        indices = np.array([lookup.setdefault(value, len(lookup))
+                            for value in distinct_values.tolist()], dtype=int)
+        return indices[inverse]
+
+    def add(self, x_values, y_values, z_values):
+        """Add scan points to the grid.
+
+        Points with a non-finite z value are ignored.
+
+        Args:
+            x_values (array-like): The x value of each point.
+            y_values (array-like): The y value of each point.
+            z_values (array-like): The result of each point.
+
+        Returns:
+            changed_cells (tuple of np.ndarray): The (row, column) indices of
+                the cells that changed, in the storage order used by
+                cell_means() and ScanGridPlot.update().
+        """
+        z_values = np.asarray(z_values, dtype=float)
+        finite = np.isfinite(z_values)
+        x_indices = self._axis_indices(
+            self._x_lookup, np.asarray(x_values)[finite])
+        y_indices = self._axis_indices(
+            self._y_lookup, np.asarray(y_values)[finite])
+
+        # Grow the arrays if new scan values appeared.
+        shape = (len(self._y_lookup), len(self._x_lookup))
+        if shape != self._counts.shape:
+            padding = ((0, shape[0] - self._counts.shape[0]),
+                       (0, shape[1] - self._counts.shape[1]))
+            self._counts = np.pad(self._counts, padding)
+            self._means = np.pad(self._means, padding)
+            self._m2 = np.pad(self._m2, padding)
+
+        # Calculate the statistics of the new points in each cell, then merge
+        # them into the changed cells using Chan et al.'s formula for combining
+        # the mean and M2 of two sets of samples.
+        flat_indices = np.ravel_multi_index((y_indices, x_indices), shape)
+        batch_counts, batch_means, batch_m2 = _cell_statistics(
+            flat_indices, z_values[finite], shape[0] * shape[1])
+        changed = np.flatnonzero(batch_counts)
+        counts = self._counts.reshape(-1)
+        means = self._means.reshape(-1)
+        m2 = self._m2.reshape(-1)
+        count_a = counts[changed]
+        count_b = batch_counts[changed]
+        total = count_a + count_b
+        delta = batch_means[changed] - means[changed]
+        means[changed] += delta * count_b / total
+        m2[changed] += batch_m2[changed] + delta**2 * count_a * count_b / total
+        counts[changed] = total
+        return np.unravel_index(changed, shape)
+
+    def update(self, df):
+        """Add the rows of df which haven't been processed yet.
+
+        Args:
+            df (pd.DataFrame): The dataframe, e.g. from lyse.data(). It must
+                have a 'filepath' column.
+
+        Returns:
+            changed_cells (tuple of np.ndarray or None): The (row, column)
+                indices of the cells that changed, as from add(). None if the
+                grid started over, in which case all of the cells should be
+                considered changed.
+        """
+        new_rows, restarted = self._rows.update(df)
+        if restarted:
+            self._clear_cells()
+        if len(new_rows) == 0:
+            return None if restarted else (np.zeros(0, dtype=int),) * 2
+        changed_cells = self.add(
+            column_values(new_rows, self.x_column),
+            column_values(new_rows, self.y_column),
+            column_values(new_rows, self.z_column),
+        )
+        return None if restarted else changed_cells
+
+    def axes(self):
+        """Get the scan values along each axis, in storage order.
+
+        Returns:
+            x_values (np.ndarray): The x value of each column.
+            y_values (np.ndarray): The y value of each row.
+        """
+        return np.array(list(self._x_lookup)), np.array(list(self._y_lookup))
+
+    def cell_means(self, rows, columns):
+        """Get the means of some cells in storage order. Empty cells are nan."""
+        means = self._means[rows, columns].copy()
+        means[self._counts[rows, columns] == 0] = np.nan
+        return means
+
+    def grid(self, ddof=1):
+        """Get the statistics of all of the cells, sorted by the scan values.
+
+        Args:
+            ddof (int, optional): (Default = 1) The delta degrees of freedom
+                used for the standard deviations.
+
+        Returns:
+            The same as grid_scan(): x_axis, y_axis, mean, std, and count.
+        """
+        x_values, y_values = self.axes()
+        x_order = np.argsort(x_values, kind='stable')
+        y_order = np.argsort(y_values, kind='stable')
+        cells = np.ix_(y_order, x_order)
+        counts = self._counts[cells]
+        means = self._means[cells].copy()
+        means[counts == 0] = np.nan
+        std = _cell_std(counts, self._m2[cells], ddof)
+        return x_values[x_order], y_values[y_order], means, std, counts
+
+
+def _cell_edges(centers):
+    """Get the edges of cells centered on sorted values, for pcolormesh()."""
+    centers = np.asarray(centers, dtype=float)
+    if len(centers) == 1:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+    midpoints = (centers[1:] + centers[:-1]) / 2
+    first = 2 * centers[0] - midpoints[0]
+    last = 2 * centers[-1] - midpoints[-1]
+    return np.concatenate(([first], midpoints, [last]))
+
+
+class ScanGridPlot(object):
+    """A color map of a ScanGrid which only updates the cells that changed.
+
+    The figure, mesh, and colorbar are created once. While the scan values stay
+    the same, update() only writes the changed cells into the mesh's data. When
+    new scan values appear the mesh is recreated, since its cell edges change.
+
+    Attributes:
+        fig (matplotlib.figure.Figure): The figure.
+        axes (matplotlib.axes.Axes): The axes with the color map.
+        mesh (matplotlib.collections.QuadMesh): The color map, or None before
+            the first update.
+        n_rebuilds (int): The number of times that the mesh has been created.
+    """
+
+    def __init__(self, figsize=None, cmap='viridis', xlabel='', ylabel='',
+                 colorbar_label='', title=''):
+        """Create the figure.
+
+        Args:
+            figsize (tuple of floats, optional): (Default = None) The size of
+                the figure, passed to plt.figure().
+            cmap (str, optional): (Default = 'viridis') The name of the
+                colormap.
+            xlabel (str, optional): (Default = '') The label of the x-axis.
+            ylabel (str, optional): (Default = '') The label of the y-axis.
+            colorbar_label (str, optional): (Default = '') The label of the
+                colorbar.
+            title (str, optional): (Default = '') The title of the axes.
+        """
+        self.cmap = cmap
+        self.colorbar_label = colorbar_label
+        # The layout is only recalculated when the mesh is recreated, rather
+        # than on every draw as with constrained_layout, since that takes longer
+        # than drawing the mesh itself.
+        self.fig = plt.figure(figsize=figsize)
+        self.axes = self.fig.add_subplot(111)
+        self.axes.set_xlabel(xlabel)
+        self.axes.set_ylabel(ylabel)
+        self.axes.set_title(title)
+        self.mesh = None
+        self.colorbar = None
+        self.n_rebuilds = 0
+        self._image = None
+        # The sorted position of each row and column in the grid's storage
+        # order.
+        self._row_positions = None
+        self._column_positions = None
+
+    def _rebuild(self, scan_grid):
+        x_axis, y_axis, means, _, _ = scan_grid.grid()
+        x_values, y_values = scan_grid.axes()
+        self._column_positions = np.argsort(np.argsort(x_values, kind='stable'))
+        self._row_positions = np.argsort(np.argsort(y_values, kind='stable'))
+        self._image = np.ma.masked_invalid(means)
+
+        if self.mesh is not None:
+            self.mesh.remove()
+        self.mesh = self.axes.pcolormesh(
+            _cell_edges(x_axis), _cell_edges(y_axis), self._image,
+            cmap=self.cmap, shading='flat',
+        )
+        if self.colorbar is None:
+            self.colorbar = self.fig.colorbar(self.mesh, ax=self.axes)
+            self.colorbar.set_label(self.colorbar_label)
+        else:
+            self.colorbar.update_normal(self.mesh)
+        self.fig.tight_layout()
+        self.n_rebuilds += 1
+
+    def update(self, scan_grid, changed_cells=None):
+        """Update the plot from a ScanGrid.
+
+        Args:
+            scan_grid (ScanGrid): The grid to plot.
+            changed_cells (tuple of np.ndarray, optional): (Default = None) The
+                (row, column) indices of the cells that changed, as returned by
+                ScanGrid.update(). If None, the whole plot is redrawn.
+        """
+        if self.mesh is None or changed_cells is None or \
+                scan_grid.shape != self._image.shape:
+            self._rebuild(scan_grid)
+        else:
+            rows, columns = changed_cells
+            self._image[self._row_positions[rows],
+                        self._column_positions[columns]] = np.ma.masked_invalid(
+                scan_grid.cell_means(rows, columns))
+            self.mesh.set_array(self._image)
+
+        if self._image.count():
+            self.mesh.set_clim(self._image.min(), self._image.max())
+        self.fig.canvas.draw_idle()
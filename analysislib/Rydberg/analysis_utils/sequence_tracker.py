@@ -0,0 +1,470 @@
+"""Track which sequences have had all of their shots analyzed.
+
+Multishot routines usually only have work to do once every shot from a call to
+engage() in runmanager (a sequence) has run and been through the singleshot
+routines. Checking that by looking through the dataframe every time the routine
+runs is wasted work for every shot but the last. A SequenceTracker instead
+records, for each sequence, how many shots are expected and which shots have
+finished their singleshot routines, updating that in constant time as each shot
+arrives. Multishot routines can then claim each completed sequence once with
+claim_completed(), and code running in other threads can block until a sequence
+is complete with wait_for_sequence() or be called back with subscribe().
+
+A shot counts as finished once the mark_shot_finished.py singleshot routine has
+saved its result, so that routine should be the last one in Lyse's list of
+singleshot routines. If its result isn't in the dataframe, e.g. in a Lyse setup
+that doesn't use that routine, a warning is issued and the tracker falls back to
+checking each unfinished sequence with check_all_shots_run() and
+check_all_singleshot_run() from multishot_utils.py, as the multishot routines
+did before. The expected number of shots in a sequence is read from the 'n_runs'
+attribute of the root group of the first of its shot files.
+
+Example Usage:
+```
+tracker = get_sequence_tracker()
+tracker.update_from_dataframe(lyse.data())
+for sequence_key in tracker.claim_completed('my_multishot_routine'):
+    shot_paths = tracker.finished_shots(sequence_key)
+```
+"""
+import threading
+import warnings
+
+import labscript_utils.h5_lock
+import h5py
+import numpy as np
+
+from lyse import routine_storage
+
+from analysislib.RbLab.lib.multishot_utils import (
+    check_all_shots_run, check_all_singleshot_run,
+)
+from analysislib.Rydberg.analysis_utils.dataframe_utils import column_values
+
+# The result saved by mark_shot_finished.py, as a dataframe column.
+FINISHED_RESULT_NAME = 'singleshot_finished'
+FINISHED_COLUMN = ('mark_shot_finished', FINISHED_RESULT_NAME)
+# The dataframe columns that identify a sequence.
+SEQUENCE_COLUMNS = ('sequence', 'sequence_index')
+
+
+def read_n_runs(h5_path):
+    """Read the number of shots in a shot's sequence from its hdf5 file.
+
+    Returns:
+        n_runs (int or None): The number of shots, or None if the file doesn't
+            record it.
+    """
+    with h5py.File(h5_path, 'r') as h5_file:
+        n_runs = h5_file.attrs.get('n_runs', None)
+    return None if n_runs is None else int(n_runs)
+
+
+def _is_set(value):
+    # Values that haven't been saved yet show up as nan (or None) in the
+    # dataframe.
+    if value is None:
+        return False
+    try:
+        return not np.isnan(value)
+    except TypeError:
+        return True
+
+
+class _SequenceState(object):
+    __slots__ = ('expected', 'shots', 'finished', 'complete')
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.shots = set()
+        self.finished = set()
+        self.complete = False
+
+
+class SequenceTracker(object):
+    """Records the progress of each sequence and signals when it's complete.
+
+    Sequences are identified by a hashable key, which is a tuple of the values
+    of SEQUENCE_COLUMNS when the tracker is updated from the dataframe. All
+    methods are thread safe. Subscribers are called after the tracker's lock is
+    released, so they can use the tracker, including from other threads.
+
+    Attributes:
+        n_rows (int): The number of dataframe rows that update_from_dataframe()
+            has processed.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._subscribers = []
+        # Maps consumer name -> the set of sequence keys it has claimed. This
+        # isn't cleared by reset() so that sequences aren't claimed twice.
+        self._claimed = {}
+        self.reset()
+
+    def reset(self):
+        """Forget all sequences, e.g. after shots were removed from Lyse."""
+        with self._condition:
+            # Maps sequence key -> _SequenceState.
+            self._sequences = {}
+            # The keys of the completed sequences, in the order they completed.
+            self._completed = []
+            # Maps consumer name -> how many of self._completed it has looked
+            # at.
+            self._n_checked = {}
+            self.n_rows = 0
+            self._last_filepath = None
+            # Maps the filepath of each row that isn't finished yet to its
+            # (row position, sequence key).
+            self._pending_rows = {}
+
+    def shot_arrived(self, h5_path, sequence_key, expected=None):
+        """Record that a shot of a sequence has run.
+
+        Args:
+            h5_path (str): The path of the shot's hdf5 file.
+            sequence_key (hashable): Identifies the shot's sequence.
+            expected (int, optional): (Default = None) The number of shots in
+                the sequence. Only used the first time a sequence is seen. If
+                None, it's read from the 'n_runs' attribute of h5_path.
+        """
+        with self._condition:
+            self._get_state(h5_path, sequence_key, expected).shots.add(h5_path)
+
+    def shot_finished(self, h5_path, sequence_key, expected=None):
+        """Record that the singleshot routines have finished for a shot.
+
+        Args:
+            h5_path (str): The path of the shot's hdf5 file.
+            sequence_key (hashable): Identifies the shot's sequence.
+            expected (int, optional): (Default = None) The number of shots in
+                the sequence. Only used the first time a sequence is seen. If
+                None, it's read from the 'n_runs' attribute of h5_path.
+
+        Returns:
+            completed (bool): Whether this shot completed its sequence.
+        """
+        with self._condition:
+            completion = self._mark_finished(h5_path, sequence_key, expected)
+        if completion is None:
+            return False
+        self._notify_subscribers([completion])
+        return True
+
+    def _mark_finished(self, h5_path, sequence_key, expected=None):
+        # Record a finished shot. The caller must hold the lock. If this
+        # completes the sequence, (sequence_key, shot_paths) is returned for the
+        # caller to pass to _notify_subscribers() once it has released the lock.
+        state = self._get_state(h5_path, sequence_key, expected)
+        state.shots.add(h5_path)
+        state.finished.add(h5_path)
+        if state.complete or state.expected is None or \
+                len(state.finished) < state.expected:
+            return None
+        state.complete = True
+        self._completed.append(sequence_key)
+        self._condition.notify_all()
+        return sequence_key, sorted(state.finished)
+
+    def _notify_subscribers(self, completions):
+        # Call the subscribers without holding the lock, so that a subscriber
+        # which waits on another thread that uses the tracker can't deadlock.
+        with self._condition:
+            subscribers = list(self._subscribers)
+        for sequence_key, shot_paths in completions:
+            for callback in subscribers:
+                callback(sequence_key, shot_paths)
+
+    def _get_state(self, h5_path, sequence_key, expected):
+        state = self._sequences.get(sequence_key)
+        if state is None:
+            if expected is None:
+                expected = read_n_runs(h5_path)
+            state = self._sequences[sequence_key] = _SequenceState(expected)
+        return state
+
+    def update_from_dataframe(self, df, finished_column=FINISHED_COLUMN,
+                              sequence_columns=SEQUENCE_COLUMNS):
+        """Update the tracker from the Lyse dataframe.
+
+        Only the rows added since the previous call, and the earlier rows whose
+        shots hadn't finished yet, are looked at, so this takes time
+        proportional to the number of new and in-progress shots rather than the
+        size of the dataframe. The dataframe is assumed to only grow by
+        appending rows. If that isn't the case, the tracker starts over.
+
+        Args:
+            df (pd.DataFrame): The dataframe, e.g. from lyse.data(). It must
+                have a 'filepath' column.
+            finished_column (str or tuple, optional): (Default =
+                FINISHED_COLUMN) The column which is set once a shot's
+                singleshot routines have finished. If df doesn't have it, each
+                sequence with unfinished shots is checked with
+                check_all_shots_run() and check_all_singleshot_run() instead.
+            sequence_columns (tuple, optional): (Default = SEQUENCE_COLUMNS) The
+                columns which identify a shot's sequence.
+
+        Returns:
+            completed (list): The keys of the sequences that were completed by
+                this update.
+        """
+        with self._condition:
+            if len(df) < self.n_rows or (
+                    self.n_rows and
+                    df['filepath'].iloc[self.n_rows - 1] != self._last_filepath):
+                self.reset()
+
+            # Record the new rows as pending.
+            new_rows = df.iloc[self.n_rows:]
+            if len(new_rows):
+                filepaths = column_values(new_rows, 'filepath')
+                sequence_values = [
+                    column_values(new_rows, column)
+                    for column in sequence_columns if column in df
+                ]
+                for i, h5_path in enumerate(filepaths):
+                    sequence_key = tuple(values[i] for values in sequence_values)
+                    self.shot_arrived(h5_path, sequence_key)
+                    self._pending_rows[h5_path] = (self.n_rows + i, sequence_key)
+                self.n_rows = len(df)
+                self._last_filepath = filepaths[-1]
+
+            # Check which of the pending rows have finished.
+            if not self._pending_rows:
+                return []
+            if finished_column in df:
+                finished_rows = self._finished_rows(df, finished_column)
+            else:
+                warnings.warn(
+                    f"The dataframe has no {finished_column} column, so "
+                    "sequences are checked with check_all_shots_run() and "
+                    "check_all_singleshot_run() instead. Make sure that "
+                    "mark_shot_finished.py is checked and is the last of the "
+                    "singleshot routines.")
+                finished_rows = self._finished_rows_without_column(df)
+            completions = []
+            for h5_path, sequence_key in finished_rows:
+                del self._pending_rows[h5_path]
+                completion = self._mark_finished(h5_path, sequence_key)
+                if completion is not None:
+                    completions.append(completion)
+        self._notify_subscribers(completions)
+        return [sequence_key for sequence_key, _ in completions]
+
+    def _finished_rows(self, df, finished_column):
+        # Get the (h5_path, sequence_key) of the pending rows whose
+        # finished_column is set.
+        pending = list(self._pending_rows.items())
+        positions = [position for _, (position, _) in pending]
+        finished_values = column_values(df.iloc[positions], finished_column)
+        return [(h5_path, sequence_key)
+                for (h5_path, (_, sequence_key)), value in zip(pending,
+                                                               finished_values)
+                if _is_set(value)]
+
+    def _finished_rows_without_column(self, df):
+        # Without the finished column, shots are only marked finished a whole
+        # sequence at a time, so all of the rows of an unfinished sequence are
+        # still pending. Check each of those sequences the way the multishot
+        # routines did before the tracker existed.
+        rows_by_sequence = {}
+        for h5_path, (position, sequence_key) in self._pending_rows.items():
+            rows_by_sequence.setdefault(sequence_key, []).append(
+                (position, h5_path))
+        finished_rows = []
+        for sequence_key, rows in rows_by_sequence.items():
+            rows.sort()
+            df_subset = df.iloc[[position for position, _ in rows]]
+            if not (check_all_shots_run(df_subset) and
+                    check_all_singleshot_run(df_subset)):
+                continue
+            # The old checks decide when the sequence is complete, so it
+            # completes with all of these shots, whatever n_runs says.
+            self._sequences[sequence_key].expected = len(rows)
+            finished_rows.extend((h5_path, sequence_key) for _, h5_path in rows)
+        return finished_rows
+
+    def is_complete(self, sequence_key):
+        """Check whether all of the shots of a sequence have finished."""
+        with self._condition:
+            state = self._sequences.get(sequence_key)
+            return state is not None and state.complete
+
+    def progress(self, sequence_key):
+        """Get how many shots of a sequence have finished.
+
+        Returns:
+            n_finished (int): The number of shots that have finished.
+            expected (int or None): The number of shots in the sequence, or None
+                if it isn't known.
+        """
+        with self._condition:
+            state = self._sequences.get(sequence_key)
+            if state is None:
+                return 0, None
+            return len(state.finished), state.expected
+
+    def finished_shots(self, sequence_key):
+        """Get the sorted paths of the finished shots of a sequence."""
+        with self._condition:
+            state = self._sequences.get(sequence_key)
+            return [] if state is None else sorted(state.finished)
+
+    @property
+    def n_pending(self):
+        """The number of shots whose singleshot routines haven't finished."""
+        with self._condition:
+            return len(self._pending_rows)
+
+    @property
+    def latest_sequence(self):
+        """The key of the sequence that the most recent shot belongs to."""
+        with self._condition:
+            if not self._sequences:
+                return None
+            # Dictionaries keep insertion order, so the last key is the newest.
+            return next(reversed(self._sequences))
+
+    def claim_completed(self, consumer):
+        """Get the completed sequences that consumer hasn't claimed yet.
+
+        Each consumer, e.g. a multishot routine, gets each completed sequence
+        exactly once, so it can do its work once per sequence. That includes
+        after the tracker is reset.
+
+        Args:
+            consumer (str): A name identifying the consumer.
+
+        Returns:
+            sequence_keys (list): The newly completed sequences, in the order
+                they completed.
+        """
+        with self._condition:
+            claimed = self._claimed.setdefault(consumer, set())
+            n_checked = self._n_checked.get(consumer, 0)
+            self._n_checked[consumer] = len(self._completed)
+            sequence_keys = [sequence_key
+                             for sequence_key in self._completed[n_checked:]
+                             if sequence_key not in claimed]
+            claimed.update(sequence_keys)
+            return sequence_keys
+
+    def wait_for_sequence(self, sequence_key, timeout=None):
+        """Block until a sequence is complete.
+
+        The tracker has to be updated from another thread for this to return
+        before timeout.
+
+        Args:
+            sequence_key (hashable): The sequence to wait for.
+            timeout (float, optional): (Default = None) The maximum time, in
+                seconds, to wait. If None, wait as long as necessary.
+
+        Returns:
+            complete (bool): Whether the sequence is complete.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.is_complete(sequence_key), timeout)
+
+    def subscribe(self, callback):
+        """Call callback(sequence_key, shot_paths) whenever a sequence completes.
+
+        The callback is called from whichever thread completes the sequence.
+        """
+        with self._condition:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop calling a callback passed to subscribe()."""
+        with self._condition:
+            self._subscribers.remove(callback)
+
+
+def get_sequence_tracker():
+    """Get the SequenceTracker kept in Lyse's routine_storage.
+
+    It's created the first time this is called.
+
+    Each Lyse routine runs in its own worker process with its own
+    routine_storage, so each multishot routine has its own tracker, which only
+    it updates. Use a different consumer name for each routine anyway, so that
+    they can also share a tracker passed in explicitly.
+    """
+    if not hasattr(routine_storage, 'sequence_tracker'):
+        routine_storage.sequence_tracker = SequenceTracker()
+    return routine_storage.sequence_tracker
+
+
+def claim_latest_sequence(df, consumer, tracker=None, rerun_if_unchanged=True):
+    """Claim the latest sequence for a multishot routine once it's complete.
+
+    This replaces checking every shot of the latest sequence each time a
+    multishot routine runs. The tracker is updated from df, and if the latest
+    sequence is complete and consumer hasn't claimed it yet, the rows for its
+    shots are returned. Otherwise None is returned, so the routine can skip its
+    work until the sequence completes, and then do it once.
+
+    Lyse runs the multishot routines by itself after new shots have been
+    through the singleshot routines. If df has no new rows or newly finished
+    shots, the routine was instead started by clicking "Run multishot analysis",
+    or after rerunning the singleshot routines on shots already in Lyse. In that
+    case the latest sequence is returned again by default if it's complete, even
+    though it was already claimed, so that clicking the button always does the
+    analysis.
+
+    Args:
+        df (pd.DataFrame): The Lyse dataframe, e.g. from lyse.data().
+        consumer (str): A name identifying the multishot routine.
+        tracker (SequenceTracker, optional): (Default = None) The tracker to
+            use. If None, the one from get_sequence_tracker() is used.
+        rerun_if_unchanged (bool, optional): (Default = True) Whether to return
+            the latest sequence again if it's complete and df has no new rows
+            or newly finished shots since the previous call.
+
+    Returns:
+        df_subset (pd.DataFrame or None): The rows of df for the shots of the
+            latest sequence, or None if there's no new completed sequence and
+            the routine wasn't run again by hand.
+    """
+    if tracker is None:
+        tracker = get_sequence_tracker()
+    n_rows = tracker.n_rows
+    n_pending = tracker.n_pending
+    tracker.update_from_dataframe(df)
+    unchanged = tracker.n_rows == n_rows and tracker.n_pending == n_pending
+    # Always claim, so that sequences completed before a rerun by hand aren't
+    # returned again later.
+    newly_completed = tracker.claim_completed(consumer)
+    latest_sequence = tracker.latest_sequence
+    if latest_sequence is None or not tracker.is_complete(latest_sequence):
+        return None
+    rerun = rerun_if_unchanged and unchanged and n_rows > 0
+    if latest_sequence not in newly_completed and not rerun:
+        return None
+    shot_paths = tracker.finished_shots(latest_sequence)
+    return df[df['filepath'].isin(shot_paths)]
+
+
+def describe_latest_sequence(tracker=None):
+    """Describe the progress of the latest sequence, e.g. for printing.
+
+    Args:
+        tracker (SequenceTracker, optional): (Default = None) The tracker to
+            use. If None, the one from get_sequence_tracker() is used.
+
+    Returns:
+        description (str): A short description of the progress.
+    """
+    if tracker is None:
+        tracker = get_sequence_tracker()
+    latest_sequence = tracker.latest_sequence
+    if latest_sequence is None:
+        return "No shots have run yet."
+    if tracker.is_complete(latest_sequence):
+        return "The latest sequence has already been analyzed."
+    n_finished, expected = tracker.progress(latest_sequence)
+    if expected is None:
+        expected = 'an unknown number of'
+    return (f"{n_finished} of {expected} shots of the latest sequence have "
+            "finished their singleshot routines.")
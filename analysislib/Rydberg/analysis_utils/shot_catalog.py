@@ -0,0 +1,589 @@
+"""A persistent SQLite catalog of shot metadata for fast shot selection.
+
+Finding which shots are compatible with each other, e.g. which shots have the
+same camera ROI for use as beam images, usually means globbing for files and
+then opening every one of them to check its attributes. That takes a long time
+once there are thousands of shots. The ShotCatalog class here instead keeps an
+index of each shot's metadata in an SQLite database, typically stored in the
+data directory next to the shots. The catalog records each shot's path,
+modification time, camera ROIs, image shapes, sequence, run number, and its
+scalar globals and results.
+
+Updating the catalog only opens files which are new or whose modification time
+changed since they were last indexed, and those files are read in parallel on a
+thread pool. Queries are then answered from the database's indices without
+opening any hdf5 files, so e.g. selecting all of the shots with a given ROI from
+the last week takes milliseconds.
+
+Example Usage:
+```
+catalog = ShotCatalog(default_catalog_path(data_directory))
+catalog.update([os.path.join(data_directory, '**', '*.h5')])
+one_week_ago = datetime.datetime.now() - datetime.timedelta(days=7)
+paths = catalog.query(roi=desired_roi, orientation='camera', since=one_week_ago)
+```
+"""
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from fnmatch import fnmatch
+import glob
+import json
+import math
+import os
+import sqlite3
+
+import labscript_utils.h5_lock
+import h5py
+import numpy as np
+
+from analysislib.Rydberg.analysis_utils.shot_table import convert_attribute
+from labscript_utils.connections import _ensure_str
+from labscript_utils.properties import get_attribute
+from lyse.dataframe_utilities import asdatetime
+
+CATALOG_FILE_NAME = 'shot_catalog.sqlite'
+DEFAULT_MAX_WORKERS = 8
+# The default relative tolerance used when comparing floats, which is the same
+# as the default for math.isclose().
+DEFAULT_REL_TOL = 1e-9
+# Sequence times are stored in UTC with this fixed-width format, so that
+# comparing them as strings in SQL gives the same order as comparing the times.
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Increment this when the way values are stored changes, and add a migration to
+# ShotCatalog._migrate(). Version 1 stores sequence times with TIME_FORMAT.
+_SCHEMA_VERSION = 2
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shots (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    sequence_id TEXT,
+    sequence_time TEXT,
+    sequence_index INTEGER,
+    labscript TEXT,
+    run_number INTEGER,
+    run_repeat INTEGER
+);
+CREATE INDEX IF NOT EXISTS shots_sequence_time ON shots (sequence_time);
+CREATE INDEX IF NOT EXISTS shots_sequence_id ON shots (sequence_id);
+CREATE TABLE IF NOT EXISTS rois (
+    path TEXT NOT NULL,
+    orientation TEXT NOT NULL,
+    roi TEXT NOT NULL,
+    PRIMARY KEY (path, orientation)
+);
+CREATE INDEX IF NOT EXISTS rois_roi ON rois (roi, orientation);
+CREATE TABLE IF NOT EXISTS image_shapes (
+    path TEXT NOT NULL,
+    orientation TEXT NOT NULL,
+    label TEXT NOT NULL,
+    frametype TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    PRIMARY KEY (path, orientation, label, frametype)
+);
+CREATE TABLE IF NOT EXISTS shot_globals (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (path, name)
+);
+CREATE INDEX IF NOT EXISTS shot_globals_name_value ON shot_globals (name, value);
+CREATE TABLE IF NOT EXISTS shot_results (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (path, name)
+);
+CREATE INDEX IF NOT EXISTS shot_results_name_value ON shot_results (name, value);
+"""
+_PER_SHOT_TABLES = ('shots', 'rois', 'image_shapes', 'shot_globals',
+                    'shot_results')
+
+
+def default_catalog_path(data_directory):
+    """Get the default path of the catalog for a data directory.
+
+    Args:
+        data_directory (str): The directory containing the shot files.
+
+    Returns:
+        catalog_path (str): The path of the catalog's SQLite database file.
+    """
+    return os.path.join(data_directory, CATALOG_FILE_NAME)
+
+
+def roi_key(roi):
+    """Convert an ROI into a string that can be stored and compared in SQL.
+
+    Camera ROIs are usually dictionaries with the keys 'offsetX', 'offsetY',
+    'width', and 'height', but ROIs given as sequences (e.g. a row of the Lyse
+    dataframe or an (x, y, width, height) tuple) are also supported.
+
+    Args:
+        roi (dict or sequence): The ROI.
+
+    Returns:
+        key (str): A JSON string representation of the ROI, with dictionary keys
+            sorted so that equal ROIs always give the same string.
+    """
+    if isinstance(roi, dict):
+        roi = {str(key): _sql_value(value) for key, value in roi.items()}
+    else:
+        roi = [_sql_value(value) for value in np.asarray(roi).ravel()]
+    return json.dumps(roi, sort_keys=True)
+
+
+def _sql_value(value):
+    """Convert a value to a type that SQLite can store, or return None.
+
+    Non-scalar values such as arrays can't be indexed sensibly, so None is
+    returned for them.
+    """
+    value = convert_attribute(value)
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    if isinstance(value, np.ndarray) and value.ndim == 0:
+        return _sql_value(value.item())
+    return None
+
+
+def _is_scalar(value):
+    value = convert_attribute(value)
+    return value is None or (np.ndim(value) == 0 and not isinstance(value, dict))
+
+
+def read_catalog_entry(h5_path, results_group='shot_results'):
+    """Read the metadata of one shot that is stored in the catalog.
+
+    The file is opened only once.
+
+    Args:
+        h5_path (str): The path to the shot's hdf5 file.
+        results_group (str, optional): (Default = 'shot_results') The results
+            group from which to read the scalar results. As with lyse.Run, it's
+            stored in 'results/<results_group>' in the hdf5 file.
+
+    Returns:
+        entry (dict): A dictionary with the keys 'shot' (a dict of the columns
+            of the shots table), 'rois' (a dict mapping orientation to ROI),
+            'image_shapes' (a list of (orientation, label, frametype, shape)
+            tuples), 'globals' (a dict of scalar globals), and 'results' (a
+            dict of scalar results).
+    """
+    with h5py.File(h5_path, 'r') as h5_file:
+        root_attributes = h5_file.attrs
+        seq_id = _ensure_str(root_attributes['sequence_id'])
+        sequence_time = asdatetime(seq_id.split('_')[0])
+        shot = {
+            'sequence_id': seq_id,
+            'sequence_time': _time_key(sequence_time),
+            'sequence_index': _sql_value(
+                root_attributes.get('sequence_index', None)),
+            'labscript': _ensure_str(root_attributes['script_basename']),
+            'run_number': _sql_value(root_attributes.get('run number', None)),
+            'run_repeat': _sql_value(root_attributes.get('run repeat', 0)),
+        }
+
+        # Camera ROIs and image shapes.
+        rois = {}
+        image_shapes = []
+        if 'images' in h5_file:
+            for orientation, orientation_group in h5_file['images'].items():
+                if 'ROI' in orientation_group.attrs:
+                    roi = get_attribute(orientation_group, 'ROI')
+                    rois[orientation] = roi_key(roi)
+                for label, label_group in orientation_group.items():
+                    if not isinstance(label_group, h5py.Group):
+                        continue
+                    for frametype, dataset in label_group.items():
+                        if isinstance(dataset, h5py.Dataset):
+                            image_shapes.append(
+                                (orientation, label, frametype,
+                                 json.dumps(list(dataset.shape)))
+                            )
+
+        # Scalar globals and results.
+        globals_ = {}
+        for name, value in h5_file['globals'].attrs.items():
+            if _is_scalar(value):
+                globals_[name] = _sql_value(value)
+        results = {}
+        group_path = f'results/{results_group}'
+        if group_path in h5_file:
+            for name, value in h5_file[group_path].attrs.items():
+                if _is_scalar(value):
+                    results[name] = _sql_value(value)
+
+    entry = {
+        'shot': shot,
+        'rois': rois,
+        'image_shapes': image_shapes,
+        'globals': globals_,
+        'results': results,
+    }
+    return entry
+
+
+class ShotCatalog(object):
+    """A persistent, incrementally updated SQLite index of shot metadata.
+
+    Attributes:
+        database_path (str): The path to the SQLite database file.
+        connection (sqlite3.Connection): The connection to the database.
+    """
+
+    def __init__(self, database_path):
+        """Open the catalog, creating it if it doesn't exist.
+
+        Args:
+            database_path (str): The path to the SQLite database file, e.g. as
+                returned by default_catalog_path(). Use ':memory:' for a
+                temporary in-memory catalog.
+        """
+        self.database_path = database_path
+        self.connection = sqlite3.connect(database_path)
+        self.connection.executescript(_SCHEMA)
+        self.connection.commit()
+        self._migrate()
+
+    def _migrate(self):
+        """Update a catalog written by an older version of this module."""
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version >= _SCHEMA_VERSION:
+            return
+        with self.connection:
+            if version < 1:
+                # Sequence times used to be stored with their local UTC offset,
+                # which doesn't sort correctly across daylight saving changes.
+                rows = self.connection.execute(
+                    "SELECT path, sequence_time FROM shots").fetchall()
+                self.connection.executemany(
+                    "UPDATE shots SET sequence_time = ? WHERE path = ?",
+                    [(_time_key(time), path) for path, time in rows],
+                )
+            if version < 2:
+                # Results used to be looked for in the wrong group, so none
+                # were indexed. Forget the modification times so that update()
+                # reads every shot again.
+                self.connection.execute("UPDATE shots SET mtime = -1")
+            self.connection.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def close(self):
+        """Close the connection to the database."""
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM shots").fetchone()[0]
+
+    def _stored_mtimes(self):
+        return dict(self.connection.execute("SELECT path, mtime FROM shots"))
+
+    def _delete(self, paths):
+        for table in _PER_SHOT_TABLES:
+            self.connection.executemany(
+                f"DELETE FROM {table} WHERE path = ?",
+                [(path,) for path in paths],
+            )
+
+    def _insert(self, path, mtime, entry):
+        shot = entry['shot']
+        self.connection.execute(
+            "INSERT INTO shots VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, mtime, shot['sequence_id'], shot['sequence_time'],
+             shot['sequence_index'], shot['labscript'], shot['run_number'],
+             shot['run_repeat']),
+        )
+        self.connection.executemany(
+            "INSERT INTO rois VALUES (?, ?, ?)",
+            [(path, orientation, roi)
+             for orientation, roi in entry['rois'].items()],
+        )
+        self.connection.executemany(
+            "INSERT INTO image_shapes VALUES (?, ?, ?, ?, ?)",
+            [(path, *shape) for shape in entry['image_shapes']],
+        )
+        self.connection.executemany(
+            "INSERT INTO shot_globals VALUES (?, ?, ?)",
+            [(path, name, value) for name, value in entry['globals'].items()],
+        )
+        self.connection.executemany(
+            "INSERT INTO shot_results VALUES (?, ?, ?)",
+            [(path, name, value) for name, value in entry['results'].items()],
+        )
+
+    def update(self, file_patterns, max_workers=DEFAULT_MAX_WORKERS,
+               prune=True, results_group='shot_results'):
+        """Index new and modified shot files.
+
+        Only files which aren't in the catalog yet or whose modification time
+        changed since they were indexed are opened. Files which can't be read,
+        e.g. shots that haven't been run yet or were only sent to runviewer,
+        are silently skipped and will be tried again on the next update.
+
+        Args:
+            file_patterns (list of str): Patterns passed to glob.iglob() with
+                recursive=True to find the shot files, e.g.
+                [r'C:\\Experiments\\data\\**\\*.h5'].
+            max_workers (int, optional): (Default = DEFAULT_MAX_WORKERS) The
+                maximum number of threads used to read the files.
+            prune (bool, optional): (Default = True) If True, shots in the
+                catalog which match one of the file_patterns but whose files no
+                longer exist are removed from the catalog.
+            results_group (str, optional): (Default = 'shot_results') The
+                results group from which to read the scalar results. As with
+                lyse.Run, it's stored in 'results/<results_group>' in the hdf5
+                files.
+
+        Returns:
+            n_updated (int): The number of shots that were added or updated.
+        """
+        # Find the files and their modification times.
+        current_mtimes = {}
+        for file_pattern in file_patterns:
+            for path in glob.iglob(file_pattern, recursive=True):
+                path = os.path.abspath(path)
+                try:
+                    current_mtimes[path] = os.path.getmtime(path)
+                except OSError:
+                    pass
+
+        stored_mtimes = self._stored_mtimes()
+        changed_paths = [
+            path for path, mtime in current_mtimes.items()
+            if stored_mtimes.get(path) != mtime
+        ]
+
+        def read_entry(path):
+            try:
+                return read_catalog_entry(path, results_group=results_group)
+            except Exception:
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            entries = list(executor.map(read_entry, changed_paths))
+
+        n_updated = 0
+        with self.connection:
+            self._delete(changed_paths)
+            for path, entry in zip(changed_paths, entries):
+                if entry is not None:
+                    self._insert(path, current_mtimes[path], entry)
+                    n_updated += 1
+
+            if prune:
+                # Only prune shots that would match one of the patterns, so that
+                # one catalog can be updated from different patterns.
+                missing_paths = [
+                    path for path in stored_mtimes
+                    if path not in current_mtimes and not os.path.exists(path)
+                    and any(fnmatch(path, os.path.abspath(pattern))
+                            for pattern in file_patterns)
+                ]
+                self._delete(missing_paths)
+
+        return n_updated
+
+    def query(self, roi=None, orientation=None, since=None, until=None,
+              sequence_id=None, labscript=None, global_constraints=(),
+              result_constraints=(), rel_tol=DEFAULT_REL_TOL):
+        """Get the paths of the shots that satisfy all of the given filters.
+
+        Args:
+            roi (dict or sequence, optional): (Default = None) Only include
+                shots with this camera ROI. See roi_key() for the accepted
+                formats.
+            orientation (str, optional): (Default = None) The camera orientation
+                whose ROI is compared to roi. If None, shots with any camera
+                that has the given ROI are included.
+            since (datetime.datetime or str, optional): (Default = None) Only
+                include shots from sequences that started at or after this
+                time. Strings should be in ISO format, e.g. '2022-03-01' or
+                '2022-03-01T12:00:00+01:00'. Times without a timezone are taken
+                to be in local time, as are the sequence ids.
+            until (datetime.datetime or str, optional): (Default = None) Only
+                include shots from sequences that started before this time.
+            sequence_id (str, optional): (Default = None) Only include shots
+                from the sequence with this id.
+            labscript (str, optional): (Default = None) Only include shots
+                compiled from the labscript with this name.
+            global_constraints (list of tuples, optional): (Default = ()) Only
+                include shots whose globals satisfy these constraints. They use
+                the same format as shot_grouping.constraint_mask(), e.g.
+                [('sideband_cool_z_coil', 1.0), ('tof_time', 0, 5e-3)].
+            result_constraints (list of tuples, optional): (Default = ()) The
+                same as global_constraints, but for the scalar results.
+            rel_tol (float, optional): (Default = DEFAULT_REL_TOL) The relative
+                tolerance used when comparing floats.
+
+        Raises:
+            ValueError: If since or until isn't a valid time, or if a constraint
+                isn't a name followed by one scalar value or two numeric bounds.
+
+        Returns:
+            paths (list of str): The paths of the shots, sorted by sequence time
+                and then run number.
+        """
+        conditions = []
+        parameters = []
+        if roi is not None:
+            if orientation is None:
+                conditions.append(
+                    "path IN (SELECT path FROM rois WHERE roi = ?)")
+                parameters.append(roi_key(roi))
+            else:
+                conditions.append(
+                    "path IN (SELECT path FROM rois WHERE roi = ? AND "
+                    "orientation = ?)")
+                parameters.extend([roi_key(roi), orientation])
+        if since is not None:
+            conditions.append("sequence_time >= ?")
+            parameters.append(_time_key(since))
+        if until is not None:
+            conditions.append("sequence_time < ?")
+            parameters.append(_time_key(until))
+        if sequence_id is not None:
+            conditions.append("sequence_id = ?")
+            parameters.append(sequence_id)
+        if labscript is not None:
+            conditions.append("labscript = ?")
+            parameters.append(labscript)
+        for table, constraints in (('shot_globals', global_constraints),
+                                   ('shot_results', result_constraints)):
+            for constraint in constraints:
+                condition, constraint_parameters = _constraint_condition(
+                    table, constraint, rel_tol)
+                conditions.append(condition)
+                parameters.extend(constraint_parameters)
+
+        sql = "SELECT path FROM shots"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY sequence_time, run_number, path"
+        return [row[0] for row in self.connection.execute(sql, parameters)]
+
+    def get_roi(self, path, orientation):
+        """Get the stored camera ROI of a shot.
+
+        Args:
+            path (str): The path to the shot's hdf5 file.
+            orientation (str): The orientation of the camera.
+
+        Returns:
+            roi (dict or list or None): The ROI as it was stored in the shot
+                file, or None if the shot or ROI isn't in the catalog.
+        """
+        row = self.connection.execute(
+            "SELECT roi FROM rois WHERE path = ? AND orientation = ?",
+            (os.path.abspath(path), orientation),
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_image_shape(self, path, orientation, label, frametype):
+        """Get the shape of an image in a shot without opening the file.
+
+        Args:
+            path (str): The path to the shot's hdf5 file.
+            orientation (str): The orientation of the camera.
+            label (str): The label of the exposure.
+            frametype (str): The frametype of the image.
+
+        Returns:
+            shape (tuple of ints or None): The shape of the image, or None if
+                it isn't in the catalog.
+        """
+        row = self.connection.execute(
+            "SELECT shape FROM image_shapes WHERE path = ? AND "
+            "orientation = ? AND label = ? AND frametype = ?",
+            (os.path.abspath(path), orientation, label, frametype),
+        ).fetchone()
+        if row is None:
+            return None
+        return tuple(json.loads(row[0]))
+
+
+def _time_key(time):
+    """Convert a time into the UTC string format stored in the catalog.
+
+    Args:
+        time (datetime.datetime, datetime.date, or str): The time. Strings
+            should be in ISO format. Times without a timezone are taken to be in
+            local time.
+
+    Raises:
+        ValueError: If time isn't a valid time.
+
+    Returns:
+        key (str): The time in UTC, formatted with TIME_FORMAT.
+    """
+    if isinstance(time, str):
+        try:
+            time = datetime.datetime.fromisoformat(time)
+        except ValueError:
+            message = f"Times should be in ISO format but got '{time}'."
+            raise ValueError(message) from None
+    elif isinstance(time, datetime.date) and \
+            not isinstance(time, datetime.datetime):
+        time = datetime.datetime.combine(time, datetime.time())
+    elif not isinstance(time, datetime.datetime):
+        message = ("Times should be a datetime or an ISO format string but got "
+                   f"{time!r}.")
+        raise ValueError(message)
+    # astimezone() assumes that naive times are in local time.
+    time = time.astimezone(datetime.timezone.utc)
+    return time.strftime(TIME_FORMAT)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not math.isnan(value)
+
+
+def _constraint_condition(table, constraint, rel_tol):
+    """Convert a data constraint into an SQL condition and its parameters."""
+    if not isinstance(constraint, (tuple, list)) or \
+            len(constraint) not in (2, 3) or not isinstance(constraint[0], str):
+        message = ("Constraints should be a name followed by a value or by a "
+                   f"minimum and maximum value but got {constraint!r}.")
+        raise ValueError(message)
+    name = constraint[0]
+    subquery = f"path IN (SELECT path FROM {table} WHERE name = ? AND "
+    if len(constraint) == 2:
+        value = _sql_value(constraint[1])
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            message = (f"The value of the constraint {constraint!r} should be "
+                       "a number or a string.")
+            raise ValueError(message)
+        if isinstance(value, (int, float)):
+            # Equal to within the tolerance, like math.isclose().
+            condition = subquery + "ABS(value - ?) <= ? * ABS(?))"
+            return condition, [name, value, rel_tol, value]
+        return subquery + "value = ?)", [name, value]
+
+    minimum_value = _sql_value(constraint[1])
+    maximum_value = _sql_value(constraint[2])
+    if not (_is_number(minimum_value) and _is_number(maximum_value)):
+        message = (f"The minimum and maximum values of the constraint "
+                   f"{constraint!r} should be numbers.")
+        raise ValueError(message)
+    # Widen the range by the tolerance so that values approximately equal to
+    # the end values are included. Infinite bounds are left as they are.
+    if math.isfinite(minimum_value):
+        minimum_value -= rel_tol * abs(minimum_value)
+    if math.isfinite(maximum_value):
+        maximum_value += rel_tol * abs(maximum_value)
+    condition = subquery + "value >= ? AND value <= ?)"
+    return condition, [name, minimum_value, maximum_value]
@@ -0,0 +1,348 @@
+"""Functions for grouping and filtering shots using columns of values.
+
+group_by_attributes() and the constraint filtering of the old Dataset class
+work on lists of objects, calling getattr() for every attribute of every object
+in python loops. That becomes slow for scans with tens of thousands of shots.
+The functions here instead work on columns of values, e.g. the columns of the
+table returned by shot_table.load_shot_table(), using vectorized numpy
+operations so that grouping a large scan takes milliseconds.
+
+Floats are compared with a tolerance, in the same way as the old
+get_filtered_repeatedshot_list() method, so that values which only differ due to
+finite numerical precision end up in the same group. This is done by quantizing
+each float column into integer codes, where values within the tolerance of each
+other get the same code. The codes for all of the columns are then combined into
+one structured array and the groups are found with np.unique().
+"""
+import numpy as np
+
+# The default relative tolerance used when comparing floats, which is the same
+# as the default for math.isclose().
+DEFAULT_REL_TOL = 1e-9
+
+
+def _is_float_column(values):
+    return np.issubdtype(values.dtype, np.floating) or \
+        np.issubdtype(values.dtype, np.complexfloating)
+
+
+def _hashable(value):
+    # Numpy arrays aren't hashable, so convert them to bytes the same way as
+    # group_by_attributes() does.
+    if isinstance(value, np.ndarray):
+        return value.tobytes()
+    return value
+
+
+def quantize_column(values, rel_tol=DEFAULT_REL_TOL, abs_tol=0.):
+    """Convert a column of values into integer codes for grouping.
+
+    Values that are equal get the same code. For float columns, values that are
+    within the tolerance of their neighbor when sorted also get the same code,
+    so e.g. 0.1 + 0.2 and 0.3 are put in the same group. All nan values are
+    given the same code as each other.
+
+    The codes are assigned in sorted order of the values for numerical columns,
+    and in order of first appearance for other columns (e.g. columns of
+    strings or arrays).
+
+    Args:
+        values (array-like): The column of values to quantize.
+        rel_tol (float, optional): (Default = DEFAULT_REL_TOL) The relative
+            tolerance used when comparing floats.
+        abs_tol (float, optional): (Default = 0.) The absolute tolerance used
+            when comparing floats.
+
+    Returns:
+        codes (np.ndarray): An array of integer codes with one entry per value.
+        unique_values (np.ndarray): An array with one representative value for
+            each code, such that unique_values[codes] approximately reproduces
+            values.
+    """
+    values = np.asarray(values)
+    if values.dtype == object:
+        # Objects, e.g. arrays or mixed types, have to be assigned codes one at
+        # a time since numpy can't sort them.
+        code_lookup = {}
+        codes = np.empty(len(values), dtype=np.int64)
+        unique_values = []
+        for j, value in enumerate(values):
+            key = _hashable(value)
+            if key not in code_lookup:
+                code_lookup[key] = len(unique_values)
+                unique_values.append(value)
+            codes[j] = code_lookup[key]
+        unique_array = np.empty(len(unique_values), dtype=object)
+        unique_array[:] = unique_values
+        return codes, unique_array
+
+    # np.unique() sorts the values and puts all of the nan values at the end.
+    unique_values, codes = np.unique(values, return_inverse=True)
+    codes = codes.reshape(-1)
+    if not _is_float_column(values) or len(unique_values) < 2:
+        return codes, unique_values
+
+    # Merge neighboring unique values that are within the tolerance of each
+    # other. A new group starts wherever the gap to the previous value is larger
+    # than the tolerance. Nan values compare as not close so they end up in
+    # their own group, and np.unique() may return several nans so merge those.
+    gaps = np.abs(np.diff(unique_values))
+    scale = np.maximum(np.abs(unique_values[1:]), np.abs(unique_values[:-1]))
+    is_close = gaps <= np.maximum(rel_tol * scale, abs_tol)
+    is_nan = np.isnan(unique_values)
+    is_close |= (is_nan[1:] & is_nan[:-1])
+    merged_codes = np.concatenate(([0], np.cumsum(~is_close)))
+    # Use the first value of each merged group as its representative value.
+    starts = np.concatenate(([True], ~is_close))
+    return merged_codes[codes], unique_values[starts]
+
+
+def constraint_mask(columns, data_constraints, rel_tol=DEFAULT_REL_TOL):
+    """Get a boolean mask of which rows satisfy all of the data_constraints.
+
+    The constraints have the same format and meaning as for the old
+    get_filtered_repeatedshot_list() method. Each constraint should be a tuple.
+    The first element should be the name of a column. The second and third
+    elements of the tuple should be the minimum and maximum values (inclusively)
+    that the rows should have. If the third entry in the tuple is omitted, then
+    only rows with a value approximately equal to the second element of the
+    tuple are kept. For example, ('atom_number', 1e3, 100e3) keeps rows with
+    atom number between 1e3 and 100e3, and ('sideband_cool_z_coil', 1.0) keeps
+    rows with sideband_cool_z_coil equal to one within a precision of about
+    nine decimal digits. It is also acceptable to use the two-element form for
+    columns that have non-numerical values, e.g. ('description', 'Fast
+    Cooling').
+
+    Args:
+        columns (dict-like): A mapping from column names to arrays of values,
+            e.g. a pandas DataFrame or a dictionary of numpy arrays. All of the
+            columns should have the same length.
+        data_constraints (list of tuples): The constraints, as described above.
+        rel_tol (float, optional): (Default = DEFAULT_REL_TOL) The relative
+            tolerance used when comparing floats.
+
+    Raises:
+        ValueError: If a constraint doesn't have two or three elements.
+
+    Returns:
+        mask (np.ndarray): A boolean array which is True for the rows that
+            satisfy all of the constraints.
+    """
+    mask = None
+    for constraint in data_constraints:
+        values = np.asarray(columns[constraint[0]])
+        if mask is None:
+            mask = np.ones(len(values), dtype=bool)
+        numeric = np.issubdtype(values.dtype, np.number)
+
+        if len(constraint) == 2:
+            # Check that the values are equal to the requested value, at least
+            # to within a given precision for numerical values.
+            requested_value = constraint[1]
+            if numeric and isinstance(requested_value, (int, float, np.number)):
+                keep = np.isclose(
+                    values, requested_value, rtol=rel_tol, atol=0.)
+                keep |= (values == requested_value)
+            else:
+                keep = np.fromiter(
+                    (value == requested_value for value in values),
+                    dtype=bool, count=len(values),
+                )
+        elif len(constraint) == 3:
+            # Check that the values are between the minimum and maximum values,
+            # or approximately equal to one of the end values.
+            minimum_value, maximum_value = constraint[1], constraint[2]
+            high_enough = (values > minimum_value) | np.isclose(
+                values, minimum_value, rtol=rel_tol, atol=0.)
+            low_enough = (values < maximum_value) | np.isclose(
+                values, maximum_value, rtol=rel_tol, atol=0.)
+            keep = high_enough & low_enough
+        else:
+            message = ("Constraints should have two or three elements but got "
+                       f"{constraint}.")
+            raise ValueError(message)
+        mask &= keep
+
+    if mask is None:
+        # No constraints, so keep everything if we can tell how many rows
+        # there are.
+        # Iterating over a DataFrame or a dict gives the column names.
+        first_name = next(iter(columns), None)
+        n_rows = 0 if first_name is None else len(columns[first_name])
+        mask = np.ones(n_rows, dtype=bool)
+    return mask
+
+
+class Grouping(object):
+    """The result of grouping rows by the values of some key columns.
+
+    Groups are ordered by the values of their keys, with the first key column
+    varying slowest. Group-wise reductions are done with np.bincount() so they
+    are fast even for many rows and many groups.
+
+    Attributes:
+        key_names (list of str): The names of the columns used for grouping.
+        group_ids (np.ndarray): The index of the group that each row belongs to.
+            Rows which were excluded by the constraints are given an id of -1.
+        n_groups (int): The number of groups.
+        counts (np.ndarray): The number of rows in each group.
+        keys (dict): A dictionary mapping each key name to an array with the
+            value of that key for each group.
+    """
+
+    def __init__(self, key_names, group_ids, n_groups, keys):
+        self.key_names = list(key_names)
+        self.group_ids = group_ids
+        self.n_groups = n_groups
+        self.keys = keys
+        included = group_ids >= 0
+        self._included = included
+        self.counts = np.bincount(group_ids[included], minlength=n_groups)
+
+    def __len__(self):
+        return self.n_groups
+
+    def indices(self):
+        """Get the row indices of each group.
+
+        Returns:
+            index_list (list of np.ndarray): A list with one array for each
+                group, containing the indices of the rows in that group in their
+                original order.
+        """
+        rows = np.flatnonzero(self._included)
+        order = rows[np.argsort(self.group_ids[rows], kind='stable')]
+        return np.split(order, np.cumsum(self.counts)[:-1])
+
+    def _finite_values(self, values):
+        """Get the finite values of the included rows and their group ids."""
+        values = np.asarray(values, dtype=float)[self._included]
+        ids = self.group_ids[self._included]
+        finite = np.isfinite(values)
+        return values[finite], ids[finite]
+
+    def _sums(self, values):
+        """Get the number of finite values and their sum."""
+        values, ids = self._finite_values(values)
+        n = np.bincount(ids, minlength=self.n_groups)
+        total = np.bincount(ids, weights=values, minlength=self.n_groups)
+        return n, total
+
+    def mean(self, values):
+        """Get the mean of values for each group, ignoring nan values.
+
+        Args:
+            values (array-like): An array with one value per row.
+
+        Returns:
+            means (np.ndarray): The mean for each group. Groups without any
+                finite values get nan.
+        """
+        n, total = self._sums(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / n
+
+    def std(self, values, ddof=1):
+        """Get the standard deviation of values for each group.
+
+        Args:
+            values (array-like): An array with one value per row.
+            ddof (int, optional): (Default = 1) The delta degrees of freedom,
+                as for np.std(). The default gives the sample standard
+                deviation.
+
+        Returns:
+            stds (np.ndarray): The standard deviation for each group. Groups
+                with ddof or fewer finite values get nan.
+        """
+        values, ids = self._finite_values(values)
+        n = np.bincount(ids, minlength=self.n_groups)
+        total = np.bincount(ids, weights=values, minlength=self.n_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / n
+            # Sum the squared deviations from each group's mean in a second
+            # pass. Subtracting n * mean**2 from the sum of squares instead
+            # loses all precision for e.g. atom numbers, where the spread is
+            # much smaller than the values themselves.
+            squared_deviations = np.bincount(
+                ids, weights=(values - mean[ids])**2, minlength=self.n_groups)
+            stds = np.sqrt(squared_deviations / (n - ddof))
+        stds[n <= ddof] = np.nan
+        return stds
+
+    def sem(self, values, ddof=1):
+        """Get the standard error of the mean of values for each group.
+
+        Args:
+            values (array-like): An array with one value per row.
+            ddof (int, optional): (Default = 1) The delta degrees of freedom
+                used when calculating the standard deviation.
+
+        Returns:
+            sems (np.ndarray): The standard error of the mean for each group.
+        """
+        n, _ = self._sums(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.std(values, ddof=ddof) / np.sqrt(n)
+
+
+def group_rows(columns, key_names, data_constraints=(),
+               rel_tol=DEFAULT_REL_TOL, abs_tol=0.):
+    """Group rows by their values in the columns listed in key_names.
+
+    This is the columnar equivalent of group_by_attributes(), optionally
+    combined with the constraint filtering of constraint_mask(). Rows which have
+    the same values (to within the tolerance for floats) in all of the key
+    columns are put into the same group.
+
+    Args:
+        columns (dict-like): A mapping from column names to arrays of values,
+            e.g. a pandas DataFrame or a dictionary of numpy arrays. All of the
+            columns should have the same length.
+        key_names (list of str): The names of the columns whose values should be
+            the same for two rows to be put into the same group.
+        data_constraints (list of tuples, optional): (Default = ()) Only rows
+            which satisfy these constraints are grouped. See constraint_mask()
+            for the format.
+        rel_tol (float, optional): (Default = DEFAULT_REL_TOL) The relative
+            tolerance used when comparing floats.
+        abs_tol (float, optional): (Default = 0.) The absolute tolerance used
+            when comparing floats.
+
+    Returns:
+        grouping (Grouping): The groups, which can also be used to calculate
+            group-wise means, standard deviations, etc.
+    """
+    key_names = list(key_names)
+    mask = constraint_mask(columns, data_constraints, rel_tol=rel_tol)
+    n_rows = len(mask)
+    rows = np.flatnonzero(mask)
+
+    # Quantize each key column into integer codes, then combine them into one
+    # structured array so that np.unique() can find the unique combinations.
+    codes_list = []
+    unique_values_list = []
+    for name in key_names:
+        codes, unique_values = quantize_column(
+            np.asarray(columns[name])[rows], rel_tol=rel_tol, abs_tol=abs_tol)
+        codes_list.append(codes)
+        unique_values_list.append(unique_values)
+
+    group_ids = np.full(n_rows, -1, dtype=np.int64)
+    keys = {}
+    if not key_names:
+        # Everything that satisfies the constraints is in one group.
+        group_ids[rows] = 0
+        n_groups = 1 if len(rows) else 0
+    else:
+        structured_codes = np.empty(
+            len(rows), dtype=[(f'key_{j}', np.int64) for j in range(len(key_names))])
+        for j, codes in enumerate(codes_list):
+            structured_codes[f'key_{j}'] = codes
+        unique_codes, inverse = np.unique(structured_codes, return_inverse=True)
+        group_ids[rows] = inverse.reshape(-1)
+        n_groups = len(unique_codes)
+        for j, name in enumerate(key_names):
+            keys[name] = unique_values_list[j][unique_codes[f'key_{j}']]
+
+    return Grouping(key_names, group_ids, n_groups, keys)
@@ -0,0 +1,287 @@
+"""Load many Shot instances in parallel, with progress reports and cancellation.
+
+Creating a Shot reads its globals and metadata from its hdf5 file, so creating
+one for every row of a large dataframe in a loop takes minutes, most of which is
+spent waiting on file I/O. load_shots() instead creates them on a bounded thread
+pool, calls a progress callback as they finish, and can be cancelled part way
+through by setting a threading.Event, e.g. with cancel_on_key(). The loaded
+shots are kept in a ShotCache, so when the dataframe grows by a few rows only
+the new shots are loaded, and a cancelled load picks up where it left off the
+next time. Shots whose files have been modified since they were cached, e.g.
+because they were analyzed again, are loaded again.
+
+The list of shots can then be passed to Dataset in place of the dataframe, so
+that its RepeatedShot groups are built from the already loaded shots.
+
+Example Usage:
+```
+with cancel_on_key() as cancel_event:
+    shots = load_shots(df['filepath'], progress_callback=print_progress,
+                       cancel_event=cancel_event, cache=shot_cache)
+dataset = Dataset(shots)
+```
+"""
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import os
+import threading
+
+DEFAULT_MAX_WORKERS = 8
+# Analyzed shots keep their images, e.g. od_image, as attributes, which can take
+# several megabytes each, so only keep about as many as a long scan has.
+DEFAULT_MAX_ENTRIES = 1000
+# How often, in seconds, to check for cancellation while waiting on a shot.
+CANCEL_CHECK_INTERVAL = 0.1
+
+
+class ShotLoadCancelled(Exception):
+    """Raised when load_shots() is cancelled.
+
+    Attributes:
+        n_loaded (int): The number of shots that were loaded before cancelling.
+            They're kept in the cache, if one was used.
+        n_total (int): The number of shots that were requested.
+    """
+
+    def __init__(self, n_loaded, n_total):
+        self.n_loaded = n_loaded
+        self.n_total = n_total
+        message = (f"Loading shots was cancelled after {n_loaded} of {n_total} "
+                   "shots were loaded.")
+        super().__init__(message)
+
+
+def _get_mtime(h5_path):
+    # Returns None if the file doesn't exist (anymore).
+    try:
+        return os.stat(h5_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ShotCache(object):
+    """A bounded in-memory cache of Shot instances, keyed by class and path.
+
+    Shots keep the results they calculate, and the globals they read when they
+    were created, as attributes. So that those aren't out of date, the
+    modification time of each shot's hdf5 file is stored with it, and a shot is
+    discarded instead of returned if its file has been modified (or removed)
+    since. That includes results saved by the cached shots themselves, so call
+    refresh() after they save results to keep them cached. When the cache is
+    full, the least recently used shot is discarded. The cache is thread safe.
+
+    Attributes:
+        max_entries (int): The maximum number of shots to keep.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        """Create a ShotCache.
+
+        Args:
+            max_entries (int, optional): (Default = DEFAULT_MAX_ENTRIES) The
+                maximum number of shots to keep.
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, shot_class, h5_path):
+        """Get a cached shot, or None if there isn't an up to date one."""
+        key = (shot_class, h5_path)
+        mtime = _get_mtime(h5_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            shot, cached_mtime = entry
+            if mtime is None or mtime != cached_mtime:
+                # The file changed since the shot was cached.
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return shot
+
+    def put(self, shot_class, h5_path, shot, mtime=None):
+        """Add a shot to the cache, discarding the oldest one if it's full.
+
+        Args:
+            shot_class (class): The class of the shot.
+            h5_path (str): The path to the shot's hdf5 file.
+            shot (Shot): The shot to cache.
+            mtime (int, optional): (Default = None) The modification time of
+                the file, in nanoseconds, from before the shot was created. If
+                None, it's read now.
+        """
+        key = (shot_class, h5_path)
+        if mtime is None:
+            mtime = _get_mtime(h5_path)
+        with self._lock:
+            self._entries[key] = (shot, mtime)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def refresh(self, shot_class, h5_path):
+        """Mark a cached shot as up to date with its file.
+
+        Call this after the cached shot saved results to its file, which
+        changes the file's modification time, so that the shot isn't loaded
+        again. Nothing is done if the shot isn't cached.
+
+        Args:
+            shot_class (class): The class of the shot.
+            h5_path (str): The path to the shot's hdf5 file.
+        """
+        key = (shot_class, h5_path)
+        mtime = _get_mtime(h5_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], mtime)
+
+    def discard(self, h5_path):
+        """Remove all cached shots for a path, e.g. if its file was replaced."""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == h5_path]:
+                del self._entries[key]
+
+    def clear(self):
+        """Remove all shots from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+
+def print_progress(n_loaded, n_total):
+    """A progress callback for load_shots() which prints every 10%."""
+    if n_total and (n_loaded == n_total or
+                    10 * n_loaded // n_total != 10 * (n_loaded - 1) // n_total):
+        print(f"Loaded {n_loaded} of {n_total} shots.")
+
+
+def load_shots(shot_paths, shot_class=None, max_workers=DEFAULT_MAX_WORKERS,
+               progress_callback=None, cancel_event=None, cache=None):
+    """Create a Shot instance for each of many shot files on a thread pool.
+
+    At most 2 * max_workers shots are queued at a time, so cancelling takes
+    effect quickly even for a very long list of shots.
+
+    Args:
+        shot_paths (iterable of str): The paths to the shots' hdf5 files.
+        shot_class (class, optional): (Default = None) The class to create for
+            each shot, which is called with the shot's path. If None,
+            data_classes.Shot is used.
+        max_workers (int, optional): (Default = DEFAULT_MAX_WORKERS) The maximum
+            number of threads used to create the shots.
+        progress_callback (function, optional): (Default = None) Called as
+            progress_callback(n_loaded, n_total) from the calling thread each
+            time a shot is loaded (or found in the cache).
+        cancel_event (threading.Event, optional): (Default = None) If this is
+            set while loading, the shots that haven't started loading are
+            skipped and ShotLoadCancelled is raised.
+        cache (ShotCache, optional): (Default = None) Shots found in this cache
+            aren't loaded again unless their files have been modified, and newly
+            loaded shots are added to it. If None, no cache is used.
+
+    Raises:
+        ShotLoadCancelled: If cancel_event was set before all of the shots were
+            loaded.
+
+    Returns:
+        shots (list): The shots, in the same order as shot_paths.
+    """
+    if shot_class is None:
+        # Import here since data_classes needs Lyse and a display, which aren't
+        # needed for loading other classes.
+        from analysislib.Rydberg.analysis_utils.data_classes import Shot
+        shot_class = Shot
+    shot_paths = list(shot_paths)
+    n_total = len(shot_paths)
+    shots = [None] * n_total
+    n_loaded = 0
+
+    def report_progress():
+        if progress_callback is not None:
+            progress_callback(n_loaded, n_total)
+
+    def load_shot(h5_path):
+        # Get the modification time first, so that if the file is modified
+        # while the shot is being created, the cached shot counts as outdated.
+        mtime = _get_mtime(h5_path)
+        shot = shot_class(h5_path)
+        if cache is not None:
+            cache.put(shot_class, h5_path, shot, mtime)
+        return shot
+
+    # Use the cached shots first, then queue the rest.
+    to_load = deque()
+    for index, h5_path in enumerate(shot_paths):
+        shot = None if cache is None else cache.get(shot_class, h5_path)
+        if shot is None:
+            to_load.append(index)
+        else:
+            shots[index] = shot
+            n_loaded += 1
+            report_progress()
+
+    max_in_flight = 2 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        try:
+            while to_load or in_flight:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise ShotLoadCancelled(n_loaded, n_total)
+                while to_load and len(in_flight) < max_in_flight:
+                    index = to_load.popleft()
+                    future = executor.submit(load_shot, shot_paths[index])
+                    in_flight[future] = index
+                done, _ = wait(in_flight, timeout=CANCEL_CHECK_INTERVAL,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    shots[in_flight.pop(future)] = future.result()
+                    n_loaded += 1
+                    report_progress()
+        finally:
+            # Don't start any queued shots if we're stopping early. The ones
+            # that already started are finished, and cached, when the executor
+            # shuts down.
+            for future in in_flight:
+                future.cancel()
+    return shots
+
+
+@contextmanager
+def cancel_on_key(key_name='esc'):
+    """Get a threading.Event which is set when a key is pressed.
+
+    This uses a pynput keyboard listener, so the key works whichever window has
+    focus, and the listener is stopped when the with block exits.
+
+    Args:
+        key_name (str, optional): (Default = 'esc') The name of the key in
+            pynput.keyboard.Key.
+
+    Yields:
+        cancel_event (threading.Event): The event, e.g. to pass to
+            load_shots().
+    """
+    # Import here since pynput needs a display, which isn't needed otherwise.
+    from pynput.keyboard import Key, Listener
+
+    cancel_event = threading.Event()
+    cancel_key = getattr(Key, key_name)
+
+    def on_press(key):
+        if key == cancel_key:
+            cancel_event.set()
+
+    listener = Listener(on_press=on_press)
+    listener.start()
+    print(f"Press {key_name} to cancel.")
+    try:
+        yield cancel_event
+    finally:
+        listener.stop()
@@ -0,0 +1,308 @@
+"""Lightweight records of shots for multishot analysis of long scans.
+
+Each Shot instance carries its own globals dictionary and all of the state of a
+lyse.Run instance, which adds up to gigabytes of python objects when holding
+tens of thousands of shots at once. However, nearly all of the globals have the
+same value for every shot in a sequence, since usually only a few of them are
+scanned. The ShotRecord class here only stores the path and a few metadata
+fields of a shot, using __slots__ to avoid a per-instance __dict__. Its globals
+are stored in a shared GlobalsTable, which keeps one dictionary of globals per
+sequence and only stores the globals that differ from that for each shot. A
+ShotRecord can be converted to a full Shot with its to_shot() method when the
+full functionality is needed, e.g. to process its images.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import labscript_utils.h5_lock
+import h5py
+import numpy as np
+
+from analysislib.Rydberg.analysis_utils.shot_table import convert_attribute
+from labscript_utils.connections import _ensure_str
+from lyse.dataframe_utilities import asdatetime
+
+DEFAULT_MAX_WORKERS = 8
+
+# Marks globals which are in the base globals of a sequence but missing from a
+# particular shot.
+_MISSING = object()
+
+
+def _values_equal(value_1, value_2):
+    """Check if two values of globals are equal, including arrays."""
+    if isinstance(value_1, np.ndarray) or isinstance(value_2, np.ndarray):
+        return np.array_equal(value_1, value_2)
+    try:
+        return bool(value_1 == value_2)
+    except Exception:
+        return False
+
+
+class GlobalsTable(object):
+    """A shared table of the globals of many shots.
+
+    The first shot added from each sequence sets the base globals for that
+    sequence. The globals of each shot are then stored as a reference to those
+    base globals plus a small dictionary of only the globals that differ from
+    them, which is None if no globals differ. Identical differences are also
+    interned so that shots with the same values of the scanned globals share
+    one dictionary.
+
+    Attributes:
+        bases (list of dict): The base globals dictionaries.
+    """
+
+    def __init__(self):
+        self.bases = []
+        self._base_indices = {}
+        self._interned_diffs = {}
+
+    def intern(self, sequence_key, globals_):
+        """Store a shot's globals in the table.
+
+        Args:
+            sequence_key (hashable): A key identifying the sequence of the shot,
+                e.g. its sequence id. Shots with the same key share the same
+                base globals.
+            globals_ (dict): The shot's globals.
+
+        Returns:
+            base_index (int): The index of the shot's base globals in
+                self.bases.
+            diff (dict or None): The globals which differ from the base
+                globals, or None if there aren't any.
+        """
+        base_index = self._base_indices.get(sequence_key)
+        if base_index is None:
+            base_index = len(self.bases)
+            self.bases.append(dict(globals_))
+            self._base_indices[sequence_key] = base_index
+            return base_index, None
+
+        base = self.bases[base_index]
+        diff = {}
+        for name, value in globals_.items():
+            if name not in base or not _values_equal(base[name], value):
+                diff[name] = value
+        for name in base:
+            if name not in globals_:
+                diff[name] = _MISSING
+        if not diff:
+            return base_index, None
+        return base_index, self._intern_diff(base_index, diff)
+
+    def _intern_diff(self, base_index, diff):
+        try:
+            key = (base_index, tuple(sorted(
+                (name, value.tobytes() if isinstance(value, np.ndarray) else value)
+                for name, value in diff.items()
+                if value is not _MISSING
+            )), tuple(sorted(
+                name for name, value in diff.items() if value is _MISSING
+            )))
+            hash(key)
+        except TypeError:
+            # Some value isn't hashable, so just don't share this one.
+            return diff
+        return self._interned_diffs.setdefault(key, diff)
+
+    def get(self, base_index, diff, name):
+        """Get the value of one global of a shot.
+
+        Raises:
+            KeyError: If the shot doesn't have that global.
+        """
+        if diff is not None and name in diff:
+            value = diff[name]
+            if value is _MISSING:
+                raise KeyError(name)
+            return value
+        return self.bases[base_index][name]
+
+    def to_dict(self, base_index, diff):
+        """Get all of the globals of a shot as a new dictionary."""
+        globals_ = dict(self.bases[base_index])
+        if diff is not None:
+            for name, value in diff.items():
+                if value is _MISSING:
+                    globals_.pop(name, None)
+                else:
+                    globals_[name] = value
+        return globals_
+
+
+class ShotRecord(object):
+    """A compact record of a shot's path, metadata, and globals.
+
+    Globals can be accessed as attributes, the same way as for Shot instances,
+    e.g. record.tof_time. Results aren't stored; use self.to_shot() or
+    shot_table.load_shot_table() to get them.
+
+    Attributes:
+        h5_path (str): The path to the shot's hdf5 file.
+        sequence (datetime-like): The start time of the shot's sequence.
+        sequence_index (int or None): The sequence index.
+        run_number (int or float): The run number, or nan if unknown.
+        run_repeat (int): The run repeat.
+        globals_table (GlobalsTable): The shared table with the shot's globals.
+    """
+
+    __slots__ = ('h5_path', 'sequence', 'sequence_index', 'run_number',
+                 'run_repeat', 'globals_table', '_base_index', '_diff')
+
+    def __init__(self, h5_path, sequence, sequence_index, run_number,
+                 run_repeat, globals_, globals_table, sequence_key=None):
+        """Create a ShotRecord.
+
+        Args:
+            h5_path (str): The path to the shot's hdf5 file.
+            sequence (datetime-like): The start time of the shot's sequence.
+            sequence_index (int or None): The sequence index.
+            run_number (int or float): The run number.
+            run_repeat (int): The run repeat.
+            globals_ (dict): The shot's globals. They are interned into
+                globals_table rather than stored on the record.
+            globals_table (GlobalsTable): The table in which to store the
+                globals, which should be shared between many records.
+            sequence_key (hashable, optional): (Default = None) The key passed
+                to globals_table.intern(). If None, (sequence, sequence_index)
+                is used.
+        """
+        self.h5_path = h5_path
+        self.sequence = sequence
+        self.sequence_index = sequence_index
+        self.run_number = run_number
+        self.run_repeat = run_repeat
+        self.globals_table = globals_table
+        if sequence_key is None:
+            sequence_key = (sequence, sequence_index)
+        self._base_index, self._diff = globals_table.intern(
+            sequence_key, globals_)
+
+    def __repr__(self):
+        return f"ShotRecord({self.h5_path!r})"
+
+    def __getattr__(self, name):
+        """Access the value of a global as an attribute.
+
+        Note that this function is called internally by Python; you don't call
+        it directly.
+
+        Raises:
+            AttributeError: If there is no global with that name.
+        """
+        # Avoid infinite recursion if the slots haven't been set yet, e.g. while
+        # unpickling.
+        if name.startswith('_') or name == 'globals_table':
+            raise AttributeError(name)
+        try:
+            return self.globals_table.get(self._base_index, self._diff, name)
+        except KeyError:
+            raise AttributeError(f"The shot has no global named {name}.")
+
+    @property
+    def globals(self):
+        """A new dictionary with all of the shot's globals."""
+        return self.globals_table.to_dict(self._base_index, self._diff)
+
+    def to_shot(self):
+        """Create a full Shot instance for this shot.
+
+        Returns:
+            shot (data_classes.Shot): The Shot instance.
+        """
+        # Import here since data_classes pulls in lyse, cv2, etc., which
+        # aren't needed just to work with the records.
+        from analysislib.Rydberg.analysis_utils.data_classes import Shot
+        return Shot(self.h5_path)
+
+
+def _read_record_inputs(h5_path):
+    """Read the sequence id, metadata, and globals of a shot from its file."""
+    with h5py.File(h5_path, 'r') as h5_file:
+        root_attributes = h5_file.attrs
+        seq_id = _ensure_str(root_attributes['sequence_id'])
+        metadata = (
+            root_attributes.get('sequence_index', None),
+            root_attributes.get('run number', float('nan')),
+            root_attributes.get('run repeat', 0),
+        )
+        globals_ = {
+            name: convert_attribute(value)
+            for name, value in h5_file['globals'].attrs.items()
+        }
+    return seq_id, metadata, globals_
+
+
+def read_shot_record(h5_path, globals_table):
+    """Create a ShotRecord by reading a shot's hdf5 file.
+
+    The metadata is calculated the same way as in Shot.__init__().
+
+    Args:
+        h5_path (str): The path to the shot's hdf5 file.
+        globals_table (GlobalsTable): The table in which to store the globals.
+
+    Returns:
+        record (ShotRecord): The record for the shot.
+    """
+    seq_id, metadata, globals_ = _read_record_inputs(h5_path)
+    sequence_index, run_number, run_repeat = metadata
+    return ShotRecord(
+        h5_path,
+        asdatetime(seq_id.split('_')[0]),
+        sequence_index,
+        run_number,
+        run_repeat,
+        globals_,
+        globals_table,
+        sequence_key=seq_id,
+    )
+
+
+def load_shot_records(shot_paths, globals_table=None,
+                      max_workers=DEFAULT_MAX_WORKERS):
+    """Create ShotRecords for many shots, reading the files in parallel.
+
+    Files that can't be read (e.g. shots that haven't been run yet) are skipped.
+
+    Args:
+        shot_paths (iterable of str): The paths to the shots' hdf5 files.
+        globals_table (GlobalsTable, optional): (Default = None) The table in
+            which to store the globals. If None, a new one is created. Pass an
+            existing one to share it with previously loaded records.
+        max_workers (int, optional): (Default = DEFAULT_MAX_WORKERS) The maximum
+            number of threads used to read the files.
+
+    Returns:
+        records (list of ShotRecord): The records, in the same order as
+            shot_paths.
+    """
+    if globals_table is None:
+        globals_table = GlobalsTable()
+
+    def read_inputs(h5_path):
+        try:
+            return (h5_path, *_read_record_inputs(h5_path))
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        outputs = list(executor.map(read_inputs, shot_paths))
+
+    # Intern the globals in the main thread since GlobalsTable isn't thread
+    # safe. Also share the sequence datetimes between records.
+    records = []
+    sequences = {}
+    for output in outputs:
+        if output is None:
+            continue
+        h5_path, seq_id, metadata, globals_ = output
+        if seq_id not in sequences:
+            sequences[seq_id] = asdatetime(seq_id.split('_')[0])
+        sequence_index, run_number, run_repeat = metadata
+        records.append(ShotRecord(
+            h5_path, sequences[seq_id], sequence_index, run_number, run_repeat,
+            globals_, globals_table, sequence_key=seq_id,
+        ))
+    return records
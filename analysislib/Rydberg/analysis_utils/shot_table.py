@@ -0,0 +1,251 @@
+"""Load the globals and results of many shots into one table.
+
+Creating a Shot instance for every file and then calling getattr() for each
+attribute is slow when there are thousands of shots, since each Shot instance
+opens its file several times and each attribute access may open it again. The
+functions here instead open each file once, read its globals, root attributes,
+and scalar results in one go, and do this for many files in parallel on a
+thread pool. The result is a pandas DataFrame with one row per shot and one
+column per quantity, so e.g. all of the atom numbers can be retrieved as
+table['atom_number'].
+
+Array results (e.g. cross sections or images) aren't loaded, since they can be
+large. Instead the table contains an ArrayResultReference for each of them,
+which loads the array from its file only when its load() method is called.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import warnings
+
+import labscript_utils.h5_lock
+import h5py
+import numpy as np
+import pandas as pd
+
+from analysislib.Rydberg.analysis_utils.image_storage import read_image_dataset
+from labscript_utils.connections import _ensure_str
+from lyse.dataframe_utilities import asdatetime
+
+# The columns that are always included in the table, which mirror the
+# attributes that Shot.__init__() sets from the root attributes of the file.
+METADATA_COLUMNS = [
+    'filepath',
+    'sequence',
+    'sequence_index',
+    'labscript',
+    'run_number',
+    'run_repeat',
+]
+DEFAULT_MAX_WORKERS = 8
+
+
+class ArrayResultReference(object):
+    """A reference to an array result stored in a shot's hdf5 file.
+
+    The array isn't read from the file until load() is called, so tables of
+    many shots can include array results without using much memory.
+
+    Attributes:
+        h5_path (str): The path to the hdf5 file with the result.
+        group (str): The results group with the result, e.g. 'shot_results'.
+            Like lyse.Run, it's read from 'results/<group>' in the file.
+        name (str): The name of the dataset with the result.
+        shape (tuple of ints): The shape of the array.
+        dtype (np.dtype): The datatype of the stored array. Note that images
+            stored with a lossy encoding are decoded to float64 when loaded.
+    """
+
+    __slots__ = ('h5_path', 'group', 'name', 'shape', 'dtype')
+
+    def __init__(self, h5_path, group, name, shape, dtype):
+        self.h5_path = h5_path
+        self.group = group
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    def __repr__(self):
+        return (f"ArrayResultReference({self.name!r}, shape={self.shape}, "
+                f"dtype={self.dtype})")
+
+    def load(self, roi=None):
+        """Read the array from the hdf5 file.
+
+        Args:
+            roi (tuple of ints, optional): (Default = None) For images, only
+                this region is read. It should be given as (x, y, width,
+                height). See image_storage.read_image_dataset() for more
+                information.
+
+        Returns:
+            array (np.ndarray): The array, or its ROI.
+        """
+        with h5py.File(self.h5_path, 'r') as h5_file:
+            return read_image_dataset(h5_file['results'][self.group][self.name],
+                                      roi=roi)
+
+
+def convert_attribute(value):
+    """Convert an hdf5 attribute value to a more convenient python type.
+
+    This applies the same conversions as runmanager.get_shot_globals().
+    """
+    # Convert numpy bools to normal bools.
+    if isinstance(value, np.bool_):
+        value = bool(value)
+    # Convert null HDF references to None.
+    if isinstance(value, h5py.Reference) and not value:
+        value = None
+    # Convert numpy strings and bytes to python strings.
+    if isinstance(value, np.str_):
+        value = str(value)
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value
+
+
+def read_shot_row(h5_path, results_group='shot_results'):
+    """Read the globals, metadata, and results of one shot.
+
+    The file is opened only once. The metadata is calculated the same way as in
+    Shot.__init__().
+
+    Args:
+        h5_path (str): The path to the shot's hdf5 file.
+        results_group (str, optional): (Default = 'shot_results') The results
+            group from which to read the results. As with lyse.Run, it's stored
+            in 'results/<results_group>' in the hdf5 file.
+
+    Returns:
+        row (dict): A dictionary with the metadata, globals, and results of the
+            shot. Scalar results are included directly, and array results are
+            included as ArrayResultReference instances.
+        global_names (list of str): The names of the globals in row.
+        result_names (list of str): The names of the results in row.
+    """
+    with h5py.File(h5_path, 'r') as h5_file:
+        root_attributes = h5_file.attrs
+
+        # Metadata, using the same conventions as Shot.__init__().
+        seq_id = _ensure_str(root_attributes['sequence_id'])
+        row = {
+            'filepath': h5_path,
+            'sequence': asdatetime(seq_id.split('_')[0]),
+            'sequence_index': root_attributes.get('sequence_index', None),
+            'labscript': _ensure_str(root_attributes['script_basename']),
+            'run_number': root_attributes.get('run number', float('nan')),
+            'run_repeat': root_attributes.get('run repeat', 0),
+        }
+
+        # Globals.
+        global_names = []
+        for name, value in h5_file['globals'].attrs.items():
+            row[name] = convert_attribute(value)
+            global_names.append(name)
+
+        # Results. Globals take precedence if there is a name collision, which
+        # is the same as in Shot.__getattr__().
+        result_names = []
+        group_path = f'results/{results_group}'
+        if group_path in h5_file:
+            group = h5_file[group_path]
+            for name, value in group.attrs.items():
+                if name not in row:
+                    row[name] = convert_attribute(value)
+                    result_names.append(name)
+            for name, dataset in group.items():
+                if name not in row and isinstance(dataset, h5py.Dataset):
+                    row[name] = ArrayResultReference(
+                        h5_path, results_group, name, dataset.shape,
+                        dataset.dtype,
+                    )
+                    result_names.append(name)
+
+    return row, global_names, result_names
+
+
+def load_shot_table(shot_paths, max_workers=DEFAULT_MAX_WORKERS,
+                    results_group='shot_results', ignore_errors=True):
+    """Load the globals and results of many shots into a pandas DataFrame.
+
+    The files are read in parallel on a thread pool, which mainly helps hide the
+    latency of opening files and acquiring the hdf5 file locks. The rows of the
+    table are in the same order as shot_paths.
+
+    The names of the globals and results that are present in the table are
+    stored in table.attrs['globals'] and table.attrs['results'] respectively.
+    Shots that are missing a global or result get nan for it.
+
+    Args:
+        shot_paths (iterable of str): The paths to the shots' hdf5 files. This
+            can be e.g. the 'filepath' column of the Lyse dataframe.
+        max_workers (int, optional): (Default = DEFAULT_MAX_WORKERS) The maximum
+            number of threads used to read the files.
+        results_group (str, optional): (Default = 'shot_results') The results
+            group from which to read the results. As with lyse.Run, it's stored
+            in 'results/<results_group>' in the hdf5 files.
+        ignore_errors (bool, optional): (Default = True) If True, files which
+            can't be read (e.g. shots which haven't been run yet) are skipped
+            with a warning. If False, the error is raised.
+
+    Returns:
+        table (pandas.DataFrame): A table with one row per shot, with columns
+            for the metadata in METADATA_COLUMNS, the globals, and the results.
+    """
+    shot_paths = list(shot_paths)
+
+    def read_row(h5_path):
+        try:
+            return read_shot_row(h5_path, results_group=results_group)
+        except Exception as error:
+            if not ignore_errors:
+                raise
+            warnings.warn(f"Skipping {h5_path}, which couldn't be read: {error}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # executor.map() returns the results in the same order as shot_paths.
+        outputs = list(executor.map(read_row, shot_paths))
+
+    # Combine the rows, keeping track of all of the column names in order.
+    rows = []
+    global_names = {}
+    result_names = {}
+    for output in outputs:
+        if output is None:
+            continue
+        row, row_global_names, row_result_names = output
+        rows.append(row)
+        global_names.update(dict.fromkeys(row_global_names))
+        result_names.update(dict.fromkeys(row_result_names))
+
+    columns = METADATA_COLUMNS + list(global_names) + list(result_names)
+    table = pd.DataFrame.from_records(rows, columns=columns)
+    table.attrs['globals'] = list(global_names)
+    table.attrs['results'] = list(result_names)
+    return table
+
+
+def get_varied_globals(table, ignore=('shot_repetition_index',)):
+    """Get the names of the globals that take more than one value in a table.
+
+    Args:
+        table (pandas.DataFrame): A table as returned by load_shot_table().
+        ignore (iterable of str, optional): (Default =
+            ('shot_repetition_index',)) Globals which should never be included
+            in the returned list.
+
+    Returns:
+        varied_globals (list of str): The names of the globals which don't have
+            the same value for all of the shots in table, sorted alphabetically.
+    """
+    varied_globals = []
+    for name in table.attrs['globals']:
+        if name in ignore:
+            continue
+        # Arrays aren't hashable, so compare their string representations.
+        values = table[name].map(
+            lambda value: repr(value) if isinstance(value, np.ndarray) else value
+        )
+        if values.nunique(dropna=False) > 1:
+            varied_globals.append(name)
+    return sorted(varied_globals)
@@ -11,9 +11,10 @@ Partially based on y_vs_auto.py from Philip Starkey's thesis.
 script plots atom number as a function of shot index.
 * If one variable is changed, this script plots a line giving atom number as a
 function of that parameter.
-* TODO: If two parameters are scanned, this script makes a color plot where the
+* If two parameters are scanned, this script makes a color plot where the
 color corresponds to the atom number and the two axes are the two scanned
-parameters.
+parameters. Repeated shots are averaged, and the plot is updated in place as
+shots arrive (see scan_gridding.py).
 * If three or more parameters are scanned, this script plots many lines where
 the x-axis gives the value of one of the parameters, then each combination of
 the other parameters is plotted as one line.
@@ -21,10 +22,14 @@ the other parameters is plotted as one line.
 import matplotlib.pyplot as plt
 import numpy as np
 
-from lyse import Run, data, path
+from lyse import Run, data, path, routine_storage
 from analysislib.RbLab.lib.multishot_utils import (
     get_dataframe_subset, get_independents
 )
+from analysislib.Rydberg.analysis_utils.running_statistics import LineAggregator
+from analysislib.Rydberg.analysis_utils.scan_gridding import (
+    ScanGrid, ScanGridPlot
+)
 
 
 def plot_0D(df, y_parameter_tuple):
@@ -90,6 +95,36 @@ def plot_1D(df, x_parameter, y_parameter_tuple):
         fig.tight_layout()
 
 
+def plot_2D(df, x_parameter, y_parameter, z_column):
+    """Plot z_column as a color map over the two scanned parameters.
+
+    The grid and plot are kept in routine_storage, so each time this runs only
+    the shots added since the last run are binned, and only the cells that
+    changed are redrawn. If the scanned parameters change, or the figure was
+    closed, they are created again.
+    """
+    scan_grid = getattr(routine_storage, 'atom_number_scan_grid', None)
+    scan_plot = getattr(routine_storage, 'atom_number_scan_plot', None)
+    if scan_grid is None or not scan_grid.settings_match(
+            x_parameter, y_parameter, z_column):
+        scan_grid = ScanGrid(x_parameter, y_parameter, z_column)
+        routine_storage.atom_number_scan_grid = scan_grid
+        scan_plot = None
+    if scan_plot is None or not plt.fignum_exists(scan_plot.fig.number):
+        scan_plot = ScanGridPlot(
+            xlabel=f"{x_parameter} ({units[x_parameter]})",
+            ylabel=f"{y_parameter} ({units[y_parameter]})",
+            colorbar_label='Atom Number',
+            title=plot_title,
+        )
+        routine_storage.atom_number_scan_plot = scan_plot
+    changed_cells = scan_grid.update(df)
+    # A new plot is drawn from the whole grid.
+    if scan_plot.mesh is None:
+        changed_cells = None
+    scan_plot.update(scan_grid, changed_cells)
+
+
 # Begin actual analysis script
 
 # Get the relevant part of the Lyse dataframe
@@ -129,89 +164,74 @@ independents = get_independents(last_run)
 # elif n_independents == 1:
 #     plot_1D(df, independents[0], y_parameter_tuple)
 
-# Figure out what parameter to use for the x-axis
-# TODO: Make it possible to select x_parameter, maybe using a global
-if independents:
-    x_parameter = independents[0]
-else:
-    x_parameter = 'shot_repetition_index'
-
-# Set which parameters need to be the same for points to be part of the same
-# line in the plot.
-# Set whether different sequences are plotted separately or averaged
-if separate_sequences:
-    # In this case we should add 'sequence' to the list of things we use to
-    # decide which points should be on distinct lines in the plot
-    groupby_list = ['sequence'] + independents.copy()
+y_column = ('shot_results', 'atom_number')
+if len(independents) == 2:
+    # Make a color plot of the atom number over the two scanned parameters.
+    # Repeated shots are averaged regardless of separate_sequences.
+    plot_2D(df, independents[0], independents[1], y_column)
 else:
-    groupby_list = independents.copy()
-# Don't put points that only differ by their x_parameter value in
-# different lines
-if x_parameter in groupby_list:
-    groupby_list.remove(x_parameter)
-
-if not groupby_list:
-    # groupby isn't happy if groupby_list is empty. When it's empty we actually
-    # just want groupby to pass through everything in one group. To do this we
-    # pass it a function that just always returns True. This is a perfectly fine
-    # use of groupby, although admittedly it is a little misleading to call this
-    # variable groupby_list when it is not a list, but a function.
-    def groupby_list(x): return True  # pylint: disable=function-redefined
-
-# Give the index level 'sequence' a new name to avoid confusion with the column
-# called 'sequence' otherwise groupby() throws an error
-df.index.set_names('seq', level=0, inplace=True)
-
-# Iterate over all combinations of parameters besides x_parameter
-atom_number_figure = plt.figure()
-atom_number_axes = plt.subplot(111)
-for line_parameters, df_subset in df.groupby(groupby_list):
-    # line_parameters is a tuple of all the values for all the parameters
-    # included in groupby_list
-    # df_subset is a subset the of the Lyse dataframe which only includes the
-    # rows that have the values line_parameters for the elements included in
-    # groupby_list. Each subset is the data that should be included in each
-    # line.
-
-    # Iterate over the points in this line
-    x_values = []
-    atom_numbers = []
-    atom_number_uncertainties = []
-    for x_value, df_identical_shots in df_subset.groupby(x_parameter):
-        # x_value is the value of x_parameter for these shots
-        # df_identical_shots is a subset of the dataframe which only has shots
-        # with identical values for the variables in groupby_list. These may be
-        # from different sequences, i.e. different clicks of 'Engage' in
-        # Runmanager, if separate_sequences is False.
-        atom_number_data = df_identical_shots[(
-            'shot_results', 'atom_number')]
-        atom_number_average = atom_number_data.mean()
-        atom_number_uncertainty = atom_number_data.std()
-        # The uncertainty will be nan if there is only one shot
-
-        # Collect results
-        x_values.append(x_value)
-        atom_numbers.append(atom_number_average)
-        atom_number_uncertainties.append(atom_number_uncertainty)
-
-    # Now plot the line for this line_parameters set
-    # atom_number_axes.plot(x_values, atom_numbers, label=str(line_parameters))
-    atom_number_axes.errorbar(
-        x_values,
-        atom_numbers,
-        yerr=atom_number_uncertainties,
-        fmt='-o',
-        markersize=4,
-        capsize=2,
-        label=str(line_parameters),
-    )
-
-# Add legend
-atom_number_axes.set_title(plot_title)
-atom_number_axes.set_xlabel(f"{x_parameter} ({units[x_parameter]})")
-atom_number_axes.set_ylabel('Atom Number')
-atom_number_axes.legend()
-atom_number_figure.tight_layout()
+    # Figure out what parameter to use for the x-axis
+    # TODO: Make it possible to select x_parameter, maybe using a global
+    if independents:
+        x_parameter = independents[0]
+    else:
+        x_parameter = 'shot_repetition_index'
+
+    # Set which parameters need to be the same for points to be part of the
+    # same line in the plot.
+    # Set whether different sequences are plotted separately or averaged
+    if separate_sequences:
+        # In this case we should add 'sequence' to the list of things we use to
+        # decide which points should be on distinct lines in the plot
+        groupby_list = ['sequence'] + independents.copy()
+    else:
+        groupby_list = independents.copy()
+    # Don't put points that only differ by their x_parameter value in
+    # different lines
+    if x_parameter in groupby_list:
+        groupby_list.remove(x_parameter)
+
+    # Average the atom numbers of the points on each line. The aggregator is
+    # kept in routine_storage and only processes the shots added since this
+    # script last ran, so the time this takes doesn't grow over the course of a
+    # long scan. If the scanned parameters change, start a new aggregator.
+    aggregator = getattr(routine_storage, 'atom_number_aggregator', None)
+    if aggregator is None or not aggregator.settings_match(
+            groupby_list, x_parameter, y_column):
+        aggregator = LineAggregator(groupby_list, x_parameter, y_column)
+        routine_storage.atom_number_aggregator = aggregator
+    aggregator.update(df)
+
+    # Iterate over all combinations of parameters besides x_parameter
+    atom_number_figure = plt.figure()
+    atom_number_axes = plt.subplot(111)
+    for line_parameters, line_data in aggregator.lines().items():
+        # line_parameters is a tuple of all the values for all the parameters
+        # included in groupby_list. The points on the line are the averages
+        # over shots with identical values for those parameters and
+        # x_parameter. These may be from different sequences, i.e. different
+        # clicks of 'Engage' in Runmanager, if separate_sequences is False. The
+        # uncertainty will be nan if there is only one shot.
+        x_values, atom_numbers, atom_number_uncertainties, _ = line_data
+
+        # Now plot the line for this line_parameters set
+        # atom_number_axes.plot(x_values, atom_numbers, label=str(line_parameters))
+        atom_number_axes.errorbar(
+            x_values,
+            atom_numbers,
+            yerr=atom_number_uncertainties,
+            fmt='-o',
+            markersize=4,
+            capsize=2,
+            label=str(line_parameters),
+        )
+
+    # Add legend
+    atom_number_axes.set_title(plot_title)
+    atom_number_axes.set_xlabel(f"{x_parameter} ({units[x_parameter]})")
+    atom_number_axes.set_ylabel('Atom Number')
+    atom_number_axes.legend()
+    atom_number_figure.tight_layout()
 
 
 # Debug
@@ -69,7 +69,7 @@ Possible values for the mloop_cost_function_name global (include the quotes):
   * An uncertainty could be calculated via error propagation, but as of yet this
     hasn't been done and the uncertainty is simply always set to the value of
     the global mloop_cost_constant_uncertainty. See the docstring for
-    constant_uncertainty() in this lyse script for more details.
+    constant_uncertainty() in mloop_costs.py for more details.
   * Note that this method doesn't actually scale with the PSD when there is a
     BEC. In fact, for a pure BEC this cost scales as 1/N^(1/5) (i.e. when
     varying the atom number at zero temperature) ignoring the low-atom cutoff.
@@ -121,18 +121,29 @@ Possible values for the mloop_cost_function_name global (include the quotes):
   * This makes the cost function emphasize peak OD even more heavily than
     'bec_root_n_proxy' while still favoring larger BECs over smaller BECs.
 
-To add additional cost and uncertainty functions to this module, complete the
-following steps:
-
-* Define functions for the new cost and/or uncertainty in this script.
-  * The functions should take an instance of the RepeatedShot class as their
-    only argument.
+The cost and uncertainty functions are defined in
+analysislib/Rydberg/analysis_utils/mloop_costs.py. They take arrays with one
+entry per RepeatedShot in the dataset, so the costs of all of the RepeatedShot
+instances are calculated at once with array operations. The peak OD of each
+RepeatedShot is found with np.partition() rather than by sorting its whole OD
+image. To add additional cost and uncertainty functions, complete the following
+steps:
+
+* Define functions for the new cost and/or uncertainty in mloop_costs.py.
+  * The functions should take a GroupValues instance (or a dictionary of arrays)
+    as their only argument, and look up the results and globals that they need
+    by name, e.g. values['atom_number']. They should return an array with one
+    entry per RepeatedShot.
   * It's possible to use the same function in multiple cost/uncertainty pairs.
     In particular, the constant_uncertainty() function can be used as the
-    uncertainty function if no uncertainty can be calculated. It just alwyas
+    uncertainty function if no uncertainty can be calculated. It just always
     sets the uncertainty to be the value of the mloop_cost_constant_uncertainty
-    global.
-* Add an entry to cost_function_dict.
+    global. If a good value for the uncertainty isn't known, simply set that
+    global to zero. In that case, M-LOOP will automatically set it to
+    minimum_uncertainty. The default value of minimum_uncertainty is very small
+    which can lead to overfitting, so you'll likely want to set cost_has_noise
+    to True for optimizations where the uncertainty is set to zero.
+* Add an entry to COST_FUNCTIONS in mloop_costs.py.
   * The key should be the string that the user should use to select the new
     cost/uncertainty pair.
   * The value should be a tuple with two elements. The first should be the
@@ -147,211 +158,97 @@ analysis computer by transfer_files.py before this script is run, which means
 that there are two copies of the file. We typically save any additional results
 just to the copy on the analysis computer since that's the copy we use, but the
 M-LOOP integration code will look for results in the original copy. Results
-calculated here are saved to both copies using save_result_to_both_copies() from
-multishot_utils.py. That way the M-LOOP integration code still works, but we
-still get a complete copy of the shot file on the analysis computer.
+calculated here are saved to the original copy right away, so that the cost is
+reported to M-LOOP without waiting on the other copy. They are then replicated
+to the copy on the analysis computer in the background by a ResultReplicator
+from result_replication.py, which is kept in routine_storage between runs. That
+way the M-LOOP integration code still works, but we still get a complete copy of
+the shot file on the analysis computer. The path of the copy is found by
+replacing the start of the original path, given by the
+analysis_copy_original_prefix global, with the analysis_copy_prefix global. If
+those globals aren't set, the results are instead saved to both copies right
+away using save_result_to_both_copies() from multishot_utils.py, as before.
+
+The cost is also published over a local socket by a CostPublisher from
+cost_channel.py, so that an M-LOOP interface listening with a CostSubscriber
+gets it without reading the shot file. When the cost is delivered that way, it
+is saved to the original copy in the background as well, so that disk I/O
+doesn't hold up the next M-LOOP iteration. To test this without M-LOOP, run
+python -m analysislib.Rydberg.analysis_utils.cost_channel to start a stand-in
+subscriber that prints the costs it receives.
 """
 import numpy as np
 
+from lyse import data, routine_storage
+
 from analysislib.RbLab.lib.data_classes import Dataset, Shot
-from analysislib.RbLab.lib.multishot_utils import (
-    check_all_shots_run, check_all_singleshot_run, get_dataframe_subset,
-    save_result_to_both_copies,
+from analysislib.RbLab.lib.multishot_utils import save_result_to_both_copies
+from analysislib.Rydberg.analysis_utils.cost_channel import (
+    CostPublisher, create_write_behind, get_write_behind_journal_path,
+    report_cost,
+)
+from analysislib.Rydberg.analysis_utils.mloop_costs import (
+    GroupValues, evaluate_costs, top_k_mean,
+)
+from analysislib.Rydberg.analysis_utils.result_replication import (
+    analysis_copy_mapping, get_journal_path, update_replicator,
+)
+from analysislib.Rydberg.analysis_utils.sequence_tracker import (
+    claim_latest_sequence, describe_latest_sequence,
 )
 
 
-# Define possible cost and uncertainty functions:
-def atom_number(repeatedshot):
-    return repeatedshot.atom_number
-
-
-def atom_number_uncertainty(repeatedshot):
-    """Set the uncertainty to the atom number uncertainty if available.
-
-    This sets the uncertainty to repeatedshot.atom_number_uncertainty if it is
-    available. If there is only one shot in the RepeatedShot instance, then the
-    value of repeatedshot.atom_number_uncertainty will be nan, which causes
-    issues for M-LOOP. In that case we'll just set the uncertainty to zero
-    instead.
-
-    Args:
-        repeatedshot (RepeatedShot): An instance of the RepeatedShot class from
-            analysislib.RbLab.lib.data_classes for which the uncertainty should
-            be calculated.
-
-    Returns:
-        uncertainty (float): The uncertainty, which is set to the value of
-            repeatedshot.atom_number_uncertainty, unless that is nan in which
-            case zero is returned instead.
-    """
-    uncertainty = repeatedshot.atom_number_uncertainty
-    if np.isnan(uncertainty):
-        return 0
-    else:
-        return uncertainty
-
-
-def psd_3d_proxy_peak_od(repeatedshot):
-    # Set constant parameters
-    TYPICAL_PEAK_OD = 0.1
-
-    # Extract results and settings from repeatedshot.
-    atom_number = repeatedshot.atom_number
-    atom_threshold = repeatedshot.mloop_cost_atom_threshold
-    n_peak_pixels_average = repeatedshot.mloop_n_peak_pixels_average
-
-    # Average the OD of the pixels with the highest OD. The number of pixels to
-    # average is set by the mloop_n_peak_pixels_average global.
-    od_image = repeatedshot.od_image
-    sorted_array = np.sort(od_image, axis=None)
-    mean_largest = np.mean(sorted_array[-n_peak_pixels_average:])
-    peak_od = mean_largest
-
-    # Scale peak_od and atom_number to make the resulting cost ~1. Otherwise it
-    # can end up very small, say order ~1e-12, which can cause numerics issues
-    # for M-LOOP, or at least its neural net learner as of version 2.2.0.
-    peak_od_prime = peak_od / TYPICAL_PEAK_OD
-    atom_number_prime = atom_number / atom_threshold
-
-    # Calculate the proxy for the PSD.
-    psd_proxy = peak_od_prime**3 / atom_number_prime**2
-
-    # Calculate the thresholding function to suppress noise in the cost at low
-    # atom numbers.
-    if atom_number >= 0:
-        thresholding_value = 2. / (np.exp(atom_threshold / atom_number) + 1.)
-    else:
-        thresholding_value = 0.
-
-    # Combine to get the cost.
-    cost = psd_proxy * thresholding_value
-    return cost
-
-
-def bec_number_proxy(repeatedshot):
-    # Extract results and settings from repeatedshot.
-    atom_number = repeatedshot.atom_number
-    atom_threshold = repeatedshot.mloop_cost_atom_threshold
-
-    # The psd_proxy scales as 1/N^(1/5) for a pure BEC (neglecting the low atom-
-    # number cutoff). So multiply it by N^(6/5).
-    psd_proxy = psd_3d_proxy_peak_od(repeatedshot)
-    atom_number_prime = atom_number / atom_threshold
-    # Set it atom number to 0 if it was measured to be a negative value.
-    atom_number_prime = max(0, atom_number_prime)
-
-    # PSD proxy scales as 1/N^(1/5) at T=0, so need to multiply it by N^(6/5) to
-    # get something that scales as N at T=0.
-    cost = psd_proxy * (atom_number_prime)**(6. / 5.)
-
-    return cost
-
-
-def bec_root_n_proxy(repeatedshot):
-    # Extract results and settings from repeatedshot.
-    atom_number = repeatedshot.atom_number
-    atom_threshold = repeatedshot.mloop_cost_atom_threshold
-
-    # The psd_proxy scales as 1/N^(1/5) for a pure BEC (neglecting the low atom-
-    # number cutoff). So multiply it by N^(6/5).
-    psd_proxy = psd_3d_proxy_peak_od(repeatedshot)
-    atom_number_prime = atom_number / atom_threshold
-    # Set it atom number to 0 if it was measured to be a negative value.
-    atom_number_prime = max(0, atom_number_prime)
-
-    # PSD proxy scales as 1/N^(1/5) at T=0, so need to multiply it by
-    # N^(1/5)*N^(1/2) = N^(7/10) to get something that scales as N^(1/2) at T=0.
-    cost = psd_proxy * (atom_number_prime)**(0.7)
-
-    return cost
-
-
-def bec_fourth_root_n_proxy(repeatedshot):
-    # Extract results and settings from repeatedshot.
-    atom_number = repeatedshot.atom_number
-    atom_threshold = repeatedshot.mloop_cost_atom_threshold
-
-    # The psd_proxy scales as 1/N^(1/5) for a pure BEC (neglecting the low atom-
-    # number cutoff). So multiply it by N^(6/5).
-    psd_proxy = psd_3d_proxy_peak_od(repeatedshot)
-    atom_number_prime = atom_number / atom_threshold
-    # Set it atom number to 0 if it was measured to be a negative value.
-    atom_number_prime = max(0, atom_number_prime)
-
-    # PSD proxy scales as 1/N^(1/5) at T=0, so need to multiply it by
-    # N^(1/5)*N^(1/4) = N^(9/20) = N^0.45 to get something that scales as
-    # N^(1/4) for a pure BEC.
-    cost = psd_proxy * (atom_number_prime)**(0.45)
-
-    return cost
-
-
-def constant_uncertainty(repeatedshot):
-    """Set the uncertainty to the value of mloop_cost_constant_uncertainty.
-
-    If constant_uncertainty() is used but a good value for uncertainty isn't
-    known, simply set mloop_cost_constant_uncertainty to zero. In that case,
-    M-LOOP will automatically set it to minimum_uncertainty. The default value
-    of minimum_uncertainty is very small which can lead to overfitting, so
-    you'll likely want to set cost_has_noise to True for optimizations where the
-    uncertainty is set to zero.
-
-    Args:
-        repeatedshot (RepeatedShot): An instance of the RepeatedShot class from
-            analysislib.RbLab.lib.data_classes for which the uncertainty should
-            be calculated.
-
-    Returns:
-        uncertainty (float): The uncertainty, which is set to the value of the
-            global mloop_cost_constant_uncertainty.
-    """
-    return repeatedshot.mloop_cost_constant_uncertainty
-
-
-# Create a dictionary for looking up the cost and uncertainty functions. The
-# keys are the allowed values of the mloop_cost_function_name global. The values
-# are tuples where the first entry is the function that calculates the cost, and
-# the second entry is the function that calculates the uncertainty of the cost.
-cost_function_dict = {
-    'atom_number': (atom_number, atom_number_uncertainty),
-    'psd_3d_proxy_peak_od': (psd_3d_proxy_peak_od, constant_uncertainty),
-    'bec_number_proxy': (bec_number_proxy, constant_uncertainty),
-    'bec_root_n_proxy': (bec_root_n_proxy, constant_uncertainty),
-    'bec_fourth_root_n_proxy': (bec_fourth_root_n_proxy, constant_uncertainty),
-}
-
-
-# Get a subset of the Lyse dataframe containing only the shots to analyze.
-df_subset = get_dataframe_subset(n_sequences_to_include=1)
-
-# Check if the all of the shots from this call to engage in runmanager have
-# completed.
-all_shots_run = check_all_shots_run(df_subset)
+# Identifies this routine to the sequence tracker and names its journal.
+ROUTINE_NAME = 'mloop_calculate_cost'
 
-# Check if the single shot routines have been run on all the shots from this
-# call to engage in runmanager. Since the results here depend on results from
+# Update the tracker of which sequences have finished, and claim the latest
+# sequence if all of its shots have run and been through the single shot
+# routines. Since the results here depend on results from
 # on_the_fly_absorption_image_processing.py we have to make sure that the single
-# shot routines run on all of the shots before we give results to M-LOOP.
-# Sometimes a shot can be added after lyse starts running the multishot
-# routines. That can lead to a scenario where all the shots have run but the
-# single shot routines haven't been run on one or more of them.
-all_singleshot_run = check_all_singleshot_run(df_subset)
-
-# Create an instance of our custom Shot class. This class inherits from lyse.Run
-# so it has all of that class's methods and more, and so it can be used in place
-# of the lyse.Run class. We'll use the original copy since the M-LOOP script
-# will look for results in that file.
-shot_path = df_subset['filepath'].iloc[-1]
-last_shot = Shot(shot_path)
-
-# Set where results are saved for that shot file
-results_group = 'results/mloop_costs'
-
-if all_shots_run and all_singleshot_run:
+# shot routines run on all of the shots before we give results to M-LOOP. The
+# tracker only looks at new or unfinished shots, and each sequence is only
+# claimed once, so the analysis below runs once per sequence. Clicking "Run
+# multishot analysis" runs it again for the latest sequence if it's complete.
+# See sequence_tracker.py.
+df_subset = claim_latest_sequence(data(), ROUTINE_NAME)
+
+# Get the publisher which sends costs straight to the M-LOOP side over a local
+# socket, and the replicator which then saves them to the original copy of the
+# shot file in the background. See cost_channel.py. The write-behind replicator
+# has its own journal for this routine, since each Lyse routine runs in its own
+# process.
+if not hasattr(routine_storage, 'cost_publisher'):
+    routine_storage.cost_publisher = CostPublisher()
+    routine_storage.cost_write_behind = create_write_behind(
+        get_write_behind_journal_path(ROUTINE_NAME))
+publisher = routine_storage.cost_publisher
+write_behind = routine_storage.cost_write_behind
+
+if df_subset is not None:
     # All of the shots have completed, so do the analysis and save the result
     # for mloop_multishot.py
     print("All shots of engage have completed, generating results for mloop...")
 
+    # Create an instance of our custom Shot class. This class inherits from
+    # lyse.Run so it has all of that class's methods and more, and so it can be
+    # used in place of the lyse.Run class. We'll use the original copy since the
+    # M-LOOP script will look for results in that file.
+    last_shot = Shot(df_subset['filepath'].iloc[-1])
+
+    # Get the replicator which copies results to the analysis computer's copy
+    # of the shot file. Keeping it in routine_storage keeps its background
+    # thread alive between runs of this script. It's replaced if the globals
+    # giving the path of the copy change, and it has its own journal since each
+    # Lyse routine runs in its own process.
+    routine_storage.result_replicator = update_replicator(
+        getattr(routine_storage, 'result_replicator', None),
+        analysis_copy_mapping(last_shot.get_globals()),
+        get_journal_path(ROUTINE_NAME),
+    )
+    # If the globals aren't set, report_cost() saves the results to both
+    # copies right away with save_result_to_both_copies() instead.
+    replicator = routine_storage.result_replicator
+
     # Construct a Dataset instance
     dataset = Dataset(df_subset)
 
@@ -362,44 +259,53 @@ if all_shots_run and all_singleshot_run:
     dataset.integrate_od_images()
     dataset.fit_gaussians()
 
+    # Collect the results and globals that the cost functions need into arrays
+    # with one entry per RepeatedShot. They're only collected when a cost
+    # function asks for them. The peak OD is the average OD of the pixels with
+    # the highest OD in each RepeatedShot's averaged OD image. The number of
+    # pixels to average is set by the mloop_n_peak_pixels_average global.
+    repeatedshot_list = dataset.repeatedshot_list
+    values = GroupValues(
+        repeatedshot_list,
+        derived={
+            'peak_od': lambda repeatedshot: top_k_mean(
+                repeatedshot.od_image,
+                repeatedshot.mloop_n_peak_pixels_average,
+            ),
+        },
+    )
+
+    # Evaluate the cost and uncertainty, specified by the global
+    # mloop_cost_function_name, for all of the RepeatedShot instances at once.
+    key = repeatedshot_list[0].mloop_cost_function_name
+    costs, uncertainties = evaluate_costs(key, values)
+
     # Assume that there is only one repeatedshot instance in the dataset for
     # now. Later we may generalize to allow more than one repeatedshot to
     # analyze time-of-flight scan data, etc..
-    repeatedshot = dataset.repeatedshot_list[0]
-
-    # Get the functions corresponding to the cost specified by the global
-    # mloop_cost_function_name.
-    key = repeatedshot.mloop_cost_function_name
-    cost_function, uncertainty_function = cost_function_dict[key]
+    cost = float(costs[0])
+    uncertainty = float(uncertainties[0])
 
-    # Evaluate the cost and uncertainty
-    cost = cost_function(repeatedshot)
-    uncertainty = uncertainty_function(repeatedshot)
-
-    # Save cost.
-    save_result_to_both_copies(
+    # Publish the cost to M-LOOP and save it, along with its uncertainty, to
+    # both copies of the shot file. Runs with a nan cost are marked as bad.
+    report_cost(
         last_shot,
-        'mloop_cost',
         cost,
-        group=results_group,
-    )
-    # Save uncertainty with naming convention required by the mloop lyse
-    # integration code.
-    save_result_to_both_copies(
-        last_shot,
-        'u_mloop_cost',
         uncertainty,
-        group=results_group,
+        publisher,
+        write_behind,
+        replicator,
+        bad=not np.isfinite([cost, uncertainty]).all(),
+        shot_ids=df_subset['filepath'],
+        save_to_both_copies=save_result_to_both_copies,
     )
 
     # Print results.
     print(f"Cost: {cost} +/- {uncertainty}")
 else:
-    # In this case we're not ready for M-LOOP yet so we'll avoid running the
-    # M-LOOP analysis. We don't need to save results in this case. The M-LOOP
-    # integration code will just get nan for mloop_cost and u_mloop_cost since
-    # their entries are empty in the dataframe, then it won't run.
-    if not all_shots_run:
-        print("Not all shots have run, skipping M-LOOP.")
-    elif not all_singleshot_run:
-        print("Single shot routines haven't run on all shots, skipping M-LOOP.")
+    # In this case we're not ready for M-LOOP yet, or this sequence was already
+    # analyzed, so we'll avoid running the M-LOOP analysis. We don't need to
+    # save results in this case. The M-LOOP integration code will just get nan
+    # for mloop_cost and u_mloop_cost since their entries are empty in the
+    # dataframe, then it won't run.
+    print(f"{describe_latest_sequence()} Skipping M-LOOP.")
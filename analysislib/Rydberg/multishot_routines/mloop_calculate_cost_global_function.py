@@ -11,7 +11,9 @@ and this script will use that string to generate a python function using eval().
 The code in the string can use python's lambda function feature to return a
 function. If desired, values of other globals can be inserted into the function
 by insterting them into the string using f-strings or other python string
-formatting utilities.
+formatting utilities. The generated functions are cached by their source string
+by mloop_costs.compile_cost_function(), so eval() only runs again when the
+string changes. The code is evaluated with numpy available as np.
 
 Usage Instructions:
 * Define a global called mloop_cost_function.
@@ -29,7 +31,13 @@ Usage Instructions:
 * Ensure that this script is added to Lyse's multishot routines and is checked.
 * Ensure that the singleshot routine on_the_fly_absorption_image_processing.py
   is checked.
+* Ensure that the singleshot routine mark_shot_finished.py is checked and is the
+  last singleshot routine, so that this script knows when a sequence is done.
+  Without it, each unfinished sequence is checked with check_all_shots_run() and
+  check_all_singleshot_run() from multishot_utils.py every time, as before.
 * Start optimization by clicking "Run multishot analysis".
+  * If the latest sequence is already complete, this reports its cost again,
+    even if it was already analyzed when its last shot finished.
   * Starting the optimization by clicking engage in runmanager is probably a bad
     idea when using multiple shots per M-LOOP iteration.
 
@@ -39,53 +47,96 @@ analysis computer by transfer_files.py before this script is run, which means
 that there are two copies of the file. We typically save any additional results
 just to the copy on the analysis computer since that's the copy we use, but the
 M-LOOP integration code will look for results in the original copy. Results
-calculated here are saved to both copies using save_result_to_both_copies() from
-multishot_utils.py. That way the M-LOOP integration code still works, but we
-still get a complete copy of the shot file on the analysis computer.
+calculated here are saved to the original copy right away, so that the cost is
+reported to M-LOOP without waiting on the other copy. They are then replicated
+to the copy on the analysis computer in the background by a ResultReplicator
+from result_replication.py, which is kept in routine_storage between runs. That
+way the M-LOOP integration code still works, but we still get a complete copy of
+the shot file on the analysis computer. The path of the copy is found by
+replacing the start of the original path, given by the
+analysis_copy_original_prefix global, with the analysis_copy_prefix global. If
+those globals aren't set, the results are instead saved to both copies right
+away using save_result_to_both_copies() from multishot_utils.py, as before.
+
+The cost is also published over a local socket by a CostPublisher from
+cost_channel.py, so that an M-LOOP interface listening with a CostSubscriber
+gets it without reading the shot file. When the cost is delivered that way, it
+is saved to the original copy in the background as well, so that disk I/O
+doesn't hold up the next M-LOOP iteration. To test this without M-LOOP, run
+python -m analysislib.Rydberg.analysis_utils.cost_channel to start a stand-in
+subscriber that prints the costs it receives.
 """
 import os
 
 import matplotlib.pyplot as plt
 import numpy as np
 
-from lyse import Run, data, path
+from lyse import Run, data, path, routine_storage
 from analysislib.RbLab.lib.data_classes import Dataset, Shot
-from analysislib.RbLab.lib.multishot_utils import (
-    check_all_shots_run, check_all_singleshot_run, get_dataframe_subset,
-    save_result_to_both_copies,
+from analysislib.RbLab.lib.multishot_utils import save_result_to_both_copies
+from analysislib.Rydberg.analysis_utils.cost_channel import (
+    CostPublisher, create_write_behind, get_write_behind_journal_path,
+    report_cost,
+)
+from analysislib.Rydberg.analysis_utils.mloop_costs import compile_cost_function
+from analysislib.Rydberg.analysis_utils.result_replication import (
+    analysis_copy_mapping, get_journal_path, update_replicator,
+)
+from analysislib.Rydberg.analysis_utils.sequence_tracker import (
+    claim_latest_sequence, describe_latest_sequence,
 )
 
-# Get a subset of the Lyse dataframe containing only the shots to analyze.
-df_subset = get_dataframe_subset(n_sequences_to_include=1)
-
-# Check if the all of the shots from this call to engage in runmanager have
-# completed.
-all_shots_run = check_all_shots_run(df_subset)
+# Identifies this routine to the sequence tracker and names its journal.
+ROUTINE_NAME = 'mloop_calculate_cost_global_function'
 
-# Check if the single shot routines have been run on all the shots from this
-# call to engage in runmanager. Since the results here depend on results from
+# Update the tracker of which sequences have finished, and claim the latest
+# sequence if all of its shots have run and been through the single shot
+# routines. Since the results here depend on results from
 # on_the_fly_absorption_image_processing.py we have to make sure that the single
-# shot routines run on all of the shots before we give results to M-LOOP.
-# Sometimes a shot can be added after lyse starts running the multishot
-# routines. That can lead to a scenario where all the shots have run but the
-# single shot routines haven't been run on one or more of them.
-all_singleshot_run = check_all_singleshot_run(df_subset)
-
-# Create an instance of our custom Shot class. This class inherits from lyse.Run
-# so it has all of that class's methods and more, and so it can be used in place
-# of the lyse.Run class. We'll use the original copy since the M-LOOP script
-# will look for results in that file.
-shot_path = df_subset['filepath'].iloc[-1]
-last_shot = Shot(shot_path)
-
-# Set where results are saved for that shot file
-results_group = 'results/mloop_costs'
-
-if all_shots_run and all_singleshot_run:
+# shot routines run on all of the shots before we give results to M-LOOP. The
+# tracker only looks at new or unfinished shots, and each sequence is only
+# claimed once, so the analysis below runs once per sequence. Clicking "Run
+# multishot analysis" runs it again for the latest sequence if it's complete.
+# See sequence_tracker.py.
+df_subset = claim_latest_sequence(data(), ROUTINE_NAME)
+
+# Get the publisher which sends costs straight to the M-LOOP side over a local
+# socket, and the replicator which then saves them to the original copy of the
+# shot file in the background. See cost_channel.py. The write-behind replicator
+# has its own journal for this routine, since each Lyse routine runs in its own
+# process.
+if not hasattr(routine_storage, 'cost_publisher'):
+    routine_storage.cost_publisher = CostPublisher()
+    routine_storage.cost_write_behind = create_write_behind(
+        get_write_behind_journal_path(ROUTINE_NAME))
+publisher = routine_storage.cost_publisher
+write_behind = routine_storage.cost_write_behind
+
+if df_subset is not None:
     # All of the shots have completed, so do the analysis and save the result
     # for mloop_multishot.py
     print("All shots of engage have completed, generating results for mloop...")
 
+    # Create an instance of our custom Shot class. This class inherits from
+    # lyse.Run so it has all of that class's methods and more, and so it can be
+    # used in place of the lyse.Run class. We'll use the original copy since the
+    # M-LOOP script will look for results in that file.
+    last_shot = Shot(df_subset['filepath'].iloc[-1])
+
+    # Get the replicator which copies results to the analysis computer's copy
+    # of the shot file. Keeping it in routine_storage keeps its background
+    # thread alive between runs of this script. It's replaced if the globals
+    # giving the path of the copy change, and it has its own journal since each
+    # Lyse routine runs in its own process.
+    routine_storage.result_replicator = update_replicator(
+        getattr(routine_storage, 'result_replicator', None),
+        analysis_copy_mapping(last_shot.get_globals()),
+        get_journal_path(ROUTINE_NAME),
+    )
+    # If the globals aren't set, report_cost() saves the results to both
+    # copies right away with save_result_to_both_copies() instead.
+    replicator = routine_storage.result_replicator
+
     # Construct a Dataset instance
     dataset = Dataset(df_subset)
 
@@ -101,37 +152,35 @@ if all_shots_run and all_singleshot_run:
     # analyze time-of-flight scan data, etc..
     repeatedshot = dataset.repeatedshot_list[0]
 
-    # Calculate the cost.
-    cost_function = eval(repeatedshot.mloop_cost_function)
+    # Calculate the cost and its uncertainty. The functions are only compiled
+    # with eval() the first time their source is seen; after that the cached
+    # functions are reused.
+    cost_function = compile_cost_function(repeatedshot.mloop_cost_function)
     cost = cost_function(repeatedshot)
-    save_result_to_both_copies(
-        last_shot,
-        'mloop_cost',
-        cost,
-        group=results_group,
-    )
-
-    # Calculate the cost uncertainty.
-    uncertainty_function = eval(repeatedshot.mloop_cost_uncertainty_function)
+    uncertainty_function = compile_cost_function(
+        repeatedshot.mloop_cost_uncertainty_function)
     uncertainty = uncertainty_function(repeatedshot)
-    # Save uncertainty with naming convention required by the mloop lyse
-    # integration code.
-    save_result_to_both_copies(
+
+    # Publish the cost to M-LOOP and save it, along with its uncertainty, to
+    # both copies of the shot file. Runs with a nan cost are marked as bad.
+    report_cost(
         last_shot,
-        'u_mloop_cost',
+        cost,
         uncertainty,
-        group=results_group,
+        publisher,
+        write_behind,
+        replicator,
+        bad=not np.isfinite([cost, uncertainty]).all(),
+        shot_ids=df_subset['filepath'],
+        save_to_both_copies=save_result_to_both_copies,
     )
 
     # Print results.
     print(f"Cost: {cost} +/- {uncertainty}")
 else:
-    # In this case we're not ready for M-LOOP yet. We'll avoid running the
-    # M-LOOP analysis by settings the results to nan.
-    if not all_shots_run:
-        print("Not all shots have run, skipping M-LOOP.")
-    elif not all_singleshot_run:
-        print("Single shot routines haven't run on all shots, skipping M-LOOP.")
-    # Don't need to save results in this case. The M-LOOP integration code will
-    # just get nan for mloop_cost and u_mloop_cost anyway since their entries
-    # are empty in the dataframe.
+    # In this case we're not ready for M-LOOP yet, or this sequence was already
+    # analyzed, so we'll avoid running the M-LOOP analysis. We don't need to
+    # save results in this case. The M-LOOP integration code will just get nan
+    # for mloop_cost and u_mloop_cost since their entries are empty in the
+    # dataframe, then it won't run.
+    print(f"{describe_latest_sequence()} Skipping M-LOOP.")
@@ -35,25 +35,23 @@ import numpy as np
 from lyse import data, routine_storage, Run
 from analysislib.RbLab.lib.absorption_image_processor import AbsorptionImageProcessor
 from analysislib.RbLab.lib.data_classes import Dataset
-from analysislib.RbLab.lib.multishot_utils import (
-    check_all_shots_run, check_all_singleshot_run, get_dataframe_subset,
+from analysislib.Rydberg.analysis_utils.sequence_tracker import (
+    claim_latest_sequence, describe_latest_sequence,
 )
 
 # Keep track of how long this script takes to run.
 start_time = time.time()
 
-# Get a subset of the Lyse dataframe containing only the shots to analyze.
-df_subset = get_dataframe_subset(n_sequences_to_include=1)
+# Get the shots from the last call to engage in runmanager, but only once all of
+# them have run and been through the single shot routines. Each sequence is only
+# returned once, so the analysis below runs once per sequence rather than
+# checking the whole sequence on every shot. Clicking "Run multishot analysis"
+# runs it again for the latest sequence if it's complete. See
+# sequence_tracker.py.
+df_subset = claim_latest_sequence(
+    data(), 'multishot_on_the_fly_absorption_image_processing')
 
-# Check if the all of the shots from this call to engage in runmanager have
-# completed.
-all_shots_run = check_all_shots_run(df_subset)
-
-# Check if the single shot routines have been run on all the shots from this
-# call to engage in runmanager.
-all_singleshot_run = check_all_singleshot_run(df_subset)
-
-if all_shots_run and all_singleshot_run:
+if df_subset is not None:
     # Construct a Dataset intance to hold the shots.
     dataset = Dataset(df_subset)
 
@@ -122,6 +120,8 @@ if all_shots_run and all_singleshot_run:
     # Do the analysis on the images.
     dataset.process_images(processor)
     # dataset.fit_gaussians()
+else:
+    print(describe_latest_sequence())
 
 end_time = time.time()
 script_duration = end_time - start_time
@@ -1,15 +1,19 @@
 """Plot atom number as a function of a scanned global.
 
-This multishot script still needs a lot of work. It doesn't handle averaging
-results from identical repeated shots, it can't handle 2-parameter scans, and it
-likely errors if no parameters are scanned.
+This multishot script still needs a lot of work. Identical repeated shots are
+averaged together, but it can't handle 2-parameter scans, and it likely errors
+if no parameters are scanned.
 """
 import matplotlib.pyplot as plt
 import numpy as np
 
 from lyse import Run, data, path
-from analysislib.RbLab.lib.data_classes import Dataset, Shot
 from analysislib.RbLab.lib.multishot_utils import get_dataframe_subset
+from analysislib.Rydberg.analysis_utils.shot_grouping import group_rows
+from analysislib.Rydberg.analysis_utils.shot_table import (
+    get_varied_globals,
+    load_shot_table,
+)
 
 # Get dataframe from Lyse.
 df = data(n_sequences=1)
@@ -18,24 +22,23 @@ df_subset = df
 # Get a subset of the Lyse dataframe containing only the shots to analyze.
 # df_subset = get_dataframe_subset()
 
-# Construct a Dataset instance
-separate_sequences = df_subset['separate_sequences'][-1]
-dataset = Dataset(df_subset, separate_sequences=separate_sequences)
+# Load the globals and results of all of the shots in one go.
+table = load_shot_table(df_subset['filepath'])
 
 # Find out what variables were scanned.
-independents = dataset.get_independent_globals()
+independents = get_varied_globals(table)
 
-# Make the plot.
-# axes = dataset.plot_lines(independents[0], 'atom_number')
-# Need to determine how to appropriately do multishot averaging using the
-# Dataset class. For now we'll just use the singleshot results from the
-# dataframe.
+# Average together the repeated shots for each value of the scanned variable.
 x_variable = independents[0]
-x_values = df[x_variable].values
-y_values = df[('shot_results', 'atom_number')].values
+grouping = group_rows(table, [x_variable])
+x_values = grouping.keys[x_variable]
+y_values = grouping.mean(table['atom_number'])
+y_errors = grouping.sem(table['atom_number'])
+
+# Make the plot.
 fig = plt.figure(111)
 axes = fig.add_subplot(111)
-axes.plot(x_values, y_values, linestyle='-', marker='o')
+axes.errorbar(x_values, y_values, yerr=y_errors, linestyle='-', marker='o')
 axes.set_xlabel(x_variable)
 axes.set_ylabel('Atom Number')
 plt.tight_layout()
@@ -0,0 +1,18 @@
+"""Plot thumbnails of the processed images of many shots in one figure.
+
+This is useful for quickly scanning through a lot of shots to find outliers.
+The thumbnails are read from the image pyramids that Shot.process_image() saves
+with the processed image, so only a small amount of data is read per shot.
+Clicking on a thumbnail prints the path of its shot.
+"""
+import matplotlib.pyplot as plt
+
+from lyse import data
+from analysislib.Rydberg.analysis_utils.image_pyramid import plot_contact_sheet
+
+# Get dataframe from Lyse.
+df = data()
+
+# Plot the processed images of all of the shots.
+plot_contact_sheet(df['filepath'], 'processed_image', thumbnail_shape=(64, 64))
+plt.tight_layout()
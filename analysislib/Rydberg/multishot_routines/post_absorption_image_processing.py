@@ -10,14 +10,23 @@ on the control computer.
 The script's name begins with "post" to imply that it should be used for post-
 analysis of accumulated data rather than for processing data on-the-fly as it
 comes in. This is due to the lengthy processing time required for this analysis.
+
+The shots are loaded on a thread pool by shot_loading.load_shots(), which
+prints its progress and can be cancelled by pressing the escape key. Loaded
+shots are kept in a cache in routine_storage, so running this again after a few
+more shots have arrived (or after cancelling) only loads the new shots, and the
+shots whose files were modified by something else since.
 """
 import numpy as np
 
-from lyse import Run, data, path
+from lyse import Run, data, path, routine_storage
 from analysislib.RbLab.lib.absorption_image_processor import \
     AbsorptionImageProcessor
 from analysislib.RbLab.lib.data_classes import Dataset, Shot
 from analysislib.RbLab.lib.multishot_utils import get_dataframe_subset
+from analysislib.Rydberg.analysis_utils.shot_loading import (
+    ShotCache, cancel_on_key, load_shots, print_progress,
+)
 
 # Get dataframe from Lyse
 df = data()
@@ -25,9 +34,24 @@ df = data()
 # Get a subset of the Lyse containing only the shots to analyze
 df_subset = get_dataframe_subset()
 
-# Construct a Dataset instance
+# Keep the loaded Shot instances between runs of this script so that only new
+# shots have to be loaded.
+if not hasattr(routine_storage, 'shot_cache'):
+    routine_storage.shot_cache = ShotCache()
+shot_cache = routine_storage.shot_cache
+
+# Construct a Dataset instance from shots loaded in parallel, rather than
+# letting it create a Shot for each row of df_subset one after another.
 separate_sequences = df_subset['separate_sequences'][-1]
-dataset = Dataset(df_subset, separate_sequences=separate_sequences)
+with cancel_on_key() as cancel_event:
+    shot_list = load_shots(
+        df_subset['filepath'],
+        shot_class=Shot,
+        progress_callback=print_progress,
+        cancel_event=cancel_event,
+        cache=shot_cache,
+    )
+dataset = Dataset(shot_list, separate_sequences=separate_sequences)
 
 # Configure settings
 max_principal_components = df_subset['post_max_principal_components'][-1]
@@ -57,8 +81,17 @@ max_beam_images = len(df_beam_images.index)
 processor = AbsorptionImageProcessor(max_beam_images=max_beam_images,
                                      max_principal_components=max_principal_components,
                                      use_sparse_routines=True)
-for shot_path in df_beam_images['filepath']:
-    shot = Shot(shot_path)
+# Load those shots in parallel too. Most of them are usually already in the
+# cache.
+with cancel_on_key() as cancel_event:
+    beam_shot_list = load_shots(
+        df_beam_images['filepath'],
+        shot_class=Shot,
+        progress_callback=print_progress,
+        cancel_event=cancel_event,
+        cache=shot_cache,
+    )
+for shot in beam_shot_list:
     processor.add_beam_image(shot)
 
 # Mask atom region
@@ -69,3 +102,8 @@ processor.set_rectangular_mask(atom_region_rows, atom_region_cols)
 # Perform the data analysis
 dataset.process_images(processor)
 dataset.fit_gaussians()
+
+# Saving the results modified the shot files, so the cache would load the shots
+# again next time. The cached shots have the new results, so keep them.
+for h5_path in df_subset['filepath']:
+    shot_cache.refresh(Shot, h5_path)
@@ -5,12 +5,15 @@ from analysislib.Rydberg.analysis_utils.data_classes import Shot
 # images, traces, and results from analysis.
 shot = Shot(path)
 
-# image with atoms + imaging beam
-atoms_image = shot.get_image('basler', 'CMOT', 'atoms')
-# image without atoms + imaging beam
-no_atoms_image = shot.get_image('basler', 'CMOT', 'no_atoms')
+# image with atoms + imaging beam, and image without atoms + imaging beam. Both are read with one file open.
+# These are read as full frames rather than with get_images(..., roi=...), because process_image() saves the full
+# processed image, adds its artificial cloud at fixed full-frame pixel positions, and can move the automatic ROI
+# anywhere on the sensor. Scripts that only need a known region should pass roi to read just that hyperslab.
+atoms_image, no_atoms_image = shot.get_images('basler', 'CMOT', ('atoms', 'no_atoms'), dtype=float)
 # optionally can include an image that has none of the above (a background image) and pass this to process_image as well
 
+# Use fit_mode='moments' to only calculate a closed-form atom number estimate, saved as atom_number_estimate, and skip
+# the full gaussian fits, e.g. to keep up with the camera during live feedback.
 shot.process_image(atoms_image, no_atoms_image, plot=True)
 
 
@@ -0,0 +1,13 @@
+"""Mark that the singleshot routines have finished for this shot.
+
+This should be the last routine in Lyse's list of singleshot routines. The
+result it saves is how sequence_tracker.SequenceTracker knows that the shot is
+ready for the multishot routines, so they can run once per completed sequence.
+"""
+from lyse import Run, path
+from analysislib.Rydberg.analysis_utils.sequence_tracker import FINISHED_RESULT_NAME
+
+# Get the Run instance for the shot. Its results are saved in the
+# 'mark_shot_finished' group, which gives the column that the tracker checks.
+run = Run(path)
+run.save_result(FINISHED_RESULT_NAME, True)